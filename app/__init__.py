@@ -1,4 +1,5 @@
 import os
+import json
 from flask import Flask
 
 def create_app():
@@ -12,8 +13,142 @@ def create_app():
     
     app.config['SECRET_KEY'] = '1qaz'
     
+    # gunicorn多进程部署时的worker进程数（由 gunicorn.conf.py 设置）。多个进程时下载并发数和平台/CDN限流
+    # 通过 RATE_LIMIT_DIR 中的文件锁共享，配置值是整台机器的总量，与单进程部署时相同
+    app.config['WEB_WORKERS'] = max(1, int(os.environ.get('WEB_WORKERS', 1)))
+    app.config['RATE_LIMIT_DIR'] = os.environ.get(
+        'RATE_LIMIT_DIR', os.path.join(app.instance_path, 'rate_limits'))
+    shared_limit_dir = app.config['RATE_LIMIT_DIR'] if app.config['WEB_WORKERS'] > 1 else None
+    
+    # 下载调度配置 - 可通过环境变量覆盖
+    app.config['DOWNLOAD_WORKERS'] = int(os.environ.get('DOWNLOAD_WORKERS', 4))
+    app.config['DOWNLOAD_QUEUE_SIZE'] = int(os.environ.get('DOWNLOAD_QUEUE_SIZE', 50))
+    # 短任务优先排序的老化速率（字节/秒），以及元数据探测线程数
+    app.config['SCHEDULER_AGING_RATE'] = int(os.environ.get('SCHEDULER_AGING_RATE', 2 * 1024 ** 2))
+    app.config['PROBE_WORKERS'] = int(os.environ.get('PROBE_WORKERS', 2))
+    
+    # 上游限流 - JSON格式，按平台/CDN主机覆盖默认值，例如
+    # PLATFORM_LIMITS='{"bilibili": {"concurrency": 2, "rate": 0.2, "burst": 2}}'
+    from .rate_limit import DEFAULT_PLATFORM_LIMITS, DEFAULT_HOST_LIMITS
+    app.config['PLATFORM_LIMITS'] = {**DEFAULT_PLATFORM_LIMITS, **json.loads(os.environ.get('PLATFORM_LIMITS', '{}'))}
+    app.config['HOST_LIMITS'] = {**DEFAULT_HOST_LIMITS, **json.loads(os.environ.get('HOST_LIMITS', '{}'))}
+    
+    # 元数据缓存配置
+    app.config['METADATA_CACHE_SIZE'] = int(os.environ.get('METADATA_CACHE_SIZE', 512))
+    app.config['METADATA_CACHE_TTL'] = int(os.environ.get('METADATA_CACHE_TTL', 600))
+    # 持久化元数据缓存 - 设为空字符串可关闭
+    app.config['METADATA_CACHE_DB'] = os.environ.get(
+        'METADATA_CACHE_DB', os.path.join(app.instance_path, 'metadata_cache.sqlite3'))
+    app.config['METADATA_CACHE_DB_TTL'] = int(os.environ.get('METADATA_CACHE_DB_TTL', 3600))
+    
+    # 下载结果缓存 - 配额为0时关闭
+    app.config['RESULT_CACHE_DIR'] = os.environ.get(
+        'RESULT_CACHE_DIR', os.path.join(app.instance_path, 'result_cache'))
+    app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+    
+    # 下载任务工作目录 - 每个任务一个子目录，保存检查点和未完成的 .part 文件，重启后断点续传
+    app.config['DOWNLOAD_WORK_DIR'] = os.environ.get(
+        'DOWNLOAD_WORK_DIR', os.path.join(app.instance_path, 'work'))
+    
+    # 下载中的 .part 文件目录 - 为空时放在任务工作目录中；可以指向tmpfs等高速盘，
+    # 与工作目录不在同一文件系统时，完成的文件通过reflink/copy_file_range落盘，否则直接重命名
+    app.config['DOWNLOAD_PART_DIR'] = os.environ.get('DOWNLOAD_PART_DIR', '')
+    
+    from .checkpoint import init_work_root, init_part_root
+    init_work_root(app.config['DOWNLOAD_WORK_DIR'])
+    init_part_root(app.config['DOWNLOAD_PART_DIR'])
+
+    # 磁盘准入控制 - 工作目录配额（0为不限，只检查剩余空间）、始终保留的剩余空间、合并余量（预留=预估大小×(1+余量)）
+    app.config['DISK_QUOTA_BYTES'] = int(os.environ.get('DISK_QUOTA_BYTES', 0))
+    app.config['DISK_MIN_FREE_BYTES'] = int(os.environ.get('DISK_MIN_FREE_BYTES', 1024 ** 3))
+    app.config['DISK_MERGE_HEADROOM'] = float(os.environ.get('DISK_MERGE_HEADROOM', 1.0))
+
+    from .disk_budget import init_disk_budget
+    init_disk_budget(app.config['DISK_QUOTA_BYTES'], app.config['DISK_MIN_FREE_BYTES'],
+                     app.config['DISK_MERGE_HEADROOM'])
+
+    # 文件交付方式 - direct(应用发送，支持时用sendfile) / x-accel(nginx) / x-sendfile(Apache/lighttpd)
+    # x-accel 需要在nginx中把下列目录配置为 internal location，JSON格式：{"目录": "内部URI前缀"}
+    app.config['FILE_DELIVERY'] = os.environ.get('FILE_DELIVERY', 'direct')
+    app.config['X_ACCEL_LOCATIONS'] = json.loads(os.environ.get('X_ACCEL_LOCATIONS', 'null')) or {
+        app.config['RESULT_CACHE_DIR']: '/_protected/cache/',
+        app.config['DOWNLOAD_WORK_DIR']: '/_protected/work/',
+    }
+    # 交给代理发送的缓存文件在此时间（秒）内不会被淘汰，应覆盖慢速客户端下载大文件所需的时间
+    app.config['OFFLOAD_LEASE_SECONDS'] = int(os.environ.get('OFFLOAD_LEASE_SECONDS', 2 * 3600))
+    
+    from .file_delivery import init_file_delivery
+    init_file_delivery(app.config['FILE_DELIVERY'], app.config['X_ACCEL_LOCATIONS'],
+                       app.config['OFFLOAD_LEASE_SECONDS'])
+    
+    # 任务存储 - memory(开发) / sqlite(单机多进程) / redis(多机)
+    app.config['JOB_STORE'] = os.environ.get('JOB_STORE', 'memory')
+    app.config['JOB_STORE_PATH'] = os.environ.get(
+        'JOB_STORE_PATH', os.path.join(app.instance_path, 'jobs.sqlite3'))
+    app.config['JOB_STORE_REDIS_URL'] = os.environ.get('JOB_STORE_REDIS_URL', 'redis://localhost:6379/0')
+    app.config['JOB_TTL'] = int(os.environ.get('JOB_TTL', 24 * 3600))
+    
+    from .job_store import init_job_store
+    init_job_store(app.config['JOB_STORE'], app.config['JOB_STORE_PATH'],
+                   app.config['JOB_STORE_REDIS_URL'], app.config['JOB_TTL'])
+    
+    from .scheduler import init_scheduler
+    init_scheduler(app.config['DOWNLOAD_WORKERS'], app.config['DOWNLOAD_QUEUE_SIZE'],
+                   app.config['PLATFORM_LIMITS'], app.config['SCHEDULER_AGING_RATE'],
+                   app.config['PROBE_WORKERS'], shared_limit_dir)
+    
+    from .rate_limit import init_host_limiter
+    init_host_limiter(app.config['HOST_LIMITS'], shared_limit_dir)
+    
+    from .cache import init_metadata_cache
+    init_metadata_cache(app.config['METADATA_CACHE_SIZE'], app.config['METADATA_CACHE_TTL'],
+                        app.config['METADATA_CACHE_DB'], app.config['METADATA_CACHE_DB_TTL'])
+    
+    from .result_cache import init_result_cache
+    init_result_cache(app.config['RESULT_CACHE_DIR'], app.config['RESULT_CACHE_MAX_BYTES'])
+    
+    # 下载进程池 - yt-dlp在子进程中运行，避免与请求处理争抢GIL；大小为0时在线程中直接执行
+    app.config['PROCESS_POOL_SIZE'] = int(os.environ.get('PROCESS_POOL_SIZE', app.config['DOWNLOAD_WORKERS'] + 2))
+    app.config['PROCESS_MAX_JOBS'] = int(os.environ.get('PROCESS_MAX_JOBS', 20))
+    app.config['PROCESS_MAX_RSS'] = int(os.environ.get('PROCESS_MAX_RSS', 512 * 1024 ** 2))
+    # 子进程连续这么久（秒）没有任何进度（进度回调或 .part 文件增长）才判定为卡死并结束，不限制下载总时长
+    app.config['PROCESS_IDLE_TIMEOUT'] = int(os.environ.get('PROCESS_IDLE_TIMEOUT', 600))
+    
+    from .process_pool import init_process_pool
+    init_process_pool(app.config['PROCESS_POOL_SIZE'], app.config['PROCESS_MAX_JOBS'],
+                      app.config['PROCESS_MAX_RSS'], app.config['PROCESS_IDLE_TIMEOUT'],
+                      cache_config={
+                          'max_entries': app.config['METADATA_CACHE_SIZE'],
+                          'ttl': app.config['METADATA_CACHE_TTL'],
+                          'db_path': app.config['METADATA_CACHE_DB'],
+                          'db_ttl': app.config['METADATA_CACHE_DB_TTL'],
+                      },
+                      part_root=app.config['DOWNLOAD_PART_DIR'] or None)
+    
     # 注册蓝图 - 这是关键！
     from . import routes
     app.register_blueprint(routes.bp)
     
+    # SSE进度推送连接的最长持续时间（秒），到期后浏览器自动重连；gthread下每个连接占用一个请求线程
+    app.config['SSE_MAX_STREAM_DURATION'] = int(os.environ.get('SSE_MAX_STREAM_DURATION', 600))
+    routes.SSE_MAX_STREAM_DURATION = app.config['SSE_MAX_STREAM_DURATION']
+    
+    # 接管上次进程退出时未完成的下载
+    routes.resume_unfinished_jobs()
+    
+    # 定期清理（秒）- 已取走/未取走的文件、失败任务、无主的工作目录分别保留多久
+    app.config['REAPER_INTERVAL'] = int(os.environ.get('REAPER_INTERVAL', 60))
+    app.config['REAP_FETCHED_AFTER'] = int(os.environ.get('REAP_FETCHED_AFTER', 300))
+    app.config['REAP_UNFETCHED_AFTER'] = int(os.environ.get('REAP_UNFETCHED_AFTER', 3600))
+    app.config['REAP_FAILED_AFTER'] = int(os.environ.get('REAP_FAILED_AFTER', 900))
+    app.config['REAP_ORPHAN_AFTER'] = int(os.environ.get('REAP_ORPHAN_AFTER', 3600))
+    
+    from .reaper import init_reaper
+    init_reaper(app.config['REAPER_INTERVAL'], app.config['REAP_FETCHED_AFTER'],
+                app.config['REAP_UNFETCHED_AFTER'], app.config['REAP_FAILED_AFTER'],
+                app.config['REAP_ORPHAN_AFTER'],
+                sync_progress=routes.sync_follower_progress,
+                forget_jobs=routes.forget_progress,
+                resume_orphans=routes.resume_unfinished_jobs)
+    
     return app
\ No newline at end of file
@@ -0,0 +1,287 @@
+"""
+视频元数据缓存 - 按规范化视频ID缓存提取结果
+同一个视频（预检测 + 下载、多个用户粘贴同一链接）只向上游提取一次
+
+两级结构：进程内LRU（微秒级） + 本地SQLite持久化存储（重启后仍然有效，同机多进程共享）
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+logger = logging.getLogger(__name__)
+
+_BV_PATTERN = re.compile(r'BV[0-9A-Za-z]{10}')
+_AV_PATTERN = re.compile(r'/av(\d+)', re.IGNORECASE)
+_YOUTUBE_ID_PATTERN = re.compile(r'^[0-9A-Za-z_-]{11}$')
+
+# 分享/统计用的查询参数，不影响指向哪个视频
+_TRACKING_PARAMS = {
+    'spm_id_from', 'from_spmid', 'vd_source', 'share_source', 'share_medium', 'share_plat',
+    'share_session_id', 'share_tag', 'share_from', 'unique_k',
+    'si', 'feature', 'fbclid', 'gclid', 'igshid', 'ref_src',
+}
+
+
+def canonical_video_id(url: str) -> Optional[str]:
+    """把各种形式的链接（移动端、分享参数、短链）归一化为平台+视频ID
+
+    已知平台的链接中找不到视频ID时返回 None：调用方不能用它缓存、合并或去重，
+    否则不同视频（如稍后再看列表中的 ?bvid=）会得到同一个键
+    """
+    url = (url or '').strip()
+    parsed = urlparse(url if '://' in url else f'https://{url}')
+    host = (parsed.hostname or '').lower()
+    query = parse_qs(parsed.query)
+
+    if 'bilibili.com' in host:
+        video_id = None
+        bv_match = _BV_PATTERN.search(parsed.path) or _BV_PATTERN.fullmatch((query.get('bvid') or [''])[0])
+        if bv_match:
+            video_id = bv_match.group()
+        else:
+            av_match = _AV_PATTERN.search(parsed.path)
+            if av_match:
+                video_id = f'av{av_match.group(1)}'
+            elif (query.get('aid') or [''])[0].isdigit():
+                video_id = f"av{query['aid'][0]}"
+        if not video_id:
+            return None
+        page = (query.get('p') or ['1'])[0]
+        return f'bilibili:{video_id}' if page in ('', '1') else f'bilibili:{video_id}:p{page}'
+
+    if host == 'b23.tv':
+        short_id = parsed.path.strip('/')
+        return f'b23:{short_id}' if short_id else None
+
+    if 'youtube.com' in host or host == 'youtu.be':
+        video_id = None
+        if host == 'youtu.be':
+            video_id = parsed.path.strip('/').split('/')[0]
+        elif query.get('v'):
+            video_id = query['v'][0]
+        else:
+            parts = parsed.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+                video_id = parts[1]
+        if video_id and _YOUTUBE_ID_PATTERN.match(video_id):
+            return f'youtube:{video_id}'
+        return None
+
+    if not host:
+        return None
+
+    # 其他平台：不知道哪个参数是视频ID，保留除分享跟踪参数外的全部查询参数（排序后与顺序无关）
+    params = sorted((name, value) for name, values in query.items() for value in values
+                    if name not in _TRACKING_PARAMS and not name.startswith('utm_'))
+    key = f"{host}{parsed.path.rstrip('/')}"
+    return f'{key}?{urlencode(params)}' if params else key
+
+
+class SQLiteMetadataStore:
+    """SQLite(WAL模式)持久化存储，值为zlib压缩的紧凑JSON
+
+    WAL模式下多个worker进程可以并发读、串行写，互不阻塞读取
+    """
+
+    def __init__(self, path: str, ttl: float = 3600):
+        self.path = path
+        self.ttl = float(ttl)
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS metadata ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_metadata_expires ON metadata (expires_at)')
+        conn.commit()
+        self.purge_expired()
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3连接不能跨线程共享，每个线程持有自己的连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _encode(value: Dict[str, Any]) -> bytes:
+        return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 6)
+
+    @staticmethod
+    def _decode(blob: bytes) -> Dict[str, Any]:
+        return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+    def get(self, key: str) -> Optional[tuple]:
+        """返回 (expires_at, value)，不存在或已过期返回 None"""
+        try:
+            row = self._connect().execute(
+                'SELECT value, expires_at FROM metadata WHERE key = ? AND expires_at > ?',
+                (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"持久化缓存读取失败: {e}")
+            return None
+
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[1], self._decode(row[0])
+
+    def set(self, key: str, value: Dict[str, Any], expires_at: float):
+        try:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO metadata (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, self._encode(value), expires_at)
+            )
+            conn.commit()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.warning(f"持久化缓存写入失败: {e}")
+
+    def invalidate(self, key: str):
+        try:
+            conn = self._connect()
+            conn.execute('DELETE FROM metadata WHERE key = ?', (key,))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"持久化缓存删除失败: {e}")
+
+    def purge_expired(self) -> int:
+        try:
+            conn = self._connect()
+            removed = conn.execute('DELETE FROM metadata WHERE expires_at <= ?', (time.time(),)).rowcount
+            conn.commit()
+            return removed
+        except sqlite3.Error as e:
+            logger.warning(f"持久化缓存清理失败: {e}")
+            return 0
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            entries = self._connect().execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+        except sqlite3.Error:
+            entries = -1
+        return {
+            'path': self.path,
+            'entries': entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class MetadataCache:
+    """带TTL和容量上限的LRU缓存，线程安全；可挂载持久化存储作为二级缓存"""
+
+    def __init__(self, max_entries: int = 512, ttl: float = 600, store: Optional[SQLiteMetadataStore] = None):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl)
+        self.store = store
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at >= time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+
+        # 内存未命中时查持久化存储，命中后回填内存
+        if self.store is not None:
+            stored = self.store.get(key)
+            if stored is not None:
+                expires_at, value = stored
+                self._put(key, value, min(expires_at, time.time() + self.ttl))
+                return value
+        return None
+
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None):
+        now = time.time()
+        self._put(key, value, now + (self.ttl if ttl is None else ttl))
+        if self.store is not None:
+            self.store.set(key, value, now + (self.store.ttl if ttl is None else ttl))
+
+    def _put(self, key: str, value: Dict[str, Any], expires_at: float):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.store is not None:
+            self.store.invalidate(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            stats = {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 3) if total else 0,
+            }
+        if self.store is not None:
+            stats['persistent'] = self.store.stats()
+        return stats
+
+
+# 全局缓存实例
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+
+
+def init_metadata_cache(max_entries: int = 512, ttl: float = 600,
+                        db_path: Optional[str] = None, db_ttl: float = 3600) -> MetadataCache:
+    global _metadata_cache
+    with _metadata_cache_lock:
+        if _metadata_cache is None:
+            store = None
+            if db_path:
+                try:
+                    store = SQLiteMetadataStore(db_path, ttl=db_ttl)
+                except (sqlite3.Error, OSError) as e:
+                    logger.warning(f"⚠️ 持久化元数据缓存不可用，仅使用内存缓存: {e}")
+            _metadata_cache = MetadataCache(max_entries=max_entries, ttl=ttl, store=store)
+            logger.info(f"🗂️ 元数据缓存已初始化: 容量 {max_entries}, TTL {ttl}秒, 持久化: {db_path if store else '无'}")
+    return _metadata_cache
+
+
+def get_metadata_cache() -> MetadataCache:
+    if _metadata_cache is None:
+        return init_metadata_cache()
+    return _metadata_cache
@@ -0,0 +1,186 @@
+"""
+下载任务检查点 - 每个任务使用固定的工作目录，记录任务参数、所选格式和下载进度
+进程异常退出（部署、OOM、崩溃）后，重启时找回未完成的任务，利用 .part 文件和 HTTP Range 断点续传
+
+工作目录上的文件锁由正在执行任务的进程持有，进程退出时由操作系统自动释放；
+能拿到锁的任务即为无人处理的孤儿任务，多个worker进程同时启动也只会有一个接管
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows：只有单进程开发服务器，不需要跨进程加锁
+    fcntl = None
+
+from .finalize import same_filesystem
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILENAME = 'job.json'
+LOCK_FILENAME = '.lock'
+# 未配置单独的 .part 目录时，下载中的文件放在任务工作目录的这个子目录中
+PART_DIRNAME = 'dl'
+
+# 进度写入检查点的最小间隔（秒）
+SAVE_INTERVAL = 5
+
+# 本进程已持有的任务目录
+_claimed_dirs = set()
+_claimed_lock = threading.Lock()
+
+
+class JobCheckpoint:
+    def __init__(self, work_dir: str):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, CHECKPOINT_FILENAME)
+        self._lock_file = None
+        self._saved_at = 0.0
+
+    @property
+    def download_id(self) -> str:
+        return os.path.basename(self.work_dir)
+
+    def claim(self) -> bool:
+        """独占任务目录，其他进程（或本进程的其他检查点对象）正在执行该任务时返回 False"""
+        # 本进程持有的目录单独记录：没有 fcntl 的平台上文件锁不生效，定期接管孤儿任务时不能把自己的任务再接管一次
+        with _claimed_lock:
+            if self.work_dir in _claimed_dirs:
+                return False
+            _claimed_dirs.add(self.work_dir)
+        try:
+            os.makedirs(self.work_dir, exist_ok=True)
+            lock_file = open(os.path.join(self.work_dir, LOCK_FILENAME), 'a')
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    lock_file = None
+        except OSError:
+            lock_file = None
+        if lock_file is None:
+            with _claimed_lock:
+                _claimed_dirs.discard(self.work_dir)
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, fields: Dict[str, Any], force: bool = True):
+        """合并写入检查点；force=False 时按 SAVE_INTERVAL 节流，用于频繁的进度更新"""
+        now = time.time()
+        if not force and now - self._saved_at < SAVE_INTERVAL:
+            return
+        self._saved_at = now
+        data = self.load() or {}
+        data.update(fields)
+        data['updated_at'] = now
+        # 先写临时文件再替换，进程中途退出也不会留下半个JSON
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ 写入任务检查点失败: {e}")
+
+    def finish(self):
+        """任务结束（完成/失败/取消）后删除检查点并释放锁，重启后不再恢复"""
+        for name in (CHECKPOINT_FILENAME, LOCK_FILENAME):
+            try:
+                os.remove(os.path.join(self.work_dir, name))
+            except OSError:
+                pass
+        self.release()
+
+    def release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+            with _claimed_lock:
+                _claimed_dirs.discard(self.work_dir)
+
+
+# 任务工作目录的根目录
+_work_root = None
+_work_root_lock = threading.Lock()
+
+
+def init_work_root(root: str) -> str:
+    global _work_root
+    with _work_root_lock:
+        if _work_root is None:
+            os.makedirs(root, exist_ok=True)
+            _work_root = root
+            logger.info(f"📂 下载工作目录: {root}")
+    return _work_root
+
+
+def get_work_root() -> str:
+    if _work_root is None:
+        import tempfile
+        return init_work_root(os.path.join(tempfile.gettempdir(), 'video_downloader_work'))
+    return _work_root
+
+
+# .part 文件的根目录 - 为 None 时放在各任务工作目录中
+# 可以放在 tmpfs 等高速盘上，每个任务一个以任务ID命名的子目录，重启后同样可以续传（tmpfs 不能跨越系统重启）
+_part_root = None
+
+
+def init_part_root(root: Optional[str]) -> Optional[str]:
+    global _part_root
+    with _work_root_lock:
+        if not root or _part_root is not None:
+            return _part_root
+        os.makedirs(root, exist_ok=True)
+        _part_root = root
+    logger.info(f"📂 下载临时文件目录: {root}")
+    # 下载子进程只需要知道目录位置，不初始化工作目录
+    if _work_root is not None and not same_filesystem(root, _work_root):
+        logger.info("💡 临时文件目录与工作目录不在同一文件系统，下载完成时需要复制文件（支持时使用reflink/copy_file_range）")
+    return _part_root
+
+
+def get_part_root() -> Optional[str]:
+    return _part_root
+
+
+def job_part_dir(work_dir: str) -> str:
+    """任务的 .part 文件目录，名称固定，任务中断后恢复时能找到上次的 .part 文件继续下载"""
+    if _part_root is not None:
+        return os.path.join(_part_root, os.path.basename(work_dir))
+    return os.path.join(work_dir, PART_DIRNAME)
+
+
+def job_checkpoint(download_id: str) -> JobCheckpoint:
+    return JobCheckpoint(os.path.join(get_work_root(), download_id))
+
+
+def claim_orphaned_jobs() -> List[JobCheckpoint]:
+    """找出并接管没有进程在执行的未完成任务，返回已加锁的检查点"""
+    root = get_work_root()
+    orphans = []
+    for name in sorted(os.listdir(root)):
+        checkpoint = JobCheckpoint(os.path.join(root, name))
+        if not os.path.exists(checkpoint.path):
+            continue
+        if not checkpoint.claim():
+            continue
+        if checkpoint.load() is None:
+            checkpoint.release()
+            continue
+        orphans.append(checkpoint)
+    return orphans
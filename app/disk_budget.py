@@ -0,0 +1,257 @@
+"""
+磁盘空间准入控制 - 下载开始前按预估的输出大小预留空间，放不下的任务等待或直接拒绝
+避免多个大文件同时下载占满磁盘，所有任务都在最后的合并阶段失败、白白浪费带宽
+
+- 预估大小：所选音视频格式的 filesize/filesize_approx 之和（见 format_planner），没有时按时长估算，
+  再乘以 (1 + 合并余量)：合并时分离的音视频文件和合并后的文件同时存在
+- 预留写入任务检查点（reserved_bytes），共享工作目录的多个worker进程看到同一份预留；
+  任务结束删除检查点即释放，进程崩溃后恢复任务时重新预留
+- 工作目录总占用按每个任务 max(预留, 已占用) 计算，受 quota 限制（0为不限）；
+  同时要求文件系统剩余空间减去各任务尚未写入的预留后，仍保留 min_free 字节
+- .part 目录（DOWNLOAD_PART_DIR）在另一个文件系统上时，下载的音视频流和合并都在那里进行，
+  预留同样计入该文件系统，两个文件系统都要放得下
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows：只有单进程开发服务器，进程内加锁即可
+    fcntl = None
+
+from .checkpoint import JobCheckpoint, get_part_root, get_work_root, job_part_dir
+from .finalize import same_filesystem
+from .scheduler import DEFAULT_JOB_COST, estimate_job_cost
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILENAME = '.disk_budget.lock'
+
+# 合并余量：预留 = 预估大小 × (1 + 余量)
+DEFAULT_MERGE_HEADROOM = 1.0
+DEFAULT_MIN_FREE_BYTES = 1024 ** 3
+
+# 工作目录扫描结果的有效期（秒）：每次 /download 和预留都完整遍历工作目录代价太高（/batch 一次可达上百次）。
+# 本进程的预留立即计入缓存；其他worker进程预留后会更新锁文件的修改时间，使各进程的缓存失效
+USAGE_CACHE_TTL = 2.0
+
+
+class InsufficientStorageError(Exception):
+    """磁盘空间不足，调用方应返回 507 并附带 Retry-After"""
+
+    def __init__(self, message: str = '服务器磁盘空间不足，请稍后再试', retry_after: int = 60):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _job_size(work_dir: str) -> Tuple[int, int]:
+    """任务占用：(工作目录, 单独配置的 .part 目录)"""
+    if get_part_root() is None:
+        return _dir_size(work_dir), 0
+    return _dir_size(work_dir), _dir_size(job_part_dir(work_dir))
+
+
+def _separate_part_root() -> Optional[str]:
+    """.part 目录与工作目录不在同一文件系统时返回其路径，需要单独检查剩余空间"""
+    part_root = get_part_root()
+    if part_root is None or same_filesystem(part_root, get_work_root()):
+        return None
+    return part_root
+
+
+class DiskBudget:
+    def __init__(self, quota_bytes: int = 0, min_free_bytes: int = DEFAULT_MIN_FREE_BYTES,
+                 merge_headroom: float = DEFAULT_MERGE_HEADROOM):
+        self.quota_bytes = int(quota_bytes)
+        self.min_free_bytes = int(min_free_bytes)
+        self.merge_headroom = float(merge_headroom)
+        self._lock = threading.Lock()
+        self._reserve_lock = threading.Lock()
+        # 任务目录 -> [工作目录占用, .part 目录占用, 预留]，以及扫描时间和当时锁文件的修改时间
+        self._scan = {}
+        self._scanned_at = 0.0
+        self._scan_stamp = None
+        self.scans = 0
+        self.admitted = 0
+        self.deferred = 0
+        self.rejected = 0
+
+    def estimate(self, info: Optional[Dict[str, Any]]) -> int:
+        """根据视频信息预估需要预留的字节数"""
+        size = estimate_job_cost(info) or DEFAULT_JOB_COST
+        return int(size * (1 + self.merge_headroom))
+
+    def _scan_usage(self) -> Dict[str, list]:
+        """各任务目录的 [工作目录占用, .part 目录占用, 预留]，USAGE_CACHE_TTL 内复用上次的扫描结果"""
+        now = time.time()
+        stamp = self._stamp()
+        if now - self._scanned_at < USAGE_CACHE_TTL and stamp == self._scan_stamp:
+            return self._scan
+        root = get_work_root()
+        scan = {}
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                continue
+            reserved = (JobCheckpoint(path).load() or {}).get('reserved_bytes', 0)
+            scan[path] = [*_job_size(path), reserved]
+        self._scan = scan
+        self._scanned_at = now
+        self._scan_stamp = stamp
+        self.scans += 1
+        return scan
+
+    def _stamp(self) -> Optional[int]:
+        try:
+            return os.stat(os.path.join(get_work_root(), LOCK_FILENAME)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _usage(self, exclude: Optional[str] = None) -> Tuple[int, int, int]:
+        """返回 (任务总占用, 工作目录所在文件系统上尚未写入的预留, .part 目录所在文件系统上尚未写入的预留)，
+        exclude 为不计入的任务目录；.part 目录与工作目录在同一文件系统时后者为0
+        """
+        separate = _separate_part_root() is not None
+        used_total = 0
+        outstanding = 0
+        part_outstanding = 0
+        for path, (used, part_used, reserved) in self._scan_usage().items():
+            if path == exclude:
+                continue
+            used_total += max(used + part_used, reserved)
+            if separate:
+                outstanding += max(reserved - used, 0)
+                part_outstanding += max(reserved - part_used, 0)
+            else:
+                outstanding += max(reserved - used - part_used, 0)
+        return used_total, outstanding, part_outstanding
+
+    def _available(self, exclude: Optional[str] = None, own_used: Tuple[int, int] = (0, 0)) -> int:
+        """还能预留的字节数；own_used 为本任务已经写入磁盘的 (工作目录, .part 目录) 字节数"""
+        used_total, outstanding, part_outstanding = self._usage(exclude)
+        part_root = _separate_part_root()
+        if part_root is None:
+            available = shutil.disk_usage(get_work_root()).free - outstanding - self.min_free_bytes + sum(own_used)
+        else:
+            available = min(
+                shutil.disk_usage(get_work_root()).free - outstanding - self.min_free_bytes + own_used[0],
+                shutil.disk_usage(part_root).free - part_outstanding - self.min_free_bytes + own_used[1])
+        if self.quota_bytes:
+            available = min(available, self.quota_bytes - used_total)
+        return available
+
+    def fits_ever(self, size: int) -> bool:
+        """任务单独运行也放不下时直接失败，不必等待"""
+        capacity = shutil.disk_usage(get_work_root()).total - self.min_free_bytes
+        part_root = _separate_part_root()
+        if part_root is not None:
+            capacity = min(capacity, shutil.disk_usage(part_root).total - self.min_free_bytes)
+        if self.quota_bytes:
+            capacity = min(capacity, self.quota_bytes)
+        return size <= capacity
+
+    def check_admission(self):
+        """提交任务时检查：已经没有可用空间时拒绝，不再让新任务排队"""
+        with self._locked():
+            if self._available() > 0:
+                return
+        with self._lock:
+            self.rejected += 1
+        raise InsufficientStorageError()
+
+    def try_reserve(self, checkpoint: JobCheckpoint, size: int) -> bool:
+        """为任务预留空间，写入检查点；放不下时返回 False。恢复的任务已下载的部分计入预留"""
+        with self._locked():
+            own_used = _job_size(checkpoint.work_dir)
+            if self._available(exclude=checkpoint.work_dir, own_used=own_used) < size:
+                with self._lock:
+                    self.deferred += 1
+                return False
+            checkpoint.save({'reserved_bytes': size})
+            # 本进程的预留立即计入缓存的扫描结果，下一次检查不必重新扫描；通知其他进程重新扫描
+            scan = self._scan_usage()
+            scan[checkpoint.work_dir] = [*own_used, size]
+            self._touch_lock_file()
+            self._scan_stamp = self._stamp()
+        with self._lock:
+            self.admitted += 1
+        return True
+
+    def _touch_lock_file(self):
+        try:
+            os.utime(os.path.join(get_work_root(), LOCK_FILENAME))
+        except OSError:
+            pass
+
+    @contextmanager
+    def _locked(self):
+        """检查和预留必须原子完成：进程内用线程锁，共享工作目录的worker进程之间用文件锁"""
+        with self._reserve_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(get_work_root(), LOCK_FILENAME), 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                yield
+
+    def stats(self) -> Dict[str, Any]:
+        with self._locked():
+            used_total, outstanding, part_outstanding = self._usage()
+        disk = shutil.disk_usage(get_work_root())
+        part_root = _separate_part_root()
+        with self._lock:
+            stats = {
+                'quota_bytes': self.quota_bytes,
+                'min_free_bytes': self.min_free_bytes,
+                'merge_headroom': self.merge_headroom,
+                'work_dir_bytes': used_total,
+                'outstanding_reserved_bytes': outstanding,
+                'disk_free_bytes': disk.free,
+                'admitted': self.admitted,
+                'deferred': self.deferred,
+                'rejected': self.rejected,
+                'scans': self.scans,
+            }
+        if part_root is not None:
+            stats['part_outstanding_reserved_bytes'] = part_outstanding
+            stats['part_disk_free_bytes'] = shutil.disk_usage(part_root).free
+        return stats
+
+
+# 全局磁盘预算
+_disk_budget = None
+_disk_budget_lock = threading.Lock()
+
+
+def init_disk_budget(quota_bytes: int = 0, min_free_bytes: int = DEFAULT_MIN_FREE_BYTES,
+                     merge_headroom: float = DEFAULT_MERGE_HEADROOM) -> DiskBudget:
+    global _disk_budget
+    with _disk_budget_lock:
+        if _disk_budget is None:
+            _disk_budget = DiskBudget(quota_bytes, min_free_bytes, merge_headroom)
+            quota = f"{quota_bytes / 1024 ** 3:.1f} GB" if quota_bytes else '不限'
+            logger.info(f"💽 磁盘准入控制: 配额 {quota}, 保留 {min_free_bytes / 1024 ** 3:.1f} GB 剩余空间")
+    return _disk_budget
+
+
+def get_disk_budget() -> DiskBudget:
+    if _disk_budget is None:
+        return init_disk_budget()
+    return _disk_budget
@@ -0,0 +1,306 @@
+"""
+文件交付 - 视频文件不经过Python逐块读写，尽快释放worker线程
+
+- x-accel: 只返回 X-Accel-Redirect 头和空响应体，由 nginx 从 internal location 直接发送文件（自带Range支持）
+- x-sendfile: 只返回 X-Sendfile 头（Apache mod_xsendfile / lighttpd），同上
+- direct: 应用自己发送；响应体是 wsgi.file_wrapper 包装的文件对象，gunicorn 等服务器会用 sendfile(2)
+  在内核中直接把文件写入socket，不支持的服务器（如开发服务器）按 DIRECT_BLOCK_SIZE 大块读取
+
+x-accel 模式需要把文件所在目录映射为 nginx 的内部URI前缀，默认映射结果缓存目录和任务工作目录:
+
+    location /_protected/cache/ { internal; alias /srv/app/instance/result_cache/; }
+    location /_protected/work/  { internal; alias /srv/app/instance/work/; }
+
+不在映射目录下的文件自动退回 direct 模式。代理何时发送完毕应用无从得知，
+交给代理的缓存文件按 offload_lease 秒的租约保护，期间不会被淘汰（见 result_cache.py）
+"""
+
+import io
+import logging
+import os
+import re
+import secrets
+import threading
+import unicodedata
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from werkzeug.http import is_resource_modified, parse_date
+from werkzeug.wsgi import wrap_file
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_MODES = ('direct', 'x-accel', 'x-sendfile')
+
+# 交给代理发送的文件的默认保护时长（秒），应覆盖慢速客户端下载大文件所需的时间
+DEFAULT_OFFLOAD_LEASE = 2 * 3600
+
+# 服务器不支持 sendfile 时每次读取的块大小
+DIRECT_BLOCK_SIZE = 1024 * 1024
+
+# 合并后超过该数量的多区间请求按完整文件响应
+MAX_RANGES = 32
+
+_RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class _ReleasingFile(io.FileIO):
+    """关闭时执行回调的文件对象 - 服务器发送完毕（或连接中断）关闭响应体时释放缓存引用
+
+    指定 start/length 时只能读到该区间：gunicorn 按当前偏移和 Content-Length 调用 sendfile，
+    其他服务器逐块 read() 也不会读出区间之外的数据
+    """
+
+    def __init__(self, path: str, on_close: Optional[Callable[[], None]] = None,
+                 start: int = 0, length: Optional[int] = None):
+        super().__init__(path, 'rb')
+        self._on_close = on_close
+        self._remaining = length
+        if start:
+            self.seek(start)
+
+    def read(self, size: int = -1) -> bytes:
+        if self._remaining is None:
+            return super().read(size)
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = super().read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+
+
+def content_disposition(disposition: str, filename: str, fallback: Optional[str] = None) -> str:
+    """Content-Disposition 头：filename 为ASCII备用名（响应头只能是latin-1），filename* 为UTF-8原名（RFC 6266）"""
+    if fallback is None:
+        stem, ext = os.path.splitext(filename)
+        stem = unicodedata.normalize('NFKD', stem).encode('ascii', 'ignore').decode('ascii')
+        stem = re.sub(r'[\x00-\x1f"\\]', '', stem).strip() or 'video'
+        fallback = stem + ext.encode('ascii', 'ignore').decode('ascii')
+    return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def _file_etag(stat: os.stat_result) -> str:
+    """强校验ETag：文件被替换（inode/修改时间/大小变化）后 If-Range 不再匹配"""
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def _if_range_matches(if_range: str, etag: str, mtime: float) -> bool:
+    """If-Range 只接受强校验：ETag 需完全相同，日期需与文件修改时间（秒）一致"""
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    date = parse_date(if_range)
+    return date is not None and int(date.timestamp()) == int(mtime)
+
+
+def _resolve_ranges(range_header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """把 Range 头解析为按顺序合并后的 [start, stop) 区间列表
+
+    无法解析或不支持时返回 None（按RFC 7233忽略Range，发送完整文件）；没有可满足的区间时返回空列表（416）
+    """
+    units, _, specs = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        match = _RANGE_SPEC.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if first:
+            # bytes=N- 或 bytes=N-M（M超出文件时截到末尾）
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            stop = min(int(last) + 1, size) if last else size
+        elif last:
+            # bytes=-N：最后N个字节
+            start, stop = max(size - int(last), 0), size
+        else:
+            return None
+        if start < stop:
+            ranges.append((start, stop))
+
+    # 重叠或相邻的区间合并为一个，避免客户端用大量碎片区间放大服务器开销
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+class FileDelivery:
+    def __init__(self, mode: str = 'direct', accel_locations: Optional[Dict[str, str]] = None,
+                 offload_lease: float = DEFAULT_OFFLOAD_LEASE):
+        if mode not in DELIVERY_MODES:
+            raise ValueError(f'不支持的文件交付方式: {mode}，可选 {", ".join(DELIVERY_MODES)}')
+        self.mode = mode
+        self.offload_lease = offload_lease
+        # 目录（绝对路径，末尾带分隔符） -> 内部URI前缀（末尾带 /），长路径优先匹配
+        self.accel_locations = sorted(
+            ((os.path.join(os.path.realpath(root), ''), prefix.rstrip('/') + '/')
+             for root, prefix in (accel_locations or {}).items()),
+            key=lambda item: len(item[0]), reverse=True)
+
+    def offload_header(self, path: str) -> Optional[Tuple[str, str]]:
+        """交给前端代理发送文件所需的响应头，当前模式或文件位置不支持时返回 None"""
+        if self.mode == 'x-sendfile':
+            # WSGI响应头只能是latin-1字符串，中文路径按PEP 3333的约定以UTF-8原始字节传给服务器
+            return 'X-Sendfile', os.fsencode(os.path.realpath(path)).decode('latin-1')
+        if self.mode == 'x-accel':
+            real_path = os.path.realpath(path)
+            for root, prefix in self.accel_locations:
+                if real_path.startswith(root):
+                    relative = os.path.relpath(real_path, root).replace(os.sep, '/')
+                    return 'X-Accel-Redirect', prefix + quote(relative)
+        return None
+
+    def open(self, path: str, on_close: Optional[Callable[[], None]] = None,
+             start: int = 0, length: Optional[int] = None) -> io.FileIO:
+        return _ReleasingFile(path, on_close, start, length)
+
+    def send(self, path: str, environ: dict, response_class, headers: Dict[str, str],
+             on_close: Optional[Callable[[], None]] = None,
+             on_offload: Optional[Callable[[float], None]] = None):
+        """生成文件响应，headers 为各设备分支决定的 Content-Type/Content-Disposition/缓存头
+
+        Content-Length、Accept-Ranges、ETag/Last-Modified 以及 Range/If-Range 由这里统一处理，
+        完整文件(200)、单区间(206)、多区间(206 multipart/byteranges)、无法满足(416)的响应头保持一致。
+        on_close 在不再需要该文件时调用：交给代理发送或不需要响应体时立即调用，
+        否则在服务器关闭响应体（发送完毕或连接中断）时调用。
+        交给代理发送时先以 offload_lease 调用 on_offload，由调用方在代理发送期间继续保护文件
+        """
+        header = self.offload_header(path)
+        if header is not None:
+            # 代理自己处理Range和条件请求，响应体为空
+            response = response_class(b'', headers=headers)
+            response.headers[header[0]] = header[1]
+            response.headers['Content-Length'] = '0'
+            if on_offload is not None:
+                on_offload(self.offload_lease)
+            if on_close is not None:
+                on_close()
+            return response
+
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = _file_etag(stat)
+        content_type = headers.get('Content-Type', 'application/octet-stream')
+        response = response_class(headers=headers)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['ETag'] = etag
+        response.last_modified = stat.st_mtime
+
+        if not is_resource_modified(environ, etag=etag, last_modified=response.last_modified,
+                                    ignore_if_range=True):
+            response.status_code = 304
+            response.headers.pop('Content-Length', None)
+            if on_close is not None:
+                on_close()
+            return response
+
+        # HEAD请求只需要响应头，不打开文件
+        head_only = environ.get('REQUEST_METHOD') == 'HEAD'
+        if head_only and on_close is not None:
+            on_close()
+
+        ranges = None
+        range_header = environ.get('HTTP_RANGE')
+        if range_header:
+            if_range = environ.get('HTTP_IF_RANGE')
+            if not if_range or _if_range_matches(if_range, etag, stat.st_mtime):
+                ranges = _resolve_ranges(range_header, size)
+
+        if ranges is not None and not ranges:
+            response.status_code = 416
+            response.headers['Content-Range'] = f'bytes */{size}'
+            response.headers['Content-Length'] = '0'
+            if on_close is not None and not head_only:
+                on_close()
+            return response
+
+        if ranges is None or len(ranges) == 1:
+            start, stop = ranges[0] if ranges else (0, size)
+            if ranges:
+                response.status_code = 206
+                response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+            response.headers['Content-Length'] = str(stop - start)
+            if head_only:
+                return response
+            file = self.open(path, on_close, start, stop - start)
+            # direct_passthrough：原样把 file_wrapper 交给服务器，服务器才能识别并使用 sendfile
+            response.response = wrap_file(environ, file, DIRECT_BLOCK_SIZE)
+            response.direct_passthrough = True
+            return response
+
+        # 多区间：multipart/byteranges，每段带自己的 Content-Type 和 Content-Range
+        boundary = secrets.token_hex(16)
+        parts = [(f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                  f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode('latin-1')
+                 for start, stop in ranges]
+        closing = f'--{boundary}--\r\n'.encode('latin-1')
+        length = sum(len(part) + stop - start + 2 for part, (start, stop) in zip(parts, ranges)) + len(closing)
+        response.status_code = 206
+        response.headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+        response.headers['Content-Length'] = str(length)
+        if head_only:
+            return response
+        file = self.open(path, on_close)
+
+        def generate():
+            for part, (start, stop) in zip(parts, ranges):
+                yield part
+                file.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = file.read(min(DIRECT_BLOCK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError(f'文件大小发生变化: {path}')
+                    remaining -= len(chunk)
+                    yield chunk
+                yield b'\r\n'
+            yield closing
+
+        response.response = generate()
+        response.call_on_close(file.close)
+        return response
+
+    @staticmethod
+    def is_offloaded(response) -> bool:
+        return 'X-Accel-Redirect' in response.headers or 'X-Sendfile' in response.headers
+
+
+# 全局文件交付配置
+_file_delivery = None
+_file_delivery_lock = threading.Lock()
+
+
+def init_file_delivery(mode: str = 'direct', accel_locations: Optional[Dict[str, str]] = None,
+                       offload_lease: float = DEFAULT_OFFLOAD_LEASE) -> FileDelivery:
+    global _file_delivery
+    with _file_delivery_lock:
+        if _file_delivery is None:
+            _file_delivery = FileDelivery(mode, accel_locations, offload_lease)
+            logger.info(f"📤 文件交付方式: {mode}")
+    return _file_delivery
+
+
+def get_file_delivery() -> FileDelivery:
+    if _file_delivery is None:
+        return init_file_delivery()
+    return _file_delivery
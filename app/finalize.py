@@ -0,0 +1,126 @@
+"""
+文件落盘 - 下载完成的文件从 .part 目录移到任务目录、再移入结果缓存，这一步不应随文件大小变慢
+
+shutil.move 在跨文件系统时会退化为完整复制（用户态逐块读写）。这里按代价从低到高依次尝试:
+
+1. os.replace：同一文件系统内原子重命名，只修改目录项
+2. reflink（FICLONE）：同一文件系统的不同挂载点/子卷之间 rename 返回 EXDEV，但 btrfs/XFS 等可以共享数据块
+3. copy_file_range：数据在内核中复制，不经过用户态缓冲；NFS等可以在服务端完成
+4. shutil.copyfile：最后的兜底（Linux上内部使用 sendfile）
+
+后三种先写入目标目录中的临时文件，fsync 后再 os.replace，读者要么看不到、要么看到完整文件；
+成功后才删除源文件，中途失败时源文件保持不变
+"""
+
+import errno
+import logging
+import os
+import shutil
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows：没有 reflink，跨盘时直接复制
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# copy_file_range 单次调用的最大字节数
+COPY_CHUNK_SIZE = 1024 ** 3
+
+# 这些错误表示当前方式在这两个位置之间不可用，换下一种方式
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP,
+                       errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+
+def same_filesystem(path_a: str, path_b: str) -> bool:
+    """两个已存在的路径是否在同一文件系统上（os.replace 可以直接重命名）"""
+    try:
+        return os.stat(path_a).st_dev == os.stat(path_b).st_dev
+    except OSError:
+        return False
+
+
+def _reflink(src_fd: int, dst_fd: int) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in _UNSUPPORTED_ERRNOS:
+            return False
+        raise
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, size: int) -> bool:
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    while copied < size:
+        try:
+            count = os.copy_file_range(src_fd, dst_fd, min(size - copied, COPY_CHUNK_SIZE))
+        except OSError as e:
+            # 一个字节都还没复制时才能安全地换成其他方式
+            if copied == 0 and e.errno in _UNSUPPORTED_ERRNOS:
+                return False
+            raise
+        if count == 0:
+            if copied == 0:
+                return False
+            raise IOError(f'复制中途文件变短: 已复制 {copied}/{size} 字节')
+        copied += count
+    return True
+
+
+def finalize_file(src_path: str, dest_path: str) -> str:
+    """把 src_path 移到 dest_path（已存在时替换），返回所用的方式: rename / reflink / copy_file_range / copy"""
+    started = time.time()
+    try:
+        os.replace(src_path, dest_path)
+        method = 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        method = _copy_across(src_path, dest_path)
+        os.remove(src_path)
+
+    elapsed = time.time() - started
+    if method == 'rename':
+        logger.debug(f"📥 文件落盘(rename): {os.path.basename(dest_path)}")
+    else:
+        size = os.path.getsize(dest_path)
+        logger.info(f"📥 文件落盘({method}): {os.path.basename(dest_path)} "
+                    f"({size / 1024 / 1024:.1f} MB, {elapsed:.2f}秒)")
+    return method
+
+
+def _copy_across(src_path: str, dest_path: str) -> str:
+    """跨设备复制到目标目录中的临时文件，再原子替换为 dest_path"""
+    tmp_path = os.path.join(os.path.dirname(dest_path), f'.{os.path.basename(dest_path)}.{os.getpid()}.tmp')
+    try:
+        with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            if _reflink(src.fileno(), dst.fileno()):
+                method = 'reflink'
+            elif _copy_file_range(src.fileno(), dst.fileno(), size):
+                method = 'copy_file_range'
+            else:
+                method = 'copy'
+        if method == 'copy':
+            shutil.copyfile(src_path, tmp_path)
+        shutil.copystat(src_path, tmp_path)
+        # 先落盘再替换：替换后源文件就会被删除，进程/系统崩溃不能丢掉已下载的数据
+        with open(tmp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return method
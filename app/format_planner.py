@@ -0,0 +1,115 @@
+"""
+格式规划器 - 基于一次提取得到的formats列表在本地选出最佳音视频组合
+避免盲目地按固定顺序尝试多个下载策略（每次失败都要重新提取+建立连接）
+"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 画质策略：允许的最高分辨率/帧率，各设备类型相同
+QUALITY_POLICY = {'max_height': 1080, 'max_fps': 60}
+
+# 编码偏好（数值越大越优先），各设备类型相同：H.264兼容性和硬解支持最好（移动端和未装HEVC扩展的桌面播放器），
+# 其次HEVC，AV1/VP9最后
+VIDEO_CODEC_RANK = {'avc': 3, 'hev': 2, 'hvc': 2, 'av01': 1, 'vp9': 1, 'vp09': 1}
+
+AUDIO_CODEC_RANK = {'mp4a': 3, 'aac': 3, 'opus': 1, 'vorbis': 1}
+
+
+def _codec_rank(codec: Optional[str], ranks: Dict[str, int]) -> int:
+    codec = (codec or '').lower()
+    for prefix, rank in ranks.items():
+        if codec.startswith(prefix):
+            return rank
+    return 0
+
+
+def _has_video(fmt: Dict[str, Any]) -> bool:
+    vcodec = fmt.get('vcodec')
+    if vcodec == 'none':
+        return False
+    return bool(vcodec) or bool(fmt.get('height'))
+
+
+def _has_audio(fmt: Dict[str, Any]) -> bool:
+    acodec = fmt.get('acodec')
+    if acodec == 'none':
+        return False
+    # acodec未知时只有在有音频码率信息时才认为带音频
+    return bool(acodec) or bool(fmt.get('abr'))
+
+
+def _estimated_size(*fmts: Dict[str, Any]) -> int:
+    """各格式预估大小之和；任一格式大小未知时返回0（未知），不用偏小的值误导排序和磁盘预留"""
+    sizes = [int(fmt.get('filesize') or fmt.get('filesize_approx') or 0) for fmt in fmts]
+    return sum(sizes) if all(sizes) else 0
+
+
+def _video_score(fmt: Dict[str, Any]) -> tuple:
+    return (
+        fmt.get('height') or 0,
+        _codec_rank(fmt.get('vcodec'), VIDEO_CODEC_RANK),
+        fmt.get('fps') or 0,
+        fmt.get('tbr') or fmt.get('vbr') or 0,
+    )
+
+
+def _audio_score(fmt: Dict[str, Any]) -> tuple:
+    return (
+        _codec_rank(fmt.get('acodec'), AUDIO_CODEC_RANK),
+        fmt.get('abr') or fmt.get('tbr') or 0,
+    )
+
+
+def plan_format(formats: Optional[List[Dict[str, Any]]], device_type: str = 'desktop') -> Optional[Dict[str, Any]]:
+    """从formats中选出最佳的视频+音频组合，device_type 只用于日志（各设备的画质策略和编码偏好相同）
+
+    返回 {'format': 'vid+aid', 'height': ..., 'filesize': ..., 'description': ...}，filesize 为0表示未知；
+    没有带音频的组合（只有纯视频或纯音频流）时返回 None，由调用方退回到按策略尝试下载
+    """
+    if not formats:
+        return None
+
+    def within_policy(fmt):
+        if not fmt.get('format_id') or not fmt.get('url'):
+            return False
+        height = fmt.get('height') or 0
+        fps = fmt.get('fps') or 0
+        return height <= QUALITY_POLICY['max_height'] and fps <= QUALITY_POLICY['max_fps']
+
+    candidates = [fmt for fmt in formats if within_policy(fmt)]
+    video_only = [fmt for fmt in candidates if _has_video(fmt) and not _has_audio(fmt)]
+    audio_only = [fmt for fmt in candidates if _has_audio(fmt) and not _has_video(fmt)]
+    combined = [fmt for fmt in candidates if _has_video(fmt) and _has_audio(fmt)]
+
+    best_pair = None
+    if video_only and audio_only:
+        video = max(video_only, key=_video_score)
+        audio = max(audio_only, key=_audio_score)
+        best_pair = (video, audio)
+
+    best_combined = max(combined, key=_video_score) if combined else None
+
+    # 合并流画质不低于分离流时直接使用合并流，省去一次音频下载和合并
+    if best_combined and (not best_pair or (best_combined.get('height') or 0) >= (best_pair[0].get('height') or 0)):
+        plan = {
+            'format': best_combined['format_id'],
+            'height': best_combined.get('height') or 0,
+            'filesize': _estimated_size(best_combined),
+            'description': f"{best_combined.get('height') or '?'}p {best_combined.get('vcodec') or ''}".strip(),
+        }
+    elif best_pair:
+        video, audio = best_pair
+        plan = {
+            'format': f"{video['format_id']}+{audio['format_id']}",
+            'height': video.get('height') or 0,
+            'filesize': _estimated_size(video, audio),
+            'description': f"{video.get('height') or '?'}p {video.get('vcodec') or ''} + {audio.get('acodec') or ''}".strip(),
+        }
+    else:
+        return None
+
+    logger.info(f"🧠 格式规划结果({device_type}): {plan['format']} - {plan['description']}")
+    return plan
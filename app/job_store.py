@@ -0,0 +1,473 @@
+"""
+下载任务存储 - 替代进程内的 download_progress 字典
+可插拔后端：
+  memory  进程内字典，开发环境使用
+  sqlite  SQLite(WAL)，单机多worker进程共享
+  redis   Redis协议，多机部署共享（需要安装 redis 包）
+所有后端都支持单任务原子更新、TTL过期和按状态索引查询，
+另提供按键的原子占用（claim），用于在多个worker进程之间选出同一视频唯一的下载主任务
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_TTL = 24 * 3600
+
+
+def _merge(data: Dict[str, Any], fields: Dict[str, Any], remove: Iterable[str]):
+    data.update(fields)
+    for key in remove:
+        data.pop(key, None)
+    data['seq'] = data.get('seq', 0) + 1
+
+
+class JobStore:
+    """任务存储接口，记录为可JSON序列化的字典"""
+
+    # 是否在多个进程之间共享（共享存储的变更不会触发本进程的通知，需要定期检查）
+    shared = False
+
+    def __init__(self, ttl: float = DEFAULT_JOB_TTL):
+        self.ttl = float(ttl)
+
+    def create(self, job_id: str, data: Dict[str, Any]):
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def update(self, job_id: str, fields: Dict[str, Any], remove: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+        """原子地合并字段并删除指定字段，返回更新后的记录；任务不存在时返回 None
+
+        每次更新递增记录中的 seq 字段，所有进程看到的都是同一个版本号（SSE的事件ID）
+        """
+        raise NotImplementedError
+
+    def delete(self, job_id: str):
+        raise NotImplementedError
+
+    def find_by_status(self, *statuses: str) -> List[Tuple[str, Dict[str, Any]]]:
+        raise NotImplementedError
+
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        raise NotImplementedError
+
+    def purge_expired(self) -> int:
+        return 0
+
+    def claim(self, key: str, owner: str, replace: Optional[str] = None) -> str:
+        """原子地占用 key：未被占用、或当前占用者为 replace 时改为 owner，返回操作后的占用者
+
+        占用记录与任务记录分开保存（同样按TTL过期），不出现在 items/find_by_status 中
+        """
+        raise NotImplementedError
+
+    def release_claim(self, key: str, owner: str):
+        """仍由 owner 占用时释放 key；已被其他任务接替时不做任何事"""
+        raise NotImplementedError
+
+    def exists(self, job_id: str) -> bool:
+        return self.get(job_id) is not None
+
+    def __contains__(self, job_id: str) -> bool:
+        return self.exists(job_id)
+
+
+class MemoryJobStore(JobStore):
+    def __init__(self, ttl: float = DEFAULT_JOB_TTL):
+        super().__init__(ttl)
+        self._jobs: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._claims: Dict[str, Tuple[float, str]] = {}
+        self._lock = threading.RLock()
+
+    def _live(self, job_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._jobs.get(job_id)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self._jobs[job_id]
+            return None
+        return entry[1]
+
+    def create(self, job_id: str, data: Dict[str, Any]):
+        with self._lock:
+            self._jobs[job_id] = (time.time() + self.ttl, dict(data))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            data = self._live(job_id)
+            return dict(data) if data is not None else None
+
+    def update(self, job_id: str, fields: Dict[str, Any], remove: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            data = self._live(job_id)
+            if data is None:
+                return None
+            _merge(data, fields, remove)
+            self._jobs[job_id] = (time.time() + self.ttl, data)
+            return dict(data)
+
+    def delete(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def find_by_status(self, *statuses: str) -> List[Tuple[str, Dict[str, Any]]]:
+        return [(job_id, data) for job_id, data in self.items() if data.get('status') in statuses]
+
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            result = []
+            for job_id in list(self._jobs):
+                data = self._live(job_id)
+                if data is not None:
+                    result.append((job_id, dict(data)))
+            return result
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            now = time.time()
+            expired = [job_id for job_id, (expires_at, _) in self._jobs.items() if expires_at < now]
+            for job_id in expired:
+                del self._jobs[job_id]
+            for key in [key for key, (expires_at, _) in self._claims.items() if expires_at < now]:
+                del self._claims[key]
+            return len(expired)
+
+    def claim(self, key: str, owner: str, replace: Optional[str] = None) -> str:
+        with self._lock:
+            entry = self._claims.get(key)
+            current = entry[1] if entry is not None and entry[0] >= time.time() else None
+            if current is None or current == replace:
+                self._claims[key] = (time.time() + self.ttl, owner)
+                return owner
+            return current
+
+    def release_claim(self, key: str, owner: str):
+        with self._lock:
+            entry = self._claims.get(key)
+            if entry is not None and entry[1] == owner:
+                del self._claims[key]
+
+
+class SQLiteJobStore(JobStore):
+    """SQLite(WAL)后端：status单独成列并建索引，更新在 BEGIN IMMEDIATE 事务中完成"""
+
+    shared = True
+
+    def __init__(self, path: str, ttl: float = DEFAULT_JOB_TTL):
+        super().__init__(ttl)
+        self.path = path
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, status TEXT NOT NULL, data TEXT NOT NULL, '
+            'updated_at REAL NOT NULL, expires_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs (expires_at)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS claims ('
+            'key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self.purge_expired()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None：手动控制事务
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _write(self, conn: sqlite3.Connection, job_id: str, data: Dict[str, Any]):
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO jobs (id, status, data, updated_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+            (job_id, data.get('status', ''), json.dumps(data, ensure_ascii=False), now, now + self.ttl)
+        )
+
+    def create(self, job_id: str, data: Dict[str, Any]):
+        self._write(self._connect(), job_id, data)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            'SELECT data FROM jobs WHERE id = ? AND expires_at > ?', (job_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id: str, fields: Dict[str, Any], remove: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT data FROM jobs WHERE id = ? AND expires_at > ?', (job_id, time.time())
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            data = json.loads(row[0])
+            _merge(data, fields, remove)
+            self._write(conn, job_id, data)
+            conn.execute('COMMIT')
+            return data
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete(self, job_id: str):
+        self._connect().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def find_by_status(self, *statuses: str) -> List[Tuple[str, Dict[str, Any]]]:
+        if not statuses:
+            return []
+        placeholders = ','.join('?' * len(statuses))
+        rows = self._connect().execute(
+            f'SELECT id, data FROM jobs WHERE status IN ({placeholders}) AND expires_at > ?',
+            (*statuses, time.time())
+        ).fetchall()
+        return [(job_id, json.loads(data)) for job_id, data in rows]
+
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        rows = self._connect().execute(
+            'SELECT id, data FROM jobs WHERE expires_at > ?', (time.time(),)
+        ).fetchall()
+        return [(job_id, json.loads(data)) for job_id, data in rows]
+
+    def purge_expired(self) -> int:
+        conn = self._connect()
+        now = time.time()
+        conn.execute('DELETE FROM claims WHERE expires_at <= ?', (now,))
+        return conn.execute('DELETE FROM jobs WHERE expires_at <= ?', (now,)).rowcount
+
+    def claim(self, key: str, owner: str, replace: Optional[str] = None) -> str:
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute(
+                'SELECT owner FROM claims WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            if row is None or row[0] == replace:
+                conn.execute('INSERT OR REPLACE INTO claims (key, owner, expires_at) VALUES (?, ?, ?)',
+                             (key, owner, now + self.ttl))
+                current = owner
+            else:
+                current = row[0]
+            conn.execute('COMMIT')
+            return current
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release_claim(self, key: str, owner: str):
+        self._connect().execute('DELETE FROM claims WHERE key = ? AND owner = ?', (key, owner))
+
+
+class RedisJobStore(JobStore):
+    """Redis协议后端：每个任务一个带过期时间的JSON键，另以集合维护状态索引
+
+    更新使用 WATCH/MULTI/EXEC 乐观事务保证单任务原子性；
+    client 可以传入任何兼容 redis-py 接口的客户端（如本地测试用的替身实现）
+    """
+
+    shared = True
+
+    def __init__(self, url: Optional[str] = None, ttl: float = DEFAULT_JOB_TTL, prefix: str = 'vd', client=None):
+        super().__init__(ttl)
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError('使用Redis任务存储需要安装 redis 包: pip install redis')
+            client = redis.Redis.from_url(url or 'redis://localhost:6379/0')
+        self.client = client
+        self.prefix = prefix
+
+    def _job_key(self, job_id: str) -> str:
+        return f'{self.prefix}:job:{job_id}'
+
+    def _status_key(self, status: str) -> str:
+        return f'{self.prefix}:status:{status}'
+
+    def _claim_key(self, key: str) -> str:
+        return f'{self.prefix}:claim:{key}'
+
+    def _decode(self, raw) -> Optional[Dict[str, Any]]:
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        return json.loads(raw)
+
+    def create(self, job_id: str, data: Dict[str, Any]):
+        pipe = self.client.pipeline()
+        pipe.set(self._job_key(job_id), json.dumps(data, ensure_ascii=False), ex=int(self.ttl))
+        pipe.sadd(self._status_key(data.get('status', '')), job_id)
+        pipe.execute()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._decode(self.client.get(self._job_key(job_id)))
+
+    def update(self, job_id: str, fields: Dict[str, Any], remove: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+        key = self._job_key(job_id)
+        while True:
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(key)
+                    data = self._decode(pipe.get(key))
+                    if data is None:
+                        pipe.unwatch()
+                        return None
+                    old_status = data.get('status', '')
+                    _merge(data, fields, remove)
+                    new_status = data.get('status', '')
+
+                    pipe.multi()
+                    pipe.set(key, json.dumps(data, ensure_ascii=False), ex=int(self.ttl))
+                    if new_status != old_status:
+                        pipe.srem(self._status_key(old_status), job_id)
+                        pipe.sadd(self._status_key(new_status), job_id)
+                    pipe.execute()
+                    return data
+                except Exception as e:
+                    if not _is_watch_error(e):
+                        raise
+                    # 其他进程同时修改了该任务，重试
+                    continue
+
+    def delete(self, job_id: str):
+        data = self.get(job_id)
+        pipe = self.client.pipeline()
+        pipe.delete(self._job_key(job_id))
+        if data is not None:
+            pipe.srem(self._status_key(data.get('status', '')), job_id)
+        pipe.execute()
+
+    def find_by_status(self, *statuses: str) -> List[Tuple[str, Dict[str, Any]]]:
+        result = []
+        for status in statuses:
+            for raw_id in self.client.smembers(self._status_key(status)):
+                job_id = raw_id.decode('utf-8') if isinstance(raw_id, bytes) else raw_id
+                data = self.get(job_id)
+                if data is None:
+                    # 任务键已过期，顺便清理索引
+                    self.client.srem(self._status_key(status), job_id)
+                elif data.get('status') == status:
+                    result.append((job_id, data))
+        return result
+
+    def purge_expired(self) -> int:
+        """任务键由Redis自动过期，这里清理状态索引中已过期任务的ID，返回清理的数量"""
+        removed = 0
+        for raw_key in self.client.scan_iter(match=self._status_key('*')):
+            status_key = raw_key.decode('utf-8') if isinstance(raw_key, bytes) else raw_key
+            for raw_id in self.client.smembers(status_key):
+                job_id = raw_id.decode('utf-8') if isinstance(raw_id, bytes) else raw_id
+                if not self.client.exists(self._job_key(job_id)):
+                    removed += self.client.srem(status_key, job_id)
+        return removed
+
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        result = []
+        prefix = self._job_key('')
+        for raw_key in self.client.scan_iter(match=f'{prefix}*'):
+            key = raw_key.decode('utf-8') if isinstance(raw_key, bytes) else raw_key
+            data = self.get(key[len(prefix):])
+            if data is not None:
+                result.append((key[len(prefix):], data))
+        return result
+
+    def claim(self, key: str, owner: str, replace: Optional[str] = None) -> str:
+        claim_key = self._claim_key(key)
+        while True:
+            # 未被占用：SET NX 一步完成
+            if self.client.set(claim_key, owner, nx=True, ex=int(self.ttl)):
+                return owner
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(claim_key)
+                    current = pipe.get(claim_key)
+                    if current is None:
+                        # 占用刚好过期或被释放，重新尝试 SET NX
+                        pipe.unwatch()
+                        continue
+                    current = current.decode('utf-8') if isinstance(current, bytes) else current
+                    if current != replace:
+                        pipe.unwatch()
+                        return current
+                    pipe.multi()
+                    pipe.set(claim_key, owner, ex=int(self.ttl))
+                    pipe.execute()
+                    return owner
+                except Exception as e:
+                    if not _is_watch_error(e):
+                        raise
+                    continue
+
+    def release_claim(self, key: str, owner: str):
+        claim_key = self._claim_key(key)
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(claim_key)
+                current = pipe.get(claim_key)
+                current = current.decode('utf-8') if isinstance(current, bytes) else current
+                if current != owner:
+                    pipe.unwatch()
+                    return
+                pipe.multi()
+                pipe.delete(claim_key)
+                pipe.execute()
+            except Exception as e:
+                # 释放的同时已被其他任务接替：保留新的占用
+                if not _is_watch_error(e):
+                    raise
+
+
+def _is_watch_error(error: Exception) -> bool:
+    """WATCH的键被修改导致事务放弃；按类名判断，兼容 redis-py 以及其他兼容客户端各自定义的 WatchError"""
+    return any(cls.__name__ == 'WatchError' for cls in type(error).__mro__)
+
+
+def create_job_store(backend: str = 'memory', path: Optional[str] = None, redis_url: Optional[str] = None,
+                     ttl: float = DEFAULT_JOB_TTL) -> JobStore:
+    backend = (backend or 'memory').lower()
+    if backend == 'sqlite':
+        return SQLiteJobStore(path or 'jobs.sqlite3', ttl=ttl)
+    if backend == 'redis':
+        return RedisJobStore(redis_url, ttl=ttl)
+    return MemoryJobStore(ttl=ttl)
+
+
+# 全局任务存储实例
+_job_store = None
+_job_store_lock = threading.Lock()
+
+
+def init_job_store(backend: str = 'memory', path: Optional[str] = None, redis_url: Optional[str] = None,
+                   ttl: float = DEFAULT_JOB_TTL) -> JobStore:
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            _job_store = create_job_store(backend, path, redis_url, ttl)
+            logger.info(f"🗃️ 任务存储已初始化: {type(_job_store).__name__} (TTL {ttl}秒)")
+    return _job_store
+
+
+def get_job_store() -> JobStore:
+    if _job_store is None:
+        return init_job_store()
+    return _job_store
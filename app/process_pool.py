@@ -0,0 +1,476 @@
+"""
+下载进程池 - yt-dlp 的信息提取和下载在独立的子进程中执行
+提取过程（JSON解析、签名JS解释、格式排序）是纯Python的CPU密集操作，放在Flask进程的线程里会和请求处理争抢GIL；
+超大的 info_dict 占用的内存也无法归还给操作系统。子进程执行完一定数量的任务或内存超限后自动回收重建
+
+- 进度通过管道回传给主进程
+- 取消时通知子进程中止，超时未响应则连同ffmpeg一起强制结束
+- 子进程长时间没有任何进度（卡死）时强制结束；仍在下载的任务不限制总时长
+- 完整的 info_dict 只保存在子进程的元数据缓存中，不经过管道传输
+- CDN主机限流名额由主进程统一分配，所有子进程共享同一套限制
+"""
+
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+from .cache import canonical_video_id
+from .checkpoint import init_part_root, job_part_dir
+from .rate_limit import get_host_limiter, set_host_limiter
+from . import video_downloader
+from .video_downloader import DownloadCancelledError, DownloadFailedError
+
+logger = logging.getLogger(__name__)
+
+# 取消后等待子进程自行退出当前任务的时间，超过则强制结束
+CANCEL_GRACE_PERIOD = 10
+
+# 子进程检查 .part 目录是否在增长的间隔（秒）：没有进度回调的阶段（大小未知的下载、ffmpeg合并）
+# 文件仍在增长时发送心跳，不会被判定为卡死
+ACTIVITY_CHECK_INTERVAL = 10
+
+# Windows 没有进程组（os.setpgrp/os.killpg），只能结束子进程本身，ffmpeg 由其退出时自行结束
+HAS_PROCESS_GROUPS = hasattr(os, 'setpgrp') and hasattr(os, 'killpg')
+
+# 子进程都忙时按优先级分配：元数据探测（预检测、排队任务的时长探测）优先于下载
+PRIORITY_PROBE = 0
+PRIORITY_DOWNLOAD = 1
+
+
+def _current_rss() -> int:
+    """当前进程的常驻内存（字节）"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _encode_error(error: Exception) -> Dict[str, Any]:
+    """自定义异常的构造参数和 args 不一致，不能直接pickle，转换为字典传回主进程"""
+    if isinstance(error, DownloadCancelledError):
+        return {'kind': 'cancelled'}
+    if isinstance(error, DownloadFailedError):
+        return {'kind': 'failed', 'user_friendly': error.user_friendly,
+                'error_type': error.error_type, 'fatal': error.fatal}
+    return {'kind': 'error', 'message': str(error)}
+
+
+def _decode_error(data: Dict[str, Any]) -> Exception:
+    if data['kind'] == 'cancelled':
+        return DownloadCancelledError()
+    if data['kind'] == 'failed':
+        return DownloadFailedError(data['user_friendly'], data['error_type'], data['fatal'])
+    return RuntimeError(data['message'])
+
+
+class _RemoteHostLimiter:
+    """子进程中的CDN主机限流代理，向主进程申请名额"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire_many(self, keys, cancel_event=None) -> bool:
+        keys = sorted(set(keys))
+        if not keys:
+            return True
+        _child_send(self.conn, ('acquire', keys))
+        return self.conn.recv()
+
+    def release_many(self, keys):
+        keys = sorted(set(keys))
+        if keys:
+            _child_send(self.conn, ('release', keys))
+
+
+# 子进程中下载线程和监视线程都会向管道写入消息，Connection 不是线程安全的
+_child_send_lock = threading.Lock()
+
+
+def _child_send(conn, message):
+    with _child_send_lock:
+        conn.send(message)
+
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _child_get_video_info(conn, cancel_event, url):
+    # 只返回标题等摘要，完整 info_dict 留在本进程缓存中供下载复用
+    return video_downloader.get_video_info(url)
+
+
+def _child_download_video(conn, cancel_event, url, output_template, device_type, preferred_format):
+    info_dict = video_downloader.get_video_info(url, include_info=True).get('info_dict')
+    # ffmpeg 的输入输出都在任务的 .part 目录中
+    part_dir = job_part_dir(os.path.dirname(output_template))
+    finished = threading.Event()
+
+    def watch_cancel():
+        # 合并阶段ffmpeg不会回调进度，需要主动终止才能尽快响应取消；文件仍在增长时向主进程发送心跳
+        size = _dir_bytes(part_dir)
+        checked_at = time.time()
+        while not finished.is_set():
+            if cancel_event.wait(0.5):
+                video_downloader.terminate_ffmpeg_processes(part_dir)
+                return
+            if time.time() - checked_at >= ACTIVITY_CHECK_INTERVAL:
+                checked_at = time.time()
+                current = _dir_bytes(part_dir)
+                if current != size:
+                    size = current
+                    _child_send(conn, ('alive',))
+
+    threading.Thread(target=watch_cancel, name='cancel-watcher', daemon=True).start()
+    try:
+        return video_downloader.download_video(
+            url, output_template, lambda data: _child_send(conn, ('progress', data)),
+            info_dict, device_type, cancel_event, preferred_format)
+    finally:
+        finished.set()
+
+
+def _child_expand_playlist(conn, cancel_event, url, playlist_items):
+    return video_downloader.expand_playlist(url, playlist_items)
+
+
+_CHILD_HANDLERS = {
+    'get_video_info': _child_get_video_info,
+    'download_video': _child_download_video,
+    'expand_playlist': _child_expand_playlist,
+}
+
+
+def _child_main(conn, cancel_event, cache_config, part_root):
+    """子进程主循环：逐个执行主进程发来的任务，收到 None 或管道关闭时退出"""
+    # 独立进程组，强制结束时可以连同ffmpeg一起终止；Ctrl+C 由主进程统一处理
+    if HAS_PROCESS_GROUPS:
+        os.setpgrp()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+
+    def watch_parent():
+        # 主进程被强制结束（kill -9、OOM）时不会通知子进程；独立进程组也收不到终端信号
+        # 此时必须立即退出，否则会和重启后恢复的同一任务同时写入 .part 文件
+        multiprocessing.parent_process().join()
+        if HAS_PROCESS_GROUPS:
+            os.killpg(os.getpgrp(), signal.SIGKILL)
+        os._exit(1)
+
+    threading.Thread(target=watch_parent, name='parent-watcher', daemon=True).start()
+
+    from .cache import init_metadata_cache
+    init_metadata_cache(**cache_config)
+    init_part_root(part_root)
+    set_host_limiter(_RemoteHostLimiter(conn))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+
+        method, args = message
+        try:
+            result = _CHILD_HANDLERS[method](conn, cancel_event, *args)
+            _child_send(conn, ('result', result, _current_rss()))
+        except Exception as e:
+            _child_send(conn, ('error', _encode_error(e), _current_rss()))
+
+
+class _Child:
+    def __init__(self, ctx, cache_config, part_root):
+        self.conn, child_conn = ctx.Pipe()
+        self.cancel_event = ctx.Event()
+        self.process = ctx.Process(
+            target=_child_main,
+            args=(child_conn, self.cancel_event, cache_config, part_root),
+            name='download-process',
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.rss = 0
+        # 最近处理过的视频，同一视频的后续任务优先分配到这里以命中进程内缓存
+        self.recent_keys = deque(maxlen=32)
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        if not HAS_PROCESS_GROUPS:
+            self.process.kill()
+        else:
+            try:
+                os.killpg(self.pid, signal.SIGKILL)
+            except OSError:
+                self.process.kill()
+        self.process.join(5)
+
+
+class ProcessPool:
+    def __init__(self, max_processes: int = 4, max_jobs_per_child: int = 20,
+                 max_rss_bytes: int = 512 * 1024 * 1024, idle_timeout: float = 600,
+                 cache_config: Optional[Dict[str, Any]] = None, part_root: Optional[str] = None):
+        self.max_processes = max(1, int(max_processes))
+        self.max_jobs_per_child = max(1, int(max_jobs_per_child))
+        self.max_rss_bytes = int(max_rss_bytes)
+        self.idle_timeout = float(idle_timeout)
+        self.cache_config = cache_config or {}
+        self.part_root = part_root
+
+        # spawn：主进程中有大量线程，fork 可能复制到被持有的锁
+        self._ctx = multiprocessing.get_context('spawn')
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+        self.spawned = 0
+        self.recycled = 0
+        self.killed = 0
+        self.jobs = 0
+
+    def _acquire(self, affinity: Optional[str], priority: int) -> _Child:
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            while self._waiters[0] != ticket or (not self._idle and self._size >= self.max_processes):
+                self._cond.wait()
+            heapq.heappop(self._waiters)
+            self._cond.notify_all()
+            self.jobs += 1
+            if self._idle:
+                for child in reversed(self._idle):
+                    if affinity and affinity in child.recent_keys:
+                        break
+                else:
+                    child = self._idle[-1]
+                self._idle.remove(child)
+                return child
+            self._size += 1
+            self.spawned += 1
+
+        try:
+            child = _Child(self._ctx, self.cache_config, self.part_root)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify_all()
+            raise
+        logger.info(f"🧬 启动下载子进程: {child.pid}")
+        return child
+
+    def _release(self, child: _Child, healthy: bool):
+        retire_reason = None
+        if not healthy:
+            retire_reason = 'killed'
+        elif child.jobs >= self.max_jobs_per_child:
+            retire_reason = f'已执行 {child.jobs} 个任务'
+        elif self.max_rss_bytes and child.rss > self.max_rss_bytes:
+            retire_reason = f'内存 {child.rss / 1024 / 1024:.0f} MB 超限'
+
+        if retire_reason is None:
+            with self._cond:
+                self._idle.append(child)
+                self._cond.notify_all()
+            return
+
+        if healthy:
+            logger.info(f"♻️ 回收下载子进程 {child.pid}: {retire_reason}")
+            child.stop()
+        else:
+            # 被强制结束或异常退出的子进程
+            if child.process.is_alive():
+                child.kill()
+            child.conn.close()
+        with self._cond:
+            self._size -= 1
+            if healthy:
+                self.recycled += 1
+            self._cond.notify_all()
+
+    def call(self, method: str, args: tuple, progress_callback: Optional[Callable] = None,
+             cancel_event=None, affinity: Optional[str] = None, priority: int = PRIORITY_DOWNLOAD) -> Any:
+        """在子进程中执行任务并等待结果，期间转发进度、响应取消
+
+        子进程每发来一条消息（进度、申请/归还名额）都重新计时，超过 idle_timeout 没有任何消息才判定为卡死
+        """
+        child = self._acquire(affinity, priority)
+        child.cancel_event.clear()
+        if affinity:
+            child.recent_keys.append(affinity)
+        healthy = False
+        held_hosts = []
+        try:
+            child.conn.send((method, args))
+            last_activity = time.time()
+            cancel_deadline = None
+            while True:
+                if child.conn.poll(0.5):
+                    try:
+                        message = child.conn.recv()
+                    except (EOFError, OSError):
+                        raise DownloadFailedError('下载进程异常退出，请重试', 'worker_crashed')
+                    last_activity = time.time()
+                    if message[0] == 'alive':
+                        continue
+                    if message[0] == 'progress':
+                        if progress_callback:
+                            progress_callback(message[1])
+                        continue
+                    if message[0] == 'acquire':
+                        granted = get_host_limiter().acquire_many(message[1], cancel_event)
+                        if granted:
+                            held_hosts.extend(message[1])
+                        child.conn.send(granted)
+                        # 等待限流名额的时间不算子进程无响应
+                        last_activity = time.time()
+                        continue
+                    if message[0] == 'release':
+                        get_host_limiter().release_many(message[1])
+                        for host in message[1]:
+                            held_hosts.remove(host)
+                        continue
+                    healthy = True
+                    child.jobs += 1
+                    child.rss = message[2]
+                    if message[0] == 'result':
+                        return message[1]
+                    raise _decode_error(message[1])
+
+                if not child.process.is_alive():
+                    raise DownloadFailedError('下载进程异常退出，请重试', 'worker_crashed')
+
+                now = time.time()
+                if cancel_event is not None and cancel_deadline is None and cancel_event.is_set():
+                    child.cancel_event.set()
+                    cancel_deadline = now + CANCEL_GRACE_PERIOD
+                if cancel_deadline is not None and now > cancel_deadline:
+                    logger.warning(f"🛑 子进程 {child.pid} 未响应取消，强制结束")
+                    self._kill(child)
+                    raise DownloadCancelledError()
+                if self.idle_timeout and now - last_activity > self.idle_timeout:
+                    logger.warning(f"⏱️ 子进程 {child.pid} 已 {now - last_activity:.0f} 秒没有进展，强制结束")
+                    self._kill(child)
+                    raise DownloadFailedError('下载长时间没有进展，请稍后重试', 'timeout')
+        finally:
+            # 子进程被强制结束时未归还的名额由主进程释放
+            get_host_limiter().release_many(held_hosts)
+            self._release(child, healthy)
+
+    def _kill(self, child: _Child):
+        with self._cond:
+            self.killed += 1
+        child.kill()
+
+    def shutdown(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for child in idle:
+            child.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'max_processes': self.max_processes,
+                'processes': self._size,
+                'idle': len(self._idle),
+                'waiting': len(self._waiters),
+                'jobs': self.jobs,
+                'spawned': self.spawned,
+                'recycled': self.recycled,
+                'killed': self.killed,
+                'max_jobs_per_child': self.max_jobs_per_child,
+                'max_rss_bytes': self.max_rss_bytes,
+            }
+
+
+# 全局进程池实例，未配置时为 None（在线程中直接执行）
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def init_process_pool(max_processes: int, max_jobs_per_child: int = 20,
+                      max_rss_bytes: int = 512 * 1024 * 1024, idle_timeout: float = 600,
+                      cache_config: Optional[Dict[str, Any]] = None,
+                      part_root: Optional[str] = None) -> Optional[ProcessPool]:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None and max_processes > 0:
+            _process_pool = ProcessPool(max_processes, max_jobs_per_child, max_rss_bytes,
+                                        idle_timeout, cache_config, part_root)
+            logger.info(f"🧬 下载进程池已初始化: 最多 {max_processes} 个子进程, "
+                        f"每个子进程执行 {max_jobs_per_child} 个任务或内存超过 "
+                        f"{max_rss_bytes / 1024 / 1024:.0f} MB 后回收")
+    return _process_pool
+
+
+def get_process_pool() -> Optional[ProcessPool]:
+    return _process_pool
+
+
+def get_video_info(url: str, include_info: bool = False) -> Dict[str, Any]:
+    """与 video_downloader.get_video_info 相同的接口，启用进程池时在子进程中提取
+
+    启用进程池时返回的 info_dict 为 None：完整信息保存在子进程缓存中，download_video 在子进程内直接复用
+    """
+    pool = get_process_pool()
+    if pool is None:
+        return video_downloader.get_video_info(url, include_info)
+    info = pool.call('get_video_info', (url,), affinity=canonical_video_id(url), priority=PRIORITY_PROBE)
+    if include_info:
+        info['info_dict'] = None
+    return info
+
+
+def expand_playlist(url: str, playlist_items: Optional[str] = None) -> Dict[str, Any]:
+    """与 video_downloader.expand_playlist 相同的接口，启用进程池时在子进程中提取"""
+    pool = get_process_pool()
+    if pool is None:
+        return video_downloader.expand_playlist(url, playlist_items)
+    return pool.call('expand_playlist', (url, playlist_items), priority=PRIORITY_PROBE)
+
+
+def download_video(url: str, output_template: str, progress_callback: Optional[Callable] = None,
+                   info_dict: Optional[Dict[str, Any]] = None, device_type: str = 'desktop',
+                   cancel_event=None, preferred_format: Optional[str] = None) -> str:
+    """与 video_downloader.download_video 相同的接口，启用进程池时在子进程中下载"""
+    pool = get_process_pool()
+    if pool is None:
+        return video_downloader.download_video(url, output_template, progress_callback, info_dict,
+                                               device_type, cancel_event, preferred_format)
+    return pool.call('download_video', (url, output_template, device_type, preferred_format), progress_callback,
+                     cancel_event, affinity=canonical_video_id(url))
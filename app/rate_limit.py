@@ -0,0 +1,283 @@
+"""
+上游限流 - 按平台和CDN主机限制并发数和请求速率（令牌桶）
+B站在同一IP并发会话过多时会返回412并限流，失败又会触发多策略级联重试，进一步加重负载
+超出限制的任务排队等待，而不是直接失败
+gunicorn多进程部署时各worker进程通过文件锁共享名额和令牌桶（SharedKeyedLimiter），限制对整台机器生效
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows：只有单进程开发服务器，进程内限流即可
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 各平台同时进行的任务数上限、每秒开始的任务数、突发容量；'*' 为未单独配置的平台
+DEFAULT_PLATFORM_LIMITS = {
+    'bilibili': {'concurrency': 3, 'rate': 0.5, 'burst': 3},
+    'youtube': {'concurrency': 4, 'rate': 1.0, 'burst': 4},
+    '*': {'concurrency': 4, 'rate': 1.0, 'burst': 4},
+}
+
+# 每个CDN主机同时进行的下载数上限、每秒发起的下载数、突发容量
+DEFAULT_HOST_LIMITS = {
+    '*': {'concurrency': 4, 'rate': 2.0, 'burst': 4},
+}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """距离下一个令牌可用的秒数，0 表示当前有令牌"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class KeyedLimiter:
+    """按key（平台名或主机名）分别限制并发数和速率，线程安全
+
+    try_acquire 不阻塞，供调度器挑选可执行的任务；acquire 阻塞等待，供下载过程使用
+    """
+
+    # 名额被其他进程释放时不会唤醒本进程的等待者，非 None 时调用方需要按此间隔（秒）重试
+    poll_interval: Optional[float] = None
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, Any]]] = None, name: str = 'limiter'):
+        self.limits = dict(limits or {})
+        self.name = name
+        self._cond = threading.Condition()
+        self._active: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.throttled = 0
+
+    def _limit(self, key: str) -> Dict[str, Any]:
+        return self.limits.get(key) or self.limits.get('*') or {}
+
+    def _bucket(self, key: str) -> Optional[TokenBucket]:
+        limit = self._limit(key)
+        if not limit.get('rate'):
+            return None
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(limit['rate'], limit.get('burst', 1))
+        return bucket
+
+    def _try_acquire_locked(self, key: str, rate: bool = True) -> Optional[float]:
+        concurrency = self._limit(key).get('concurrency')
+        if concurrency and self._active.get(key, 0) >= concurrency:
+            return None
+        bucket = self._bucket(key) if rate else None
+        if bucket is not None:
+            wait = bucket.wait_time()
+            if wait > 0:
+                return wait
+            bucket.consume()
+        self._active[key] = self._active.get(key, 0) + 1
+        return 0.0
+
+    def try_acquire(self, key: str, rate: bool = True) -> Optional[float]:
+        """尝试占用一个名额：成功返回 0；受速率限制返回需要等待的秒数；并发已满返回 None（等待释放）
+
+        rate=False 时只占用并发名额，不消耗速率令牌（已经开始过的任务重试时使用）
+        """
+        with self._cond:
+            return self._try_acquire_locked(key, rate)
+
+    def acquire(self, key: str, cancel_event=None) -> bool:
+        """阻塞直到占用名额，期间被取消返回 False"""
+        with self._cond:
+            waited = False
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                wait = self._try_acquire_locked(key)
+                if wait == 0:
+                    return True
+                if not waited:
+                    waited = True
+                    self.throttled += 1
+                    logger.info(f"🚦 {self.name} 限流，等待: {key}")
+                self._cond.wait(min(wait, 0.5) if wait is not None else 0.5)
+
+    def acquire_many(self, keys: Iterable[str], cancel_event=None) -> bool:
+        """按固定顺序依次占用多个key，避免互相等待造成死锁；失败时释放已占用的名额"""
+        acquired = []
+        for key in sorted(set(keys)):
+            if not self.acquire(key, cancel_event):
+                self.release_many(acquired)
+                return False
+            acquired.append(key)
+        return True
+
+    def release(self, key: str):
+        with self._cond:
+            count = self._active.get(key, 0) - 1
+            if count > 0:
+                self._active[key] = count
+            else:
+                self._active.pop(key, None)
+            self._cond.notify_all()
+
+    def release_many(self, keys: Iterable[str]):
+        for key in set(keys):
+            self.release(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'limits': self.limits,
+                'active': dict(self._active),
+                'throttled': self.throttled,
+            }
+
+
+# 共享状态文件名中只保留安全字符
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9._-]')
+# 所有key合计的并发名额使用的文件名前缀，与key的文件名前缀不同，不会冲突
+_TOTAL_PREFIX = 'total'
+
+
+class SharedKeyedLimiter(KeyedLimiter):
+    """多个worker进程共享的限流器，名额和令牌桶保存在 state_dir 中
+
+    每个并发名额对应一个槽位文件，占用名额即对其加排他文件锁；进程崩溃时锁随之释放，名额不会泄漏。
+    令牌桶的状态在文件锁保护下读写。total 为所有key合计的并发上限（整台机器同时执行的任务数），None 为不限
+    """
+
+    poll_interval = 0.5
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, Any]]] = None, name: str = 'limiter',
+                 state_dir: str = '', total: Optional[int] = None):
+        super().__init__(limits, name)
+        self.state_dir = state_dir
+        self.total = total
+        os.makedirs(state_dir, exist_ok=True)
+        # 本进程持有的槽位文件，关闭即释放文件锁
+        self._slots: Dict[str, list] = {}
+
+    def _path(self, prefix: str, key: str, suffix: str) -> str:
+        return os.path.join(self.state_dir, f"{prefix}-{_UNSAFE_CHARS.sub('_', key)}{suffix}")
+
+    def _take_slot(self, prefix: str, key: str, count: int) -> bool:
+        for index in range(count):
+            slot = open(self._path(prefix, key, f'.{index}.slot'), 'a')
+            try:
+                fcntl.flock(slot.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                slot.close()
+                continue
+            self._slots.setdefault(f'{prefix}-{key}', []).append(slot)
+            return True
+        return False
+
+    def _drop_slot(self, prefix: str, key: str):
+        held = self._slots.get(f'{prefix}-{key}')
+        if held:
+            held.pop().close()
+            if not held:
+                del self._slots[f'{prefix}-{key}']
+
+    def _take_token(self, key: str, limit: Dict[str, Any]) -> float:
+        """从共享的令牌桶中取一个令牌：成功返回 0，否则返回需要等待的秒数"""
+        rate = float(limit['rate'])
+        capacity = max(1.0, float(limit.get('burst', 1)))
+        with open(self._path('key', key, '.bucket'), 'a+') as state:
+            fcntl.flock(state.fileno(), fcntl.LOCK_EX)
+            state.seek(0)
+            now = time.time()
+            try:
+                tokens, updated = (float(value) for value in state.read().split())
+            except ValueError:
+                tokens, updated = capacity, now
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if wait == 0:
+                tokens -= 1
+            state.truncate(0)
+            state.write(f'{tokens} {now}')
+        return wait
+
+    def _try_acquire_locked(self, key: str, rate: bool = True) -> Optional[float]:
+        limit = self._limit(key)
+        if self.total and not self._take_slot(_TOTAL_PREFIX, '', self.total):
+            return None
+        concurrency = limit.get('concurrency')
+        wait = None if concurrency and not self._take_slot('key', key, concurrency) else 0.0
+        if wait == 0 and rate and limit.get('rate'):
+            wait = self._take_token(key, limit)
+            if wait > 0:
+                self._drop_slot('key', key)
+        if wait != 0:
+            if self.total:
+                self._drop_slot(_TOTAL_PREFIX, '')
+            return wait
+        self._active[key] = self._active.get(key, 0) + 1
+        return 0.0
+
+    def release(self, key: str):
+        with self._cond:
+            self._drop_slot('key', key)
+            if self.total:
+                self._drop_slot(_TOTAL_PREFIX, '')
+        super().release(key)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats.update({'shared': True, 'total': self.total})
+        return stats
+
+
+def create_limiter(limits: Optional[Dict[str, Dict[str, Any]]], name: str,
+                   state_dir: Optional[str] = None, total: Optional[int] = None) -> KeyedLimiter:
+    """指定 state_dir 时创建多进程共享的限流器，否则只在本进程内限流（total 只对共享限流器有意义）"""
+    if state_dir and fcntl is not None:
+        return SharedKeyedLimiter(limits, name, state_dir, total)
+    return KeyedLimiter(limits, name)
+
+
+# 全局CDN主机限流器；进程池子进程中会替换为转发到主进程的代理，保证限制在整个进程内生效，
+# 多个worker进程时通过 state_dir 在整台机器上共享
+_host_limiter = None
+_host_limiter_lock = threading.Lock()
+
+
+def init_host_limiter(limits: Optional[Dict[str, Dict[str, Any]]] = None,
+                      state_dir: Optional[str] = None) -> KeyedLimiter:
+    global _host_limiter
+    with _host_limiter_lock:
+        if _host_limiter is None:
+            _host_limiter = create_limiter(limits or DEFAULT_HOST_LIMITS, 'CDN主机', state_dir)
+    return _host_limiter
+
+
+def set_host_limiter(limiter):
+    global _host_limiter
+    _host_limiter = limiter
+
+
+def get_host_limiter():
+    if _host_limiter is None:
+        return init_host_limiter()
+    return _host_limiter
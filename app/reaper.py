@@ -0,0 +1,289 @@
+"""
+磁盘和任务记录回收 - 一个后台线程按任务状态和存活时间定期清理，取代每次下载文件时启动的延迟清理线程
+
+- 已取走的文件：最后一次下载后保留 fetched_ttl 秒，期间可以断点续传或重复下载
+- 已完成但从未取走的文件：完成后保留 unfetched_ttl 秒
+- 失败/取消的任务、所有任务都已回收的批量记录：保留 failed_ttl 秒，让客户端看到最终状态
+- 工作目录中既没有检查点、也没有任务记录的目录（进程崩溃、任务记录过期等遗留）：超过 orphan_ttl 秒后删除
+- 有检查点但没有进程持有的未完成任务（其他worker进程崩溃）：交给 resume_orphans 接管
+- 单独配置的 .part 目录中，任务工作目录已不存在的子目录：任务已结束，直接删除
+
+结果缓存中的文件由缓存按配额淘汰，这里只删除任务记录；启动时立即执行一次，清理上次运行的遗留
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from .checkpoint import CHECKPOINT_FILENAME, get_part_root, get_work_root
+from .job_store import get_job_store
+from .result_cache import get_result_cache
+
+logger = logging.getLogger(__name__)
+
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def _path_size(path: str) -> int:
+    if os.path.isfile(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _job_dir_name(path: str, work_root: str) -> Optional[str]:
+    """文件所在的任务目录名，不在工作目录中时返回 None"""
+    relative = os.path.relpath(path, work_root)
+    if relative.startswith(os.pardir) or relative == os.curdir:
+        return None
+    return relative.split(os.sep)[0]
+
+
+class Reaper:
+    def __init__(self, interval: float = 60, fetched_ttl: float = 300, unfetched_ttl: float = 3600,
+                 failed_ttl: float = 900, orphan_ttl: float = 3600,
+                 sync_progress: Optional[Callable[[str], Optional[Dict[str, Any]]]] = None,
+                 forget_jobs: Optional[Callable[[Iterable[str]], None]] = None,
+                 resume_orphans: Optional[Callable[[], int]] = None):
+        self.interval = interval
+        self.fetched_ttl = fetched_ttl
+        self.unfetched_ttl = unfetched_ttl
+        self.failed_ttl = failed_ttl
+        self.orphan_ttl = orphan_ttl
+        # 由路由层提供：同步跟随者任务的进度、清理已不存在任务的内存状态、接管孤儿任务
+        self.sync_progress = sync_progress
+        self.forget_jobs = forget_jobs
+        self.resume_orphans = resume_orphans
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.sweeps = 0
+        self.last_sweep_at = None
+        self.last_sweep_seconds = 0.0
+        self.records_reaped = 0
+        self.records_expired = 0
+        self.files_reaped = 0
+        self.bytes_reclaimed = 0
+        self.orphans_resumed = 0
+        self.work_dir_bytes = 0
+
+    def start(self):
+        # 下载子进程（spawn）会重新执行 create_app，只在主进程中回收
+        if self._thread is not None or multiprocessing.parent_process() is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='reaper', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning(f"⚠️ 定期清理出错: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def _is_expired(self, record: Dict[str, Any], now: float) -> bool:
+        status = record.get('status')
+        if status == 'completed':
+            if record.get('fetched_at'):
+                return now - record['fetched_at'] >= self.fetched_ttl
+            return now - record['finished_at'] >= self.unfetched_ttl
+        return now - record['finished_at'] >= self.failed_ttl
+
+    def _remove(self, path: str) -> int:
+        """删除文件或目录，返回回收的字节数"""
+        size = _path_size(path)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            logger.warning(f"⚠️ 删除失败: {path} ({e})")
+            return 0
+        with self._lock:
+            self.files_reaped += 1
+            self.bytes_reclaimed += size
+        return size
+
+    def _remove_job_file(self, file_path: str, work_root: str) -> int:
+        """删除任务文件：在工作目录中时删除它所在的整个任务目录"""
+        job_dir_name = _job_dir_name(file_path, work_root)
+        if job_dir_name is not None:
+            return self._remove(os.path.join(work_root, job_dir_name))
+        reclaimed = self._remove(file_path)
+        # 旧版本下载到系统临时目录下的独立子目录
+        try:
+            os.rmdir(os.path.dirname(file_path))
+        except OSError:
+            pass
+        return reclaimed
+
+    def sweep(self) -> Dict[str, int]:
+        """执行一轮清理，返回本轮回收的记录数、目录数和字节数"""
+        started = time.time()
+        job_store = get_job_store()
+        result_cache = get_result_cache()
+        work_root = get_work_root()
+        expired = job_store.purge_expired()
+
+        now = time.time()
+        records = {}
+        for download_id, record in job_store.items():
+            if 'leader_id' in record and self.sync_progress is not None:
+                record = self.sync_progress(download_id) or record
+            records[download_id] = record
+
+        # 批量记录在它的所有任务都被回收后按失败任务的保留时间回收
+        for download_id, record in records.items():
+            if record.get('status') == 'batch':
+                if any(item.get('download_id') in records for item in record.get('items', [])):
+                    continue
+            elif record.get('status') not in FINAL_STATUSES:
+                continue
+            # 第一次看到任务结束时记下时间，从此开始计算保留时间
+            if 'finished_at' not in record:
+                record['finished_at'] = now
+                job_store.update(download_id, {'finished_at': now})
+
+        reaped = [download_id for download_id, record in records.items()
+                  if 'finished_at' in record and self._is_expired(record, now)]
+        for download_id in reaped:
+            job_store.delete(download_id)
+        surviving = {download_id: record for download_id, record in records.items() if download_id not in reaped}
+
+        # 删除不再被任何任务引用的文件；合并下载的其他任务仍在使用时保留
+        referenced = {record['file_path'] for record in surviving.values() if record.get('file_path')}
+        # 仍有任务记录或被其他任务引用文件的任务目录
+        kept_dirs = set(surviving) | {_job_dir_name(path, work_root) for path in referenced}
+        kept_dirs.discard(None)
+        reclaimed = 0
+        removed = 0
+        for download_id in reaped:
+            # 任务自己的工作目录（失败任务残留的 .part 文件等），没有检查点说明不是正在执行的任务
+            job_dir = os.path.join(work_root, download_id)
+            if download_id not in kept_dirs and os.path.isdir(job_dir) \
+                    and not os.path.exists(os.path.join(job_dir, CHECKPOINT_FILENAME)):
+                reclaimed += self._remove(job_dir)
+                removed += 1
+            file_path = records[download_id].get('file_path')
+            if not file_path or file_path in referenced:
+                continue
+            if result_cache is not None and result_cache.contains_path(file_path):
+                continue
+            job_dir_name = _job_dir_name(file_path, work_root)
+            if job_dir_name in kept_dirs:
+                continue
+            # 任务目录中有检查点：任务已被重新接管，正在执行
+            if job_dir_name is not None and os.path.exists(os.path.join(work_root, job_dir_name, CHECKPOINT_FILENAME)):
+                continue
+            referenced.add(file_path)
+            if os.path.exists(file_path):
+                reclaimed += self._remove_job_file(file_path, work_root)
+                removed += 1
+
+        # 工作目录中的孤儿目录：没有检查点（不是未完成的任务），也没有任务记录
+        work_dir_bytes = 0
+        for name in os.listdir(work_root):
+            path = os.path.join(work_root, name)
+            # 只处理任务目录，工作目录下的锁文件等保留
+            if not os.path.isdir(path):
+                continue
+            if name in kept_dirs or os.path.exists(os.path.join(path, CHECKPOINT_FILENAME)):
+                work_dir_bytes += _path_size(path)
+                continue
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            if age < self.orphan_ttl:
+                work_dir_bytes += _path_size(path)
+                continue
+            reclaimed += self._remove(path)
+            removed += 1
+            logger.info(f"🧹 清理孤儿目录: {name}")
+
+        # .part 目录在任务目录中创建，任务目录被删除（完成、失败、取消、回收）后就不会再使用
+        part_root = get_part_root()
+        if part_root is not None:
+            for name in os.listdir(part_root):
+                path = os.path.join(part_root, name)
+                if not os.path.isdir(path) or os.path.isdir(os.path.join(work_root, name)):
+                    continue
+                reclaimed += self._remove(path)
+                removed += 1
+                logger.info(f"🧹 清理临时文件目录: {name}")
+
+        if self.forget_jobs is not None:
+            self.forget_jobs(surviving)
+
+        resumed = self.resume_orphans() if self.resume_orphans is not None else 0
+
+        with self._lock:
+            self.sweeps += 1
+            self.last_sweep_at = started
+            self.last_sweep_seconds = round(time.time() - started, 3)
+            self.records_reaped += len(reaped)
+            self.records_expired += expired
+            self.orphans_resumed += resumed
+            self.work_dir_bytes = work_dir_bytes
+
+        if reaped or removed or expired:
+            logger.info(f"🧹 定期清理: {len(reaped)} 条任务记录, {expired} 条过期记录, "
+                        f"{removed} 个文件/目录, 回收 {reclaimed / 1024 / 1024:.1f} MB")
+        return {'records': len(reaped) + expired, 'removed': removed, 'bytes': reclaimed}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'sweeps': self.sweeps,
+                'last_sweep_at': self.last_sweep_at,
+                'last_sweep_seconds': self.last_sweep_seconds,
+                'records_reaped': self.records_reaped,
+                'records_expired': self.records_expired,
+                'files_reaped': self.files_reaped,
+                'bytes_reclaimed': self.bytes_reclaimed,
+                'orphans_resumed': self.orphans_resumed,
+                'work_dir_bytes': self.work_dir_bytes,
+            }
+
+
+# 全局回收器
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def init_reaper(interval: float = 60, fetched_ttl: float = 300, unfetched_ttl: float = 3600,
+                failed_ttl: float = 900, orphan_ttl: float = 3600, **hooks) -> Reaper:
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = Reaper(interval, fetched_ttl, unfetched_ttl, failed_ttl, orphan_ttl, **hooks)
+            _reaper.start()
+            logger.info(f"🧹 定期清理已启动: 每 {interval} 秒")
+    return _reaper
+
+
+def get_reaper() -> Optional[Reaper]:
+    return _reaper
@@ -0,0 +1,325 @@
+"""
+下载结果缓存 - 按 (规范化视频ID, 格式配置, 后处理配置) 缓存已完成的文件
+命中时 /download 直接完成，不再访问上游；磁盘占用受配额限制，按LRU淘汰
+正在传输中的文件被固定（pin），不会被淘汰
+
+多进程部署时缓存目录由各worker进程共享，索引、配额和固定状态都以磁盘为准：
+- 条目目录中的 meta.json 记录key和文件名，文件修改时间作为LRU顺序（命中时更新）
+- 固定 = 对条目目录中的 .pin 文件加共享文件锁，传输结束或进程退出时释放；淘汰前尝试加排他锁判断是否被固定
+- 交给前端代理发送的文件无法得知何时发送完毕，改为租约：.lease 文件的修改时间为到期时间，到期前不淘汰
+- 登记、淘汰和固定在缓存目录的文件锁下进行，配额按扫描到的实际占用计算
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows：只有单进程开发服务器，进程内记录固定状态即可
+    fcntl = None
+
+from .checkpoint import get_work_root
+from .finalize import finalize_file, same_filesystem
+
+logger = logging.getLogger(__name__)
+
+META_FILENAME = 'meta.json'
+PIN_FILENAME = '.pin'
+LEASE_FILENAME = '.lease'
+LOCK_FILENAME = '.lock'
+
+# 写入中的条目先放在以此开头的临时目录中，登记时整体重命名为条目目录
+STAGING_PREFIX = '.staging-'
+# 超过此时间（秒）的临时目录视为崩溃残留，启动时删除
+STAGING_MAX_AGE = 24 * 3600
+
+# 当前的后处理配置（合并为mp4），变更后处理流程时修改此值使旧缓存失效
+POSTPROCESS_PROFILE = 'mp4'
+
+
+def result_cache_key(video_id: str, format_profile: str, postprocess_profile: str = POSTPROCESS_PROFILE) -> str:
+    return f'{video_id}|{format_profile}|{postprocess_profile}'
+
+
+class ResultCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        # 本进程持有的固定：文件路径 -> 加了共享锁的 .pin 文件
+        self._pins: Dict[str, List[Any]] = {}
+        # 最近一次扫描到的缓存占用（字节）
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _read_entry(self, entry_dir: str, key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """读取条目目录，key 不为 None 时还要求与记录的key一致；条目不完整时返回 None"""
+        try:
+            with open(os.path.join(entry_dir, META_FILENAME), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            path = os.path.join(entry_dir, meta['filename'])
+            stat = os.stat(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        if key is not None and meta.get('key') != key:
+            return None
+        return {'key': meta.get('key'), 'path': path, 'size': stat.st_size,
+                'mtime': stat.st_mtime, 'dir': entry_dir}
+
+    def _scan(self) -> List[Dict[str, Any]]:
+        """扫描缓存目录中的所有条目，按最近访问时间从旧到新排列"""
+        entries = []
+        for name in os.listdir(self.root):
+            if name.startswith('.'):
+                continue
+            entry = self._read_entry(os.path.join(self.root, name))
+            if entry is not None:
+                entries.append(entry)
+        entries.sort(key=lambda entry: entry['mtime'])
+        return entries
+
+    def _load(self):
+        """启动时清理崩溃残留的临时目录和不完整的条目"""
+        with self._locked():
+            for name in os.listdir(self.root):
+                entry_dir = os.path.join(self.root, name)
+                if name.startswith(STAGING_PREFIX):
+                    # 其他worker进程可能正在写入，只清理残留的旧目录
+                    try:
+                        if time.time() - os.path.getmtime(entry_dir) > STAGING_MAX_AGE:
+                            shutil.rmtree(entry_dir, ignore_errors=True)
+                    except OSError:
+                        pass
+                elif not name.startswith('.') and self._read_entry(entry_dir) is None:
+                    # 不完整的缓存条目（写入中途崩溃等）直接删除
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+            entries = self._scan()
+        self.total_bytes = sum(entry['size'] for entry in entries)
+
+        if entries:
+            logger.info(f"📦 结果缓存已加载: {len(entries)} 个文件, {self.total_bytes / 1024 / 1024:.1f} MB")
+
+    def lookup(self, key: str) -> Optional[str]:
+        entry = self._read_entry(self._entry_dir(key), key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(entry['path'])
+        except OSError:
+            pass
+        return entry['path']
+
+    def store(self, key: str, src_path: str) -> str:
+        """把下载完成的文件移入缓存，返回缓存中的路径；放不下时返回原路径
+
+        文件先在锁外移入临时目录（跨文件系统时需要完整复制），加锁后只做淘汰和登记，
+        复制大文件期间不会阻塞其他请求的查询和淘汰
+        """
+        size = os.path.getsize(src_path)
+        if size > self.max_bytes:
+            logger.info(f"📦 文件超过缓存配额，不缓存: {os.path.basename(src_path)}")
+            return src_path
+        with self._locked():
+            if not self._can_fit_locked(size):
+                logger.info(f"📦 缓存空间被占用中的文件占满，不缓存: {os.path.basename(src_path)}")
+                return src_path
+
+        entry_dir = self._entry_dir(key)
+        staging_dir = os.path.join(self.root, f'{STAGING_PREFIX}{uuid.uuid4().hex}')
+        filename = os.path.basename(src_path)
+        os.makedirs(staging_dir)
+        try:
+            finalize_file(src_path, os.path.join(staging_dir, filename))
+            with open(os.path.join(staging_dir, META_FILENAME), 'w', encoding='utf-8') as f:
+                json.dump({'key': key, 'filename': filename, 'created': time.time()}, f, ensure_ascii=False)
+            open(os.path.join(staging_dir, PIN_FILENAME), 'a').close()
+        except BaseException:
+            self._unstage(staging_dir, filename, src_path)
+            raise
+
+        dest_path = os.path.join(entry_dir, filename)
+        with self._locked():
+            existing = self._read_entry(entry_dir, key)
+            if existing is not None:
+                # 同一结果已被其他任务（可能在其他worker进程中）先一步存入，直接复用
+                shutil.rmtree(staging_dir, ignore_errors=True)
+                try:
+                    os.utime(existing['path'])
+                except OSError:
+                    pass
+                return existing['path']
+            if not self._make_room_locked(size, exclude=entry_dir):
+                self._unstage(staging_dir, filename, src_path)
+                logger.info(f"📦 缓存空间被占用中的文件占满，不缓存: {filename}")
+                return src_path
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(staging_dir, entry_dir)
+            self.total_bytes += size
+
+        logger.info(f"📦 已缓存下载结果: {filename} ({size / 1024 / 1024:.1f} MB)")
+        return dest_path
+
+    def _unstage(self, staging_dir: str, filename: str, src_path: str):
+        """放弃写入缓存：文件已移入临时目录时移回原位置"""
+        staged_path = os.path.join(staging_dir, filename)
+        if os.path.exists(staged_path) and not os.path.exists(src_path):
+            try:
+                finalize_file(staged_path, src_path)
+            except OSError as e:
+                logger.warning(f"⚠️ 文件移回原位置失败: {e}")
+                return
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _is_pinned(self, entry_dir: str) -> bool:
+        """条目是否被任意进程固定（有共享锁时加不上排他锁），或租约尚未到期"""
+        try:
+            if os.path.getmtime(os.path.join(entry_dir, LEASE_FILENAME)) > time.time():
+                return True
+        except OSError:
+            pass
+        if fcntl is None:
+            with self._lock:
+                return any(os.path.dirname(path) == entry_dir for path in self._pins)
+        try:
+            with open(os.path.join(entry_dir, PIN_FILENAME), 'a') as pin:
+                fcntl.flock(pin.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def _can_fit_locked(self, size: int) -> bool:
+        """淘汰所有未被固定的条目后能否放下"""
+        pinned = sum(entry['size'] for entry in self._scan() if self._is_pinned(entry['dir']))
+        return pinned + size <= self.max_bytes
+
+    def _make_room_locked(self, size: int, exclude: Optional[str] = None) -> bool:
+        """按LRU顺序淘汰未被固定的条目，直到放得下 size 字节；exclude 为即将被覆盖的条目目录"""
+        entries = [entry for entry in self._scan() if entry['dir'] != exclude]
+        total = sum(entry['size'] for entry in entries)
+        for entry in entries:
+            if total + size <= self.max_bytes:
+                break
+            if self._is_pinned(entry['dir']):
+                continue
+            logger.info(f"🗑️ 淘汰缓存文件: {os.path.basename(entry['path'])}")
+            shutil.rmtree(entry['dir'], ignore_errors=True)
+            total -= entry['size']
+            with self._lock:
+                self.evictions += 1
+                self.evicted_bytes += entry['size']
+        self.total_bytes = total
+        return total + size <= self.max_bytes
+
+    @contextmanager
+    def _locked(self):
+        """登记、淘汰和固定必须互斥：进程内用线程锁，共享缓存目录的worker进程之间用文件锁"""
+        with self._cache_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.root, LOCK_FILENAME), 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                yield
+
+    def contains_path(self, path: str) -> bool:
+        return os.path.abspath(path).startswith(os.path.abspath(self.root) + os.sep)
+
+    def acquire(self, path: str) -> bool:
+        """文件开始传输时固定条目，传输期间不会被任何进程淘汰；条目已被淘汰时返回 False"""
+        with self._locked():
+            try:
+                pin = open(os.path.join(os.path.dirname(path), PIN_FILENAME), 'a')
+            except OSError:
+                return False
+            if fcntl is not None:
+                fcntl.flock(pin.fileno(), fcntl.LOCK_SH)
+        with self._lock:
+            self._pins.setdefault(path, []).append(pin)
+        return True
+
+    def lease(self, path: str, seconds: float) -> bool:
+        """交给前端代理发送时调用：seconds 秒内不淘汰该条目，多次租用以最晚的到期时间为准"""
+        lease_path = os.path.join(os.path.dirname(path), LEASE_FILENAME)
+        expires = time.time() + seconds
+        with self._locked():
+            try:
+                if os.path.exists(lease_path) and os.path.getmtime(lease_path) >= expires:
+                    return True
+                open(lease_path, 'a').close()
+                os.utime(lease_path, (expires, expires))
+            except OSError:
+                # 条目已被淘汰
+                return False
+        return True
+
+    def release(self, path: str):
+        with self._lock:
+            pins = self._pins.get(path)
+            if not pins:
+                return
+            pin = pins.pop()
+            if not pins:
+                del self._pins[path]
+        pin.close()
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self._scan()
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(entries),
+                'total_bytes': sum(entry['size'] for entry in entries),
+                'max_bytes': self.max_bytes,
+                'active_transfers': sum(len(pins) for pins in self._pins.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+            }
+
+
+# 全局结果缓存实例，未配置时为 None（不启用缓存）
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def init_result_cache(root: Optional[str], max_bytes: int) -> Optional[ResultCache]:
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None and root and max_bytes > 0:
+            try:
+                _result_cache = ResultCache(root, max_bytes)
+                logger.info(f"📦 结果缓存已初始化: {root} (配额 {max_bytes / 1024 / 1024 / 1024:.1f} GB)")
+                if not same_filesystem(root, get_work_root()):
+                    logger.info("💡 结果缓存与工作目录不在同一文件系统，入缓存时需要复制文件（支持时使用reflink/copy_file_range）")
+            except OSError as e:
+                logger.warning(f"⚠️ 结果缓存不可用: {e}")
+    return _result_cache
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    return _result_cache
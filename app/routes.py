@@ -1,10 +1,29 @@
-from flask import Blueprint, render_template, request, jsonify, send_file
+from flask import Blueprint, render_template, request, jsonify, Response
 import os
-import tempfile
-from .video_downloader import download_video, get_video_info
+import json
+import re
+import shutil
+from .video_downloader import terminate_ffmpeg_processes, detect_platform, DownloadCancelledError, DownloadFailedError
+from .process_pool import download_video, get_video_info, expand_playlist, get_process_pool
+from .scheduler import get_scheduler, estimate_job_cost, QueueFullError, SchedulerClosedError
+from .cache import get_metadata_cache, canonical_video_id
+from .result_cache import get_result_cache, result_cache_key
+from .job_store import get_job_store
+from .rate_limit import get_host_limiter
+from .checkpoint import job_checkpoint, job_part_dir, claim_orphaned_jobs
+from .reaper import get_reaper
+from .disk_budget import get_disk_budget, InsufficientStorageError
+from .zip_stream import ZipStream
+from .file_delivery import get_file_delivery, content_disposition, DIRECT_BLOCK_SIZE
 import logging
+import multiprocessing
 import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from werkzeug.wsgi import wrap_file
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
@@ -12,8 +31,161 @@ logger = logging.getLogger(__name__)
 
 bp = Blueprint('main', __name__)
 
-# 存储下载进度的全局字典
-download_progress = {}
+# 下载任务进度保存在任务存储中（见 job_store.py），多个worker进程可共享
+
+# 正在进行的下载任务记录在任务存储的占用记录中：规范化视频ID:格式配置 -> 主任务ID
+# 同一视频的并发请求（包括发往其他worker进程的请求）合并为一次下载，其余请求作为跟随者共享主任务的进度和文件
+
+def inflight_key(video_key, device_type):
+    """合并下载的占用键；识别不出视频ID的链接不合并，返回 None"""
+    return f'inflight:{video_key}:{device_type}' if video_key else None
+
+# 运行中任务的控制信息（仅本进程）：下载ID -> {'cancel_event': 取消标志, 'temp_dir': 临时目录, 'checkpoint': 任务检查点}
+active_jobs = {}
+
+class JobCancelFlag:
+    """任务取消标志：本进程内直接设置，或由其他worker进程通过任务存储的 cancel_requested 请求取消"""
+    
+    CHECK_INTERVAL = 1.0
+    
+    def __init__(self, download_id):
+        self.download_id = download_id
+        self._event = threading.Event()
+        self._checked_at = 0.0
+    
+    def set(self):
+        self._event.set()
+    
+    def is_set(self):
+        if self._event.is_set():
+            return True
+        now = time.time()
+        if now - self._checked_at >= self.CHECK_INTERVAL:
+            self._checked_at = now
+            job = get_job_store().get(self.download_id)
+            if job and job.get('cancel_requested'):
+                self._event.set()
+        return self._event.is_set()
+
+# 进度变更通知：每个任务一个递增版本号，SSE推送连接等待条件变量被唤醒
+progress_condition = threading.Condition()
+progress_versions = {}
+
+# SSE心跳间隔和单个连接的最长持续时间（秒），超时后浏览器携带Last-Event-ID自动重连
+SSE_HEARTBEAT_INTERVAL = 15
+SSE_MAX_STREAM_DURATION = 600
+
+# 批量下载单次最多提交的链接数，以及展开分P/合集后的最大任务数
+BATCH_MAX_URLS = 50
+BATCH_MAX_PARTS = 500
+# 同时展开分P列表的链接数
+BATCH_EXPAND_WORKERS = 4
+
+# 调度队列已满时延后提交的任务：(下载ID, 链接, 设备类型, 检查点)，由后台线程按顺序提交
+deferred_jobs = deque()
+deferred_lock = threading.Lock()
+deferred_feeder = None
+DEFERRED_RETRY_INTERVAL = 1.0
+
+# 磁盘空间不足时任务重新检查的间隔和最长等待时间（秒）
+DISK_WAIT_INTERVAL = 5
+DISK_WAIT_TIMEOUT = 1800
+
+# 下载进程长时间没有进展被结束后，保留 .part 文件放回队列从断点继续，最多重试的次数和间隔（秒）
+STALL_MAX_RETRIES = 2
+STALL_RETRY_DELAY = 30
+
+def notify_progress(download_id):
+    """任务进度发生变化时调用，唤醒等待中的SSE连接"""
+    with progress_condition:
+        progress_versions[download_id] = progress_versions.get(download_id, 0) + 1
+        progress_condition.notify_all()
+
+def progress_version(download_id):
+    """任务当前的进度版本号，跟随者包含主任务的版本"""
+    version = progress_versions.get(download_id, 0)
+    progress = get_job_store().get(download_id)
+    if progress and 'leader_id' in progress:
+        version += progress_versions.get(progress['leader_id'], 0)
+    return version
+
+def sync_follower_progress(download_id):
+    """跟随者任务从主任务同步进度，主任务结束后脱离主任务独立存在"""
+    job_store = get_job_store()
+    progress = job_store.get(download_id)
+    if not progress or 'leader_id' not in progress:
+        return progress
+    
+    leader = job_store.get(progress['leader_id'])
+    if leader is None:
+        return job_store.update(download_id, {}, remove=('leader_id',))
+    
+    # 主任务被取消（不是发起者取消后继续下载的情况），跟随者重新发起下载
+    if leader.get('status') == 'cancelled' and progress.get('url'):
+        return restart_follower(download_id, progress)
+    
+    leader_snapshot = dict(leader)
+    for key in ('device_type', 'download_url', 'client_cancelled', 'cancel_requested', 'url', 'seq'):
+        leader_snapshot.pop(key, None)
+    remove = ('leader_id',) if leader_snapshot.get('status') in ('completed', 'failed', 'cancelled') else ()
+    # 主任务没有变化时不写入：每次写入都会递增版本号，SSE连接会重复推送
+    if not remove and all(progress.get(key) == value for key, value in leader_snapshot.items()):
+        return progress
+    return job_store.update(download_id, leader_snapshot, remove=remove)
+
+def restart_follower(download_id, progress):
+    """跟随者脱离已取消的主任务，沿用自己的 download_id 重新创建下载（可能合并到其他进行中的任务）"""
+    job_store = get_job_store()
+    # 多个worker进程可能同时发现主任务已取消：只有拿到任务目录锁的进程负责重新发起
+    checkpoint = job_checkpoint(download_id)
+    if not checkpoint.claim():
+        return progress
+    current = job_store.get(download_id)
+    if not current or 'leader_id' not in current:
+        checkpoint.release()
+        return current
+    
+    logger.info(f"🔁 主任务已取消，跟随任务重新发起下载: {download_id} (原主任务 {progress['leader_id']})")
+    try:
+        create_download(progress['url'], progress.get('device_type', 'desktop'), defer=True,
+                        download_id=download_id, checkpoint=checkpoint)
+    except (SchedulerClosedError, InsufficientStorageError) as e:
+        # create_download 已清理检查点（进程退出时还会删除任务记录），这里写入失败状态
+        job_store.create(download_id, {
+            'status': 'failed',
+            'percent': 0,
+            'error': str(e),
+            'error_type': 'server_draining' if isinstance(e, SchedulerClosedError) else 'insufficient_storage',
+            'final': True,
+            'message': f'下载失败: {e}',
+            'device_type': progress.get('device_type', 'desktop'),
+            'url': progress['url']
+        })
+    notify_progress(download_id)
+    return job_store.get(download_id)
+
+def begin_drain():
+    """平滑退出第一步：停止接受新下载任务，结束当前进程上的SSE连接"""
+    get_scheduler().close()
+    with progress_condition:
+        progress_condition.notify_all()
+
+def wait_for_drain(timeout, heartbeat=None):
+    """等待本进程已接受的下载任务全部完成，返回是否在超时前完成"""
+    scheduler = get_scheduler()
+    if scheduler.wait_idle(timeout, heartbeat):
+        logger.info("✅ 所有下载任务已完成，进程可以退出")
+        return True
+    stats = scheduler.stats()
+    logger.warning(f"⏱️ 等待下载任务超时，仍有 {stats['running']} 个运行中、{stats['queued']} 个排队中的任务")
+    return False
+
+def forget_progress(live_ids):
+    """清理已不存在任务的进度版本号，由定期清理调用"""
+    live_ids = set(live_ids)
+    with progress_condition:
+        for download_id in [download_id for download_id in progress_versions if download_id not in live_ids]:
+            del progress_versions[download_id]
 
 @bp.route('/')
 def index():
@@ -67,6 +239,517 @@ def video_info():
             'available': False
         }), 500
 
+def new_job_checkpoint(download_id, url, device_type):
+    """为新任务创建工作目录和检查点，并由本进程持有"""
+    checkpoint = job_checkpoint(download_id)
+    if not checkpoint.claim():
+        # 任务ID唯一，目录被占用说明两个任务拿到了同一个ID，不能共用检查点和 .part 文件
+        raise RuntimeError(f'任务工作目录已被占用: {download_id}')
+    checkpoint.save({'url': url, 'device_type': device_type, 'created_at': time.time()})
+    return checkpoint
+
+def start_download_job(download_id, url, device_type, checkpoint=None):
+    """创建下载任务并提交到调度器，返回排队位置；队列已满或进程正在退出时抛出调度器的异常
+    
+    checkpoint 不为空时沿用已有的检查点（重启后接管的任务、延后提交的任务）：工作目录中已下载的 .part 文件断点续传；
+    此时提交失败由调用方处理检查点
+    """
+    job_store = get_job_store()
+    video_key = canonical_video_id(url)
+    # 识别不出视频ID的链接不缓存、不合并
+    result_cache = get_result_cache() if video_key else None
+    cache_key = result_cache_key(video_key, device_type) if video_key else None
+    coalesce_key = inflight_key(video_key, device_type)
+    
+    # 💾任务检查点：固定的工作目录 + 任务参数，进程退出后可以恢复
+    owns_checkpoint = checkpoint is None
+    resume_info = checkpoint.load() if checkpoint else None
+    if checkpoint is None:
+        checkpoint = new_job_checkpoint(download_id, url, device_type)
+    
+    # 创建进度回调函数
+    def progress_callback(progress_info):
+        # 下载器报告的completed只表示文件已下载，重命名/入缓存后才由下载线程标记完成
+        status = progress_info['status']
+        if status == 'completed':
+            status = 'finished'
+        job_store.update(download_id, {
+            'status': status,
+            'percent': progress_info.get('percent', 0),
+            'message': get_progress_message(progress_info),
+            'filename': progress_info.get('filename', ''),
+            'speed': progress_info.get('speed', ''),
+            'downloaded_mb': progress_info.get('downloaded_mb', 0),
+            'error': progress_info.get('error', ''),
+            'error_type': progress_info.get('error_type', ''),
+            'fatal': progress_info.get('fatal', False)
+        })
+        notify_progress(download_id)
+        if progress_info.get('format'):
+            checkpoint.save({'format': progress_info['format']})
+        elif status == 'downloading':
+            checkpoint.save({'percent': progress_info.get('percent', 0),
+                             'downloaded_mb': progress_info.get('downloaded_mb', 0)}, force=False)
+    
+    def release_inflight():
+        # 主任务结束，后续相同请求重新发起下载（或命中结果缓存）
+        if coalesce_key:
+            job_store.release_claim(coalesce_key, download_id)
+    
+    # 取消标志：/cancel 设置后，下载器的进度回调会中止yt-dlp
+    cancel_event = JobCancelFlag(download_id)
+    active_jobs[download_id] = {'cancel_event': cancel_event, 'temp_dir': None, 'checkpoint': checkpoint}
+    platform = detect_platform(url)
+    # 开始等待磁盘空间的时间；等待期间任务放回调度队列，不占用工作线程
+    disk_wait_since = None
+    stall_retries = 0
+    
+    # 由调度器的工作线程执行下载
+    def download_thread():
+        nonlocal disk_wait_since, stall_retries
+        temp_dir = None
+        video_info = None
+        requeued = False
+        if cancel_event.is_set():
+            # 排队期间已被（其他worker进程）取消
+            active_jobs.pop(download_id, None)
+            release_inflight()
+            checkpoint.finish()
+            shutil.rmtree(checkpoint.work_dir, ignore_errors=True)
+            job_store.update(download_id, {'status': 'cancelled', 'message': '下载已取消', 'final': True})
+            notify_progress(download_id)
+            return
+        if disk_wait_since is None:
+            job_store.update(download_id, {
+                'status': 'starting',
+                'message': '正在准备下载...'
+            }, remove=('queue_position',))
+            notify_progress(download_id)
+        try:
+            # 使用任务的工作目录（重启后恢复的任务里已有下载了一部分的 .part 文件）
+            temp_dir = checkpoint.work_dir
+            os.makedirs(temp_dir, exist_ok=True)
+            active_jobs[download_id]['temp_dir'] = temp_dir
+            
+            # 🔥修复：首先获取视频信息以使用原始标题
+            # 同时保留完整的info_dict，下载阶段直接复用，每个任务只提取一次
+            info_dict = None
+            try:
+                logger.info("📝 正在获取视频标题信息...")
+                video_info = get_video_info(url, include_info=True)
+                info_dict = video_info.get('info_dict')
+                video_title = video_info.get('title', 'Unknown_Video')
+                logger.info(f"✅ 获取到视频标题: {video_title}")
+                
+                # 创建基于视频标题的输出模板
+                # 直接使用清理后的标题，避免yt-dlp重新处理
+                safe_filename = video_title.replace('/', '_').replace('\\', '_')
+                output_template = os.path.join(temp_dir, f"{safe_filename}.%(ext)s")
+                
+                # 测试文件名是否可以创建
+                test_path = os.path.join(temp_dir, f"{safe_filename}.mp4")
+                try:
+                    with open(test_path, 'w', encoding='utf-8') as f:
+                        f.write('')
+                    os.remove(test_path)
+                    logger.info(f"✅ 文件名测试通过: {safe_filename}")
+                except Exception as e:
+                    logger.warning(f"⚠️ 文件名测试失败，使用默认模板: {e}")
+                    output_template = os.path.join(temp_dir, "%(title)s.%(ext)s")
+            
+            except Exception as e:
+                logger.warning(f"⚠️ 获取视频信息失败，使用默认模板: {e}")
+                output_template = os.path.join(temp_dir, "%(title)s.%(ext)s")
+                video_title = 'Unknown_Video'
+            
+            # 💽磁盘准入：按预估输出大小预留空间，放不下时放回队列稍后重试，不让任务下载完才在合并阶段失败
+            if not reserve_disk_space(download_id, checkpoint, video_info, disk_wait_since):
+                disk_wait_since = disk_wait_since or time.time()
+                requeued = True
+                get_scheduler().requeue(download_id, download_thread, platform,
+                                        estimate_job_cost(video_info), DISK_WAIT_INTERVAL)
+                return
+            
+            logger.info(f"📁 使用输出模板: {output_template}")
+            
+            # 调用下载函数
+            file_path = download_video(url, output_template, progress_callback, info_dict, device_type,
+                                       cancel_event, (resume_info or {}).get('format'))
+            
+            # 🔥修复：确保返回的文件使用正确的名称
+            if file_path and os.path.exists(file_path):
+                original_filename = os.path.basename(file_path)
+                
+                # 如果下载的文件名不符合预期，重命名它
+                if video_title != 'Unknown_Video' and not original_filename.startswith(video_title):
+                    desired_filename = f"{video_title}.mp4"
+                    new_file_path = os.path.join(os.path.dirname(file_path), desired_filename)
+                    
+                    try:
+                        if os.path.exists(new_file_path):
+                            os.remove(new_file_path)
+                        os.rename(file_path, new_file_path)
+                        file_path = new_file_path
+                        logger.info(f"🔄 文件重命名: {original_filename} -> {desired_filename}")
+                    except Exception as e:
+                        logger.warning(f"⚠️ 文件重命名失败: {e}")
+            
+            # 📦存入结果缓存，后续相同请求直接命中
+            if result_cache and file_path and os.path.exists(file_path):
+                try:
+                    file_path = result_cache.store(cache_key, file_path)
+                    if result_cache.contains_path(file_path):
+                        shutil.rmtree(temp_dir, ignore_errors=True)
+                except Exception as e:
+                    logger.warning(f"⚠️ 写入结果缓存失败: {e}")
+            
+            # 下载完成
+            job_store.update(download_id, {
+                'file_path': file_path,
+                'status': 'completed',
+                'percent': 100,
+                'message': '下载完成'
+            })
+        
+        except DownloadCancelledError:
+            # 🛑用户取消：立即清理临时目录，释放磁盘
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            job_store.update(download_id, {
+                'status': 'cancelled',
+                'message': '下载已取消',
+                'final': True
+            })
+            logger.info(f"🛑 任务已取消并清理: {download_id}")
+        
+        except Exception as e:
+            logger.error(f"下载线程出错: {str(e)}")
+            from .video_downloader import analyze_bilibili_error, DownloadFailedError
+            stalled = isinstance(e, DownloadFailedError) and e.error_type == 'timeout'
+            if stalled and stall_retries < STALL_MAX_RETRIES:
+                # 下载进程卡死：已下载的 .part 文件保留，稍后从断点继续
+                stall_retries += 1
+                requeued = True
+                job_store.update(download_id, {'status': 'queued', 'message': '下载长时间没有进展，稍后从断点继续...'})
+                notify_progress(download_id)
+                logger.info(f"⏱️ 任务放回队列从断点继续 ({stall_retries}/{STALL_MAX_RETRIES}): {download_id}")
+                get_scheduler().requeue(download_id, download_thread, platform,
+                                        estimate_job_cost(video_info), STALL_RETRY_DELAY)
+                return
+            # 失败任务的 .part 文件不会再被续传，立即释放磁盘；卡死的任务保留到定期清理，便于排查
+            if temp_dir and not stalled:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            
+            # 下载器已分类的错误直接使用其结果
+            if isinstance(e, DownloadFailedError):
+                error_analysis = {'user_friendly': e.user_friendly, 'error_type': e.error_type, 'fatal': e.fatal}
+            else:
+                error_analysis = analyze_bilibili_error(str(e))
+            
+            job_store.update(download_id, {
+                'status': 'failed',
+                'error': error_analysis.get('user_friendly', str(e)),
+                'error_type': error_analysis.get('error_type', 'unknown_error'),
+                'fatal': error_analysis.get('fatal', False),
+                'final': True,
+                'message': f'下载失败: {error_analysis.get("user_friendly", str(e))}'
+            })
+        
+        finally:
+            # 任务已结束（完成/失败/取消），不再需要恢复；放回队列等待磁盘空间的任务保留检查点
+            if not requeued:
+                checkpoint.finish()
+                active_jobs.pop(download_id, None)
+                notify_progress(download_id)
+                release_inflight()
+    
+    # 提交到调度器
+    try:
+        position = get_scheduler().submit(download_id, download_thread, platform)
+    except (QueueFullError, SchedulerClosedError):
+        active_jobs.pop(download_id, None)
+        if owns_checkpoint:
+            checkpoint.finish()
+            shutil.rmtree(checkpoint.work_dir, ignore_errors=True)
+        raise
+    
+    if position > 0:
+        job_store.update(download_id, {
+            'queue_position': position,
+            'message': f'正在排队，前方还有 {position} 个任务...'
+        })
+        
+        # 📏需要排队时先探测时长/大小，短视频可以排到长视频前面；探测结果进入元数据缓存，下载时直接复用
+        def probe_job_cost():
+            get_scheduler().set_cost(download_id, estimate_job_cost(get_video_info(url)))
+        
+        get_scheduler().submit_probe(download_id, probe_job_cost)
+    
+    return position
+
+def reserve_disk_space(download_id, checkpoint, video_info, wait_since=None):
+    """为任务预留磁盘空间（记录在检查点中，任务结束时释放），返回是否成功
+    
+    空间不足时返回 False，由调用方把任务放回调度队列稍后重试；wait_since 为开始等待的时间，
+    等待超时或永远放不下时抛出 DownloadFailedError
+    """
+    budget = get_disk_budget()
+    size = budget.estimate(video_info)
+    if not budget.fits_ever(size):
+        raise DownloadFailedError(f'视频预计需要 {size / 1024 / 1024:.0f} MB 磁盘空间，超出服务器限制',
+                                  'insufficient_storage', True)
+    
+    job_store = get_job_store()
+    if budget.try_reserve(checkpoint, size):
+        if wait_since is not None:
+            job_store.update(download_id, {'status': 'starting', 'message': '正在准备下载...'}, remove=('waiting_disk',))
+            notify_progress(download_id)
+        return True
+    
+    if wait_since is not None and time.time() - wait_since >= DISK_WAIT_TIMEOUT:
+        raise DownloadFailedError('服务器磁盘空间不足，请稍后重试', 'insufficient_storage')
+    if wait_since is None:
+        job_store.update(download_id, {'status': 'queued', 'message': '磁盘空间不足，等待其他任务完成...',
+                                       'waiting_disk': True})
+        notify_progress(download_id)
+        logger.info(f"💽 磁盘空间不足，任务放回队列等待: {download_id} (需要 {size / 1024 / 1024:.0f} MB)")
+    return False
+
+def defer_download_job(download_id, url, device_type, checkpoint):
+    """调度队列已满时暂存任务（批量下载的大量分P、重启后恢复的任务），由后台线程在队列有空位时依次提交
+    
+    任务已有检查点，进程在提交前退出也会在下次启动时恢复
+    """
+    global deferred_feeder
+    with deferred_lock:
+        deferred_jobs.append((download_id, url, device_type, checkpoint))
+        if deferred_feeder is None:
+            deferred_feeder = threading.Thread(target=feed_deferred_jobs, name='deferred-feeder', daemon=True)
+            deferred_feeder.start()
+
+def feed_deferred_jobs():
+    global deferred_feeder
+    while True:
+        with deferred_lock:
+            if not deferred_jobs:
+                deferred_feeder = None
+                return
+            job = deferred_jobs.popleft()
+        try:
+            start_download_job(*job)
+        except QueueFullError:
+            with deferred_lock:
+                deferred_jobs.appendleft(job)
+            time.sleep(DEFERRED_RETRY_INTERVAL)
+        except SchedulerClosedError:
+            # 进程正在退出：释放检查点，由下次启动的进程恢复
+            with deferred_lock:
+                remaining = [job] + list(deferred_jobs)
+                deferred_jobs.clear()
+                deferred_feeder = None
+            for _, _, _, checkpoint in remaining:
+                checkpoint.release()
+            return
+
+def cancel_deferred_job(download_id):
+    """取消尚未提交到调度器的延后任务，返回是否找到"""
+    with deferred_lock:
+        for job in deferred_jobs:
+            if job[0] == download_id:
+                deferred_jobs.remove(job)
+                break
+        else:
+            return False
+    checkpoint = job[3]
+    checkpoint.finish()
+    shutil.rmtree(checkpoint.work_dir, ignore_errors=True)
+    return True
+
+def resume_unfinished_jobs():
+    """启动时接管上次进程退出时未完成的下载任务，客户端继续使用原来的 download_id 查询进度"""
+    # 下载子进程（spawn）会重新导入主模块并执行 create_app，子进程中不接管任务
+    if multiprocessing.parent_process() is not None:
+        return 0
+    
+    job_store = get_job_store()
+    resumed = 0
+    for checkpoint in claim_orphaned_jobs():
+        data = checkpoint.load()
+        download_id = checkpoint.download_id
+        url = data.get('url')
+        device_type = data.get('device_type', 'desktop')
+        if not url:
+            checkpoint.finish()
+            continue
+        
+        video_key = canonical_video_id(url)
+        coalesce_key = inflight_key(video_key, device_type)
+        fields = {
+            'status': 'queued',
+            'percent': data.get('percent', 0),
+            'message': '服务已重启，正在恢复下载...',
+            'device_type': device_type,
+            'resumed': True
+        }
+        if coalesce_key:
+            fields['inflight_key'] = coalesce_key
+        if job_store.update(download_id, fields, remove=('final', 'error', 'error_type')) is None:
+            job_store.create(download_id, fields)
+        
+        if video_key:
+            # 退出的进程留下的占用记录指向的就是本任务；已被其他任务接替时不抢占
+            job_store.claim(coalesce_key, download_id)
+            # 缓存中的媒体地址可能已经过期，恢复时重新提取
+            get_metadata_cache().invalidate(video_key)
+        
+        try:
+            start_download_job(download_id, url, device_type, checkpoint)
+        except QueueFullError:
+            defer_download_job(download_id, url, device_type, checkpoint)
+        except SchedulerClosedError:
+            # 留给下次启动时再恢复
+            if coalesce_key:
+                job_store.release_claim(coalesce_key, download_id)
+            checkpoint.release()
+            continue
+        resumed += 1
+        logger.info(f"♻️ 恢复未完成的下载: {download_id} ({data.get('downloaded_mb', 0):.1f} MB 已下载)")
+    
+    return resumed
+
+def new_download_id(prefix=''):
+    """生成下载ID - 随机UUID，多个线程/worker进程同时创建也不会重复（ID同时是任务工作目录名）"""
+    return f'{prefix}{uuid.uuid4().hex}'
+
+def create_download(url, device_type, defer=False, download_id=None, checkpoint=None):
+    """为一个链接创建下载任务：结果缓存命中直接完成，相同视频正在下载时合并，否则提交到调度器
+    
+    返回 /download 的响应数据；队列已满或进程正在退出时抛出调度器的异常（已清理创建的任务），
+    磁盘空间不足时抛出 InsufficientStorageError；
+    defer=True 时队列已满的任务延后提交，不抛出 QueueFullError。
+    download_id/checkpoint 用于沿用已有的任务ID重新发起下载（已由调用方持有任务目录锁），
+    不需要自己下载时释放该检查点
+    """
+    job_store = get_job_store()
+    if download_id is None:
+        download_id = new_download_id()
+    video_key = canonical_video_id(url)
+    
+    def discard_checkpoint():
+        if checkpoint is not None:
+            checkpoint.finish()
+            shutil.rmtree(checkpoint.work_dir, ignore_errors=True)
+    
+    # 📦结果缓存命中：文件已在本地，直接完成，不访问上游（识别不出视频ID的链接不查缓存、不合并）
+    result_cache = get_result_cache()
+    cache_key = result_cache_key(video_key, device_type) if video_key else None
+    cached_path = result_cache.lookup(cache_key) if result_cache and cache_key else None
+    if cached_path:
+        job_store.create(download_id, {
+            'status': 'completed',
+            'percent': 100,
+            'message': '下载完成',
+            'device_type': device_type,
+            'file_path': cached_path,
+            'filename': os.path.basename(cached_path),
+            'cache_hit': True
+        })
+        discard_checkpoint()
+        logger.info(f"⚡ 结果缓存命中: {video_key} -> {os.path.basename(cached_path)}")
+        return {
+            'download_id': download_id,
+            'queue_position': 0,
+            'cache_hit': True,
+            'message': '下载完成'
+        }
+    
+    # 🔗合并同一视频的并发下载：已有相同视频+格式的任务在进行中时直接跟随
+    # 先以排队状态创建记录再占用，其他请求读到的主任务记录总是存在
+    coalesce_key = inflight_key(video_key, device_type)
+    progress = {
+        'status': 'queued',
+        'percent': 0,
+        'message': '正在排队等待下载...',
+        'device_type': device_type
+    }
+    if coalesce_key:
+        progress['inflight_key'] = coalesce_key
+    job_store.create(download_id, progress)
+    leader_id = job_store.claim(coalesce_key, download_id) if coalesce_key else download_id
+    while leader_id != download_id:
+        leader = job_store.get(leader_id)
+        # 只合并到仍在进行中的任务：已取消/失败/完成的主任务在被回收前仍留在任务存储中
+        if leader and leader['status'] not in ('completed', 'failed', 'cancelled') \
+                and not leader.get('cancel_requested'):
+            job_store.create(download_id, {
+                'status': 'queued',
+                'percent': 0,
+                'message': '相同视频正在下载中，已合并到该任务...',
+                'device_type': device_type,
+                'url': url,
+                'leader_id': leader_id
+            })
+            discard_checkpoint()
+            logger.info(f"🔗 合并下载请求: {download_id} -> {leader_id} ({video_key})")
+            return {
+                'download_id': download_id,
+                'queue_position': 0,
+                'coalesced': True,
+                'message': '相同视频正在下载中，已合并到该任务'
+            }
+        # 主任务已结束或记录已不存在（所在进程被杀死，未释放占用）：由本任务接替
+        leader_id = job_store.claim(coalesce_key, download_id, replace=leader_id)
+    
+    def release_inflight():
+        if coalesce_key:
+            job_store.release_claim(coalesce_key, download_id)
+    
+    # 💽磁盘已经没有可用空间时直接拒绝，不让任务排队后再失败
+    try:
+        get_disk_budget().check_admission()
+    except InsufficientStorageError:
+        job_store.delete(download_id)
+        release_inflight()
+        discard_checkpoint()
+        raise
+    
+    try:
+        # 延后提交的任务需要先有检查点，保证进程退出后仍能恢复
+        if checkpoint is not None:
+            checkpoint.save({'url': url, 'device_type': device_type, 'created_at': time.time()})
+        elif defer:
+            checkpoint = new_job_checkpoint(download_id, url, device_type)
+        position = start_download_job(download_id, url, device_type, checkpoint)
+    except Exception as e:
+        if defer and isinstance(e, QueueFullError):
+            defer_download_job(download_id, url, device_type, checkpoint)
+            job_store.update(download_id, {'message': '任务较多，等待加入下载队列...'})
+            return {
+                'download_id': download_id,
+                'queue_position': None,
+                'deferred': True,
+                'message': '任务较多，等待加入下载队列'
+            }
+        job_store.delete(download_id)
+        release_inflight()
+        discard_checkpoint()
+        raise
+    
+    return {
+        'download_id': download_id,
+        'queue_position': position,
+        'message': '下载已开始，请等待...' if position == 0 else f'已加入下载队列，排队位置: {position}'
+    }
+
+def detect_device_type():
+    """根据请求的 User-Agent 判断设备类型：mobile / desktop"""
+    user_agent = request.headers.get('User-Agent', '').lower()
+    is_mobile = any(mobile in user_agent for mobile in [
+        'mobile', 'android', 'iphone', 'ipad', 'ipod', 
+        'phone', 'tablet', 'touch', 'mini'
+    ])
+    return 'mobile' if is_mobile else 'desktop'
+
 @bp.route('/download', methods=['POST'])
 def download():
     try:
@@ -76,161 +759,445 @@ def download():
         
         url = data['url']
         
-        # 检测移动端请求 - 增强检测
+        # 检测设备类型 - 增强检测
+        device_type = detect_device_type()
         user_agent = request.headers.get('User-Agent', '').lower()
-        is_mobile = any(mobile in user_agent for mobile in [
-            'mobile', 'android', 'iphone', 'ipad', 'ipod', 
-            'phone', 'tablet', 'touch', 'mini'
-        ])
-        
-        # 检测设备类型
-        device_type = 'mobile' if is_mobile else 'desktop'
         
         logger.info(f"收到下载请求: {url} (设备类型: {device_type}, UA: {user_agent[:50]}...)")
         
-        # 生成下载ID
-        download_id = str(int(time.time() * 1000))
+        # 提交到调度器，队列满时返回429
+        try:
+            result = create_download(url, device_type)
+        except QueueFullError as e:
+            logger.warning(f"🚦 下载队列已满，拒绝请求: {url}")
+            response = jsonify({
+                'error': '服务器繁忙，下载队列已满，请稍后再试',
+                'error_type': 'queue_full',
+                'retry_after': e.retry_after
+            })
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
+        except SchedulerClosedError as e:
+            response = jsonify({
+                'error': str(e),
+                'error_type': 'server_draining',
+                'retry_after': 2
+            })
+            response.headers['Retry-After'] = '2'
+            return response, 503
+        except InsufficientStorageError as e:
+            logger.warning(f"💽 磁盘空间不足，拒绝请求: {url}")
+            response = jsonify({
+                'error': str(e),
+                'error_type': 'insufficient_storage',
+                'retry_after': e.retry_after
+            })
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 507
         
-        # 初始化进度
-        download_progress[download_id] = {
-            'status': 'starting',
-            'percent': 0,
-            'message': '正在准备下载...',
-            'device_type': device_type
-        }
+        # 返回下载ID
+        return jsonify(result)
         
-        # 创建进度回调函数
-        def progress_callback(progress_info):
-            download_progress[download_id] = {
-                'status': progress_info['status'],
-                'percent': progress_info.get('percent', 0),
-                'message': get_progress_message(progress_info),
-                'filename': progress_info.get('filename', ''),
-                'speed': progress_info.get('speed', ''),
-                'downloaded_mb': progress_info.get('downloaded_mb', 0),
-                'error': progress_info.get('error', ''),
-                'error_type': progress_info.get('error_type', ''),
-                'fatal': progress_info.get('fatal', False)
-            }
+    except Exception as e:
+        logger.error(f"启动下载时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def is_final_progress(progress):
+    """任务是否已结束（完成、取消、不再重试的失败）"""
+    return progress['status'] in ('completed', 'cancelled') or (progress['status'] == 'failed' and progress.get('final'))
+
+def build_progress_payload(download_id):
+    """生成任务的进度数据，任务不存在时返回 None"""
+    progress = sync_follower_progress(download_id)
+    if progress is None or progress['status'] == 'batch':
+        return None
+    
+    # 主任务的发起者已取消，但仍有跟随者在等待同一个文件：对发起者显示已取消
+    if progress.get('client_cancelled'):
+        return {'status': 'cancelled', 'percent': 0, 'message': '下载已取消', 'final': True}
+    
+    # 排队中的任务实时计算队列位置（等待磁盘空间的任务保留原提示）
+    if progress['status'] == 'queued' and not progress.get('waiting_disk'):
+        position = get_scheduler().queue_position(progress.get('leader_id', download_id))
+        if position is not None:
+            progress['queue_position'] = position
+            progress['message'] = f'正在排队，前方还有 {position} 个任务...' if position > 0 else '即将开始下载...'
+    
+    # 如果下载完成，提供下载链接
+    if progress['status'] == 'completed' and 'file_path' in progress:
+        file_path = progress['file_path']
+        if os.path.exists(file_path):
+            filename = os.path.basename(file_path)
+            progress['download_url'] = f'/download-file/{download_id}'
+            progress['filename'] = filename
+    
+    return progress
+
+@bp.route('/progress/<download_id>')
+def get_progress(download_id):
+    """获取下载进度"""
+    progress = build_progress_payload(download_id)
+    if progress is not None:
+        return jsonify(progress)
+    else:
+        return jsonify({'error': '下载ID不存在'}), 404
+
+@bp.route('/progress/<download_id>/stream')
+def stream_progress(download_id):
+    """SSE推送下载进度，替代轮询；支持心跳，断线重连后先推送一次当前状态"""
+    if download_id not in get_job_store():
+        return jsonify({'error': '下载ID不存在'}), 404
+    
+    scheduler = get_scheduler()
+    
+    def generate():
+        # 每个连接（包括携带 Last-Event-ID 的重连）第一轮总是推送当前状态：
+        # 本进程的通知计数不反映其他worker进程的更新，不能据此判断浏览器已经收到过
+        sent_payload = None
+        deadline = time.time() + SSE_MAX_STREAM_DURATION
+        last_write = time.time()
         
-        # 在后台线程中执行下载
-        def download_thread():
-            try:
-                # 创建临时目录
-                temp_dir = tempfile.mkdtemp()
-                
-                # 🔥修复：首先获取视频信息以使用原始标题
+        # 告诉浏览器断线后2秒重连
+        yield 'retry: 2000\n\n'
+        
+        # 进程平滑退出时主动结束推送，浏览器会自动重连到其他worker
+        while time.time() < deadline and scheduler.accepting:
+            progress = build_progress_payload(download_id)
+            if progress is None:
+                yield f"event: error\ndata: {json.dumps({'error': '下载ID不存在'}, ensure_ascii=False)}\n\n"
+                return
+            
+            # 事件ID取共享任务存储中记录的版本号，各worker进程一致
+            seq = progress.pop('seq', 0)
+            version = progress_version(download_id)
+            payload = json.dumps(progress, ensure_ascii=False)
+            if payload != sent_payload:
+                yield f"id: {seq}\nevent: progress\ndata: {payload}\n\n"
+                sent_payload = payload
+                last_write = time.time()
+            
+            if is_final_progress(progress):
+                return
+            
+            # 排队中的任务需要定期刷新队列位置，其余状态只在进度变化时唤醒；
+            # 共享任务存储中的任务可能由其他worker进程更新，本进程收不到通知，需每秒检查一次
+            timeout = 2 if progress['status'] == 'queued' else SSE_HEARTBEAT_INTERVAL
+            if get_job_store().shared:
+                timeout = 1
+            with progress_condition:
+                progress_condition.wait_for(
+                    lambda: progress_version(download_id) != version or not scheduler.accepting,
+                    timeout=timeout
+                )
+            if time.time() - last_write >= SSE_HEARTBEAT_INTERVAL:
+                yield ': heartbeat\n\n'
+                last_write = time.time()
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 禁止nginx缓冲，确保实时推送
+    return response
+
+@bp.route('/batch', methods=['POST'])
+def create_batch():
+    """批量下载：一次提交多个链接，规范化去重后逐个创建任务，返回批次ID和每个链接对应的下载ID
+    
+    parts: 展开多P视频和合集，'all' 或分P范围如 '1-10,15'；展开后的每个视频作为独立任务并行下载
+    任务创建后和单个下载一样由调度器统一排队（受平台和CDN主机限流），进度通过 /batch/<batch_id> 汇总查询
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        urls = data.get('urls')
+        # 也接受直接粘贴的多行文本
+        if isinstance(urls, str):
+            urls = urls.split()
+        if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+            return jsonify({'error': '缺少视频URL列表'}), 400
+        urls = [url.strip() for url in urls if url.strip()]
+        if not urls:
+            return jsonify({'error': '缺少视频URL列表'}), 400
+        if len(urls) > BATCH_MAX_URLS:
+            return jsonify({'error': f'一次最多提交 {BATCH_MAX_URLS} 个链接', 'error_type': 'too_many_urls'}), 400
+        
+        # 展开多P视频/合集：'all' 为全部，或 yt-dlp 的范围语法如 '1-10,15'
+        expand = 'parts' in data
+        playlist_items = str(data.get('parts') or '').replace(' ', '')
+        if playlist_items.lower() in ('', 'all'):
+            playlist_items = None
+        elif not re.fullmatch(r'\d+(-\d+)?(,\d+(-\d+)?)*', playlist_items):
+            return jsonify({'error': '分P范围格式错误，例如 1-10,15', 'error_type': 'invalid_parts'}), 400
+        
+        device_type = detect_device_type()
+        job_store = get_job_store()
+        logger.info(f"📚 收到批量下载请求: {len(urls)} 个链接 (设备类型: {device_type}"
+                    f"{', 展开分P: ' + (playlist_items or '全部') if expand else ''})")
+        
+        valid_urls = []
+        for url in urls:
+            parsed = urlparse(url if '://' in url else f'https://{url}')
+            if parsed.hostname and '.' in parsed.hostname:
+                valid_urls.append(url)
+        
+        # 各链接的分P列表并行获取
+        expanded = {}
+        if expand and valid_urls:
+            def expand_url(url):
                 try:
-                    logger.info("📝 正在获取视频标题信息...")
-                    video_info = get_video_info(url)
-                    video_title = video_info.get('title', 'Unknown_Video')
-                    logger.info(f"✅ 获取到视频标题: {video_title}")
-                    
-                    # 创建基于视频标题的输出模板
-                    # 直接使用清理后的标题，避免yt-dlp重新处理
-                    safe_filename = video_title.replace('/', '_').replace('\\', '_')
-                    output_template = os.path.join(temp_dir, f"{safe_filename}.%(ext)s")
-                    
-                    # 测试文件名是否可以创建
-                    test_path = os.path.join(temp_dir, f"{safe_filename}.mp4")
-                    try:
-                        with open(test_path, 'w', encoding='utf-8') as f:
-                            f.write('')
-                        os.remove(test_path)
-                        logger.info(f"✅ 文件名测试通过: {safe_filename}")
-                    except Exception as e:
-                        logger.warning(f"⚠️ 文件名测试失败，使用默认模板: {e}")
-                        output_template = os.path.join(temp_dir, "%(title)s.%(ext)s")
-                        
+                    return url, expand_playlist(url, playlist_items)
                 except Exception as e:
-                    logger.warning(f"⚠️ 获取视频信息失败，使用默认模板: {e}")
-                    output_template = os.path.join(temp_dir, "%(title)s.%(ext)s")
-                    video_title = 'Unknown_Video'
-                
-                logger.info(f"📁 使用输出模板: {output_template}")
-                
-                # 调用下载函数
-                file_path = download_video(url, output_template, progress_callback)
-                
-                # 🔥修复：确保返回的文件使用正确的名称
-                if file_path and os.path.exists(file_path):
-                    original_filename = os.path.basename(file_path)
-                    
-                    # 如果下载的文件名不符合预期，重命名它
-                    if video_title != 'Unknown_Video' and not original_filename.startswith(video_title):
-                        desired_filename = f"{video_title}.mp4"
-                        new_file_path = os.path.join(os.path.dirname(file_path), desired_filename)
-                        
-                        try:
-                            if os.path.exists(new_file_path):
-                                os.remove(new_file_path)
-                            os.rename(file_path, new_file_path)
-                            file_path = new_file_path
-                            logger.info(f"🔄 文件重命名: {original_filename} -> {desired_filename}")
-                        except Exception as e:
-                            logger.warning(f"⚠️ 文件重命名失败: {e}")
-                
-                # 下载完成
-                download_progress[download_id]['file_path'] = file_path
-                download_progress[download_id]['status'] = 'completed'
-                download_progress[download_id]['percent'] = 100
-                download_progress[download_id]['message'] = '下载完成'
-                
-            except Exception as e:
-                logger.error(f"下载线程出错: {str(e)}")
-                
-                # 导入错误分析函数
-                from .video_downloader import analyze_bilibili_error
-                error_analysis = analyze_bilibili_error(str(e))
-                
-                download_progress[download_id]['status'] = 'failed'
-                download_progress[download_id]['error'] = error_analysis.get('user_friendly', str(e))
-                download_progress[download_id]['error_type'] = error_analysis.get('error_type', 'unknown_error')
-                download_progress[download_id]['fatal'] = error_analysis.get('fatal', False)
-                download_progress[download_id]['message'] = f'下载失败: {error_analysis.get("user_friendly", str(e))}'
+                    return url, e
+            with ThreadPoolExecutor(max_workers=min(BATCH_EXPAND_WORKERS, len(valid_urls))) as executor:
+                expanded = dict(executor.map(expand_url, valid_urls))
         
-        # 启动下载线程
-        thread = threading.Thread(target=download_thread)
-        thread.daemon = True
-        thread.start()
+        items = []
+        for url in urls:
+            if url not in valid_urls:
+                items.append({'url': url, 'error': '无效的视频链接', 'error_type': 'invalid_url'})
+            elif isinstance(expanded.get(url), Exception):
+                error = expanded[url]
+                items.append({
+                    'url': url,
+                    'error': error.user_friendly if isinstance(error, DownloadFailedError) else '无法获取分P列表',
+                    'error_type': error.error_type if isinstance(error, DownloadFailedError) else 'expand_failed'
+                })
+            elif url in expanded:
+                for entry in expanded[url]['entries']:
+                    items.append({'url': entry['url'], 'source': url, 'title': entry.get('title')})
+            else:
+                items.append({'url': url})
         
-        # 返回下载ID
-        return jsonify({
-            'download_id': download_id,
-            'message': '下载已开始，请等待...'
+        if len(items) > BATCH_MAX_PARTS:
+            return jsonify({
+                'error': f'展开后共 {len(items)} 个视频，超过上限 {BATCH_MAX_PARTS}，请选择分P范围',
+                'error_type': 'too_many_parts'
+            }), 400
+        
+        # 逐个创建任务；超出调度队列容量的任务延后提交，不会被拒绝
+        seen = {}
+        closed = False
+        for item in items:
+            if 'error' in item:
+                continue
+            
+            # 同一视频的不同链接形式（移动端、分享参数）只下载一次；识别不出视频ID时只合并完全相同的链接
+            video_key = canonical_video_id(item['url']) or item['url']
+            if video_key in seen:
+                item.update({'download_id': seen[video_key], 'duplicate': True})
+                continue
+            
+            if closed:
+                item.update({'error': '服务器正在重启，请稍后重试', 'error_type': 'server_draining'})
+                continue
+            try:
+                item.update(create_download(item['url'], device_type, defer=True))
+                seen[video_key] = item['download_id']
+            except SchedulerClosedError:
+                closed = True
+                item.update({'error': '服务器正在重启，请稍后重试', 'error_type': 'server_draining'})
+            except InsufficientStorageError as e:
+                item.update({'error': str(e), 'error_type': 'insufficient_storage'})
+        
+        accepted = len(seen)
+        if not accepted:
+            error_type = items[-1].get('error_type')
+            status_code = {'server_draining': 503, 'insufficient_storage': 507}.get(error_type, 400)
+            response = jsonify({'error': items[-1]['error'], 'error_type': error_type, 'items': items})
+            if status_code == 503:
+                response.headers['Retry-After'] = '2'
+            elif status_code == 507:
+                response.headers['Retry-After'] = '60'
+            return response, status_code
+        
+        # 批次记录和任务一起保存在任务存储中，任意worker进程都能查询汇总进度
+        batch_id = new_download_id(prefix='batch-')
+        job_store.create(batch_id, {
+            'status': 'batch',
+            'device_type': device_type,
+            'items': [{key: item[key] for key in ('url', 'source', 'title', 'download_id', 'duplicate', 'error', 'error_type')
+                       if key in item} for item in items]
         })
+        logger.info(f"📚 批量任务已创建: {batch_id} ({accepted} 个任务, "
+                    f"{sum(1 for item in items if item.get('duplicate'))} 个重复, "
+                    f"{sum(1 for item in items if 'error' in item)} 个失败)")
         
+        return jsonify({
+            'batch_id': batch_id,
+            'accepted': accepted,
+            'items': items
+        })
+    
     except Exception as e:
-        logger.error(f"启动下载时出错: {str(e)}")
+        logger.error(f"创建批量下载时出错: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@bp.route('/progress/<download_id>')
-def get_progress(download_id):
-    """获取下载进度"""
-    if download_id in download_progress:
-        progress = download_progress[download_id]
+def build_batch_payload(batch_id):
+    """汇总批次内所有任务的进度，批次不存在时返回 None"""
+    batch = get_job_store().get(batch_id)
+    if batch is None or batch.get('status') != 'batch':
+        return None
+    
+    items = []
+    jobs = {}
+    counts = {}
+    for item in batch['items']:
+        download_id = item.get('download_id')
+        if download_id is None:
+            items.append(dict(item, status='failed', final=True))
+            continue
+        if download_id not in jobs:
+            progress = build_progress_payload(download_id) or {
+                'status': 'failed', 'error': '任务已过期', 'error_type': 'expired', 'final': True}
+            jobs[download_id] = progress
+            counts[progress['status']] = counts.get(progress['status'], 0) + 1
+        progress = jobs[download_id]
+        entry = {'url': item['url'], 'download_id': download_id}
+        if item.get('duplicate'):
+            entry['duplicate'] = True
+        for key in ('status', 'percent', 'message', 'queue_position', 'filename', 'download_url',
+                    'error', 'error_type', 'final'):
+            if key in progress:
+                entry[key] = progress[key]
+        items.append(entry)
+    
+    # 已结束（完成/失败/取消）的任务按100%计入总进度
+    finished = [progress for progress in jobs.values() if is_final_progress(progress)]
+    percent = sum(100 if is_final_progress(progress) else progress.get('percent', 0)
+                  for progress in jobs.values()) / len(jobs) if jobs else 100
+    return {
+        'batch_id': batch_id,
+        'total': len(jobs),
+        'counts': counts,
+        'completed': counts.get('completed', 0),
+        'finished': len(finished),
+        'percent': round(percent, 1),
+        'done': len(finished) == len(jobs),
+        # 已完成的文件可以打包下载（未完成的任务不包含在内）
+        'archive_url': f'/download-archive/{batch_id}' if counts.get('completed') else None,
+        'items': items
+    }
+
+@bp.route('/batch/<batch_id>')
+def get_batch_progress(batch_id):
+    """批量下载的汇总进度，替代逐个任务轮询"""
+    payload = build_batch_payload(batch_id)
+    if payload is None:
+        return jsonify({'error': '批次ID不存在'}), 404
+    return jsonify(payload)
+
+@bp.route('/batch/<batch_id>/stream')
+def stream_batch_progress(batch_id):
+    """SSE推送批量下载的汇总进度；一个连接代替每个任务各一个连接（浏览器对同一域名的连接数有限制）"""
+    if build_batch_payload(batch_id) is None:
+        return jsonify({'error': '批次ID不存在'}), 404
+    
+    download_ids = {item['download_id'] for item in get_job_store().get(batch_id)['items'] if 'download_id' in item}
+    scheduler = get_scheduler()
+    
+    def batch_version():
+        return sum(progress_version(download_id) for download_id in download_ids)
+    
+    def generate():
+        sent_payload = None
+        deadline = time.time() + SSE_MAX_STREAM_DURATION
+        last_write = time.time()
         
-        # 如果下载完成，提供下载链接
-        if progress['status'] == 'completed' and 'file_path' in progress:
-            file_path = progress['file_path']
-            if os.path.exists(file_path):
-                filename = os.path.basename(file_path)
-                progress['download_url'] = f'/download-file/{download_id}'
-                progress['filename'] = filename
+        yield 'retry: 2000\n\n'
         
-        return jsonify(progress)
-    else:
+        while time.time() < deadline and scheduler.accepting:
+            version = batch_version()
+            progress = build_batch_payload(batch_id)
+            if progress is None:
+                yield f"event: error\ndata: {json.dumps({'error': '批次ID不存在'}, ensure_ascii=False)}\n\n"
+                return
+            
+            payload = json.dumps(progress, ensure_ascii=False)
+            if payload != sent_payload:
+                yield f"event: progress\ndata: {payload}\n\n"
+                sent_payload = payload
+                last_write = time.time()
+            
+            if progress['done']:
+                return
+            
+            # 排队位置需要定期刷新；共享任务存储中的任务可能由其他worker进程更新
+            timeout = 1 if get_job_store().shared else 2
+            with progress_condition:
+                progress_condition.wait_for(
+                    lambda: batch_version() != version or not scheduler.accepting,
+                    timeout=timeout
+                )
+            if time.time() - last_write >= SSE_HEARTBEAT_INTERVAL:
+                yield ': heartbeat\n\n'
+                last_write = time.time()
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@bp.route('/cancel/<download_id>', methods=['POST'])
+def cancel_download(download_id):
+    """取消下载：排队中的任务直接出队，运行中的任务中止yt-dlp传输并终止ffmpeg"""
+    job_store = get_job_store()
+    progress = job_store.get(download_id)
+    if progress is None or progress['status'] == 'batch':
         return jsonify({'error': '下载ID不存在'}), 404
+    
+    if progress['status'] in ('completed', 'failed', 'cancelled') or progress.get('client_cancelled'):
+        return jsonify({'download_id': download_id, 'status': progress['status'], 'cancelled': False})
+    
+    # 跟随者：只脱离主任务，不影响其他用户
+    if 'leader_id' in progress:
+        job_store.update(download_id, {'status': 'cancelled', 'message': '下载已取消', 'final': True},
+                         remove=('leader_id',))
+        notify_progress(download_id)
+        logger.info(f"🛑 跟随任务已取消: {download_id}")
+        return jsonify({'download_id': download_id, 'status': 'cancelled', 'cancelled': True})
+    
+    # 仍有跟随者在等待该任务的结果时不中止传输
+    if any(other.get('leader_id') == download_id for _, other in job_store.items()):
+        job_store.update(download_id, {'client_cancelled': True})
+        notify_progress(download_id)
+        logger.info(f"🛑 任务发起者已取消，跟随者仍在等待，继续下载: {download_id}")
+        return jsonify({'download_id': download_id, 'status': 'cancelled', 'cancelled': True})
+    
+    # 任务可能由其他worker进程执行：在任务存储中记录取消请求，由执行进程的取消标志检测到
+    job_store.update(download_id, {'cancel_requested': True})
+    job = active_jobs.get(download_id)
+    if job is not None:
+        job['cancel_event'].set()
+    
+    if get_scheduler().cancel(download_id) or cancel_deferred_job(download_id):
+        # 尚未开始执行，直接出队；删除检查点，重启后不再恢复
+        active_jobs.pop(download_id, None)
+        checkpoint = job.get('checkpoint') if job is not None else None
+        if checkpoint is not None:
+            checkpoint.finish()
+            shutil.rmtree(checkpoint.work_dir, ignore_errors=True)
+        if progress.get('inflight_key'):
+            job_store.release_claim(progress['inflight_key'], download_id)
+        job_store.update(download_id, {'status': 'cancelled', 'message': '下载已取消', 'final': True})
+        notify_progress(download_id)
+        logger.info(f"🛑 排队任务已取消: {download_id}")
+        return jsonify({'download_id': download_id, 'status': 'cancelled', 'cancelled': True})
+    
+    # 运行中：进度回调会在下一次回调时中止传输；正在合并时直接终止ffmpeg
+    if job is not None and job.get('temp_dir'):
+        terminate_ffmpeg_processes(job_part_dir(job['temp_dir']))
+    job_store.update(download_id, {'message': '正在取消下载...'})
+    notify_progress(download_id)
+    logger.info(f"🛑 正在取消运行中的任务: {download_id}")
+    return jsonify({'download_id': download_id, 'status': 'cancelling', 'cancelled': True})
 
 @bp.route('/download-file/<download_id>')
 def download_file(download_id):
     """三端兼容的文件下载接口 - 彻底修复版"""
     try:
-        if download_id not in download_progress:
+        progress = sync_follower_progress(download_id)
+        if progress is None:
             logger.warning(f"下载ID不存在: {download_id}")
             return jsonify({'error': '下载ID不存在或已过期'}), 404
             
-        progress = download_progress[download_id]
         if 'file_path' not in progress or not os.path.exists(progress['file_path']):
             logger.warning(f"文件不存在: {download_id}")
             return jsonify({'error': '文件不存在或已被清理'}), 404
@@ -245,137 +1212,114 @@ def download_file(download_id):
         is_ios = any(ios in user_agent for ios in ['iphone', 'ipad', 'ipod'])
         is_android = 'android' in user_agent
         is_safari = 'safari' in user_agent and 'chrome' not in user_agent
-        is_chrome = 'chrome' in user_agent
         is_wechat = 'micromessenger' in user_agent
         
         device_info = f"Mobile={is_mobile}, iOS={is_ios}, Android={is_android}, Safari={is_safari}, WeChat={is_wechat}"
+        
+        # 传输期间持有缓存引用，防止文件被淘汰
+        result_cache = get_result_cache()
+        
+        def pin_file():
+            """增加缓存引用，返回只生效一次的释放函数"""
+            if result_cache is None or not result_cache.contains_path(file_path):
+                return lambda: None
+            result_cache.acquire(file_path)
+            pinned = [True]
+            
+            def release():
+                if pinned:
+                    pinned.clear()
+                    result_cache.release(file_path)
+            return release
+        
+        def lease_file(seconds):
+            """交给前端代理发送：释放缓存引用前先租用，代理发送期间不被淘汰"""
+            if result_cache is not None and result_cache.contains_path(file_path):
+                result_cache.lease(file_path, seconds)
+        
+        release_file = pin_file()
         logger.info(f"📱 文件下载请求: {filename} ({file_size / 1024 / 1024:.2f} MB) - {device_info}")
         
+        # 🔥新增：文件传输完成后的回调日志
+        def log_transfer_complete():
+            release_file()
+            try:
+                logger.info(f"📤 文件传输完成: {filename} -> {device_info}")
+            except:
+                pass
+        
+        delivery = get_file_delivery()
+        
         try:
             # 🔥核心修复：根据设备类型采用不同的文件传输策略
+            # 各设备分支只决定内容类型、打开方式和缓存策略；Content-Length、Accept-Ranges、
+            # ETag 和 Range/If-Range 由 delivery.send 统一处理，200/206/416 响应头保持一致
             if is_mobile:
-                # 移动端优化传输
-                response = send_file(
-                    file_path,
-                    as_attachment=True,
-                    download_name=filename,
-                    mimetype='application/octet-stream'  # 通用二进制类型，确保下载而不是播放
-                )
-                
                 # 🔥移动端关键响应头 - 确保浏览器正确处理下载
-                response.headers['Content-Type'] = 'application/octet-stream'
-                response.headers['Content-Disposition'] = f'attachment; filename="{filename}"; filename*=UTF-8\'\'{filename}'
-                response.headers['Content-Length'] = str(file_size)
-                response.headers['Accept-Ranges'] = 'bytes'
-                response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-                response.headers['Pragma'] = 'no-cache'
-                response.headers['Expires'] = '0'
+                headers = {
+                    'Content-Type': 'application/octet-stream',  # 通用二进制类型，确保下载而不是播放
+                    'Content-Disposition': content_disposition('attachment', filename),
+                    'Cache-Control': 'no-cache, no-store, must-revalidate',
+                    'Pragma': 'no-cache',
+                    'Expires': '0',
+                }
                 
                 # iOS Safari 特殊处理
                 if is_ios:
-                    response.headers['Content-Type'] = 'video/mp4'  # iOS Safari 可能需要正确的视频类型
-                    # 移除强制下载，让Safari以播放方式打开，用户可以选择下载
-                    response.headers['Content-Disposition'] = f'inline; filename="{filename}"'
+                    headers['Content-Type'] = 'video/mp4'  # iOS Safari 可能需要正确的视频类型
+                    # 移除强制下载，让Safari以播放方式打开，用户可以选择下载；播放时靠Range请求拖动进度
+                    headers['Content-Disposition'] = content_disposition('inline', filename)
                 
                 # 微信浏览器特殊处理
                 elif is_wechat:
-                    response.headers['Content-Type'] = 'video/mp4'
-                    response.headers['Content-Disposition'] = f'inline; filename="{filename}"'
-                
-                # Android Chrome 优化
-                elif is_android and is_chrome:
-                    response.headers['Content-Type'] = 'application/octet-stream'
-                    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-                    # Android Chrome 需要正确的文件大小
-                    response.headers['Content-Length'] = str(file_size)
+                    headers['Content-Type'] = 'video/mp4'
+                    headers['Content-Disposition'] = content_disposition('inline', filename)
                 
                 logger.info(f"✅ 移动端({device_info})文件传输开始: {filename}")
                 
             else:
-                # PC端标准传输
-                response = send_file(
-                    file_path,
-                    as_attachment=True,
-                    download_name=filename,
-                    mimetype='video/mp4'
-                )
-                
                 # PC端优化响应头
-                response.headers['Content-Type'] = 'video/mp4'
-                response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-                response.headers['Content-Length'] = str(file_size)
-                response.headers['Accept-Ranges'] = 'bytes'
-                response.headers['Cache-Control'] = 'public, max-age=0'
+                headers = {
+                    'Content-Type': 'video/mp4',
+                    'Content-Disposition': content_disposition('attachment', filename),
+                    'Cache-Control': 'public, max-age=0',
+                }
                 
                 logger.info(f"✅ PC端文件传输开始: {filename}")
             
-            # 🔥优化：延迟清理，给不同设备足够的下载时间
-            def delayed_cleanup():
-                # 移动端需要更长的清理延迟
-                delay_time = 60 if is_mobile else 30  # 移动端60秒，PC端30秒
-                time.sleep(delay_time)
-                
-                if download_id in download_progress:
-                    try:
-                        # 清理临时文件
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            logger.info(f"🗑️ 临时文件已删除: {filename}")
-                            
-                        # 尝试清理临时目录
-                        temp_dir = os.path.dirname(file_path)
-                        if os.path.exists(temp_dir) and temp_dir != tempfile.gettempdir():
-                            try:
-                                os.rmdir(temp_dir)
-                                logger.info(f"🗑️ 临时目录已删除: {temp_dir}")
-                            except OSError:
-                                logger.info(f"⚠️ 临时目录非空，跳过删除: {temp_dir}")
-                                
-                        # 清理进度记录
-                        del download_progress[download_id]
-                        logger.info(f"🧹 延迟清理完成: {download_id} (延迟{delay_time}秒)")
-                        
-                    except Exception as e:
-                        logger.warning(f"清理文件时出错: {e}")
-            
-            # 启动延迟清理线程
-            cleanup_thread = threading.Thread(target=delayed_cleanup)
-            cleanup_thread.daemon = True
-            cleanup_thread.start()
+            response = delivery.send(file_path, request.environ, Response, headers, on_close=log_transfer_complete,
+                                     on_offload=lease_file)
+            if response.status_code == 206:
+                logger.info(f"✂️ 分段传输: {filename} {response.headers.get('Content-Range', '多区间')}")
             
-            # 🔥新增：文件传输完成后的回调日志
-            def log_transfer_complete():
-                try:
-                    logger.info(f"📤 文件传输完成: {filename} -> {device_info}")
-                except:
-                    pass
+            # 记录取走时间：文件和进度记录由定期清理（reaper.py）在最后一次下载后保留一段时间再删除，
+            # 期间中断的下载可以用Range续传
+            get_job_store().update(download_id, {'fetched_at': time.time()})
             
-            # 为响应添加完成回调
-            response.call_on_close(log_transfer_complete)
+            # 文件已交给前端代理发送：响应体为空，worker线程立即返回
+            if delivery.is_offloaded(response):
+                logger.info(f"🚀 文件交给前端代理发送: {filename}")
             
+            # 直接发送时缓存引用在服务器关闭文件（传输结束或连接中断）时释放；交给代理时改为租约，见 file_delivery.py
             return response
             
         except Exception as file_error:
             logger.error(f"文件传输出错: {file_error}")
-            # 🔥备用方案：如果send_file失败，尝试流式传输
+            # 🔥备用方案：如果构造文件响应失败，直接流式传输
+            stream_release = pin_file()
+            release_file()
             try:
-                def generate_file_stream():
-                    with open(file_path, 'rb') as f:
-                        chunk_size = 8192 if is_mobile else 65536  # 移动端使用较小的块大小
-                        while True:
-                            chunk = f.read(chunk_size)
-                            if not chunk:
-                                break
-                            yield chunk
-                
-                from flask import Response
+                # 同样交给服务器的 file_wrapper 发送（支持时使用 sendfile），不在Python中逐块读取
+                file_stream = wrap_file(request.environ, delivery.open(file_path, stream_release), DIRECT_BLOCK_SIZE)
                 response = Response(
-                    generate_file_stream(),
+                    file_stream,
+                    direct_passthrough=True,
                     headers={
                         'Content-Type': 'application/octet-stream' if is_mobile else 'video/mp4',
-                        'Content-Disposition': f'attachment; filename="{filename}"',
+                        'Content-Disposition': content_disposition('attachment', filename),
                         'Content-Length': str(file_size),
-                        'Accept-Ranges': 'bytes',
+                        # 备用方案只发送完整文件
+                        'Accept-Ranges': 'none',
                         'Cache-Control': 'no-cache' if is_mobile else 'public, max-age=0'
                     }
                 )
@@ -384,6 +1328,7 @@ def download_file(download_id):
                 return response
                 
             except Exception as stream_error:
+                stream_release()
                 logger.error(f"流式传输也失败: {stream_error}")
                 return jsonify({'error': f'文件传输失败: {str(stream_error)}'}), 500
         
@@ -391,6 +1336,75 @@ def download_file(download_id):
         logger.error(f"下载文件接口出错: {e}")
         return jsonify({'error': f'服务器错误: {str(e)}'}), 500
 
+@bp.route('/download-archive/<archive_id>')
+def download_archive(archive_id):
+    """把批量任务（或单个任务）已完成的文件实时打包为ZIP下载
+    
+    只存储不压缩、边读边发，不生成临时压缩包；总大小预先算出，发送 Content-Length，浏览器可以显示进度
+    """
+    try:
+        job_store = get_job_store()
+        record = job_store.get(archive_id)
+        if record is None:
+            return jsonify({'error': '下载ID不存在或已过期'}), 404
+        
+        if record['status'] == 'batch':
+            download_ids = list(dict.fromkeys(item['download_id'] for item in record['items'] if 'download_id' in item))
+        else:
+            download_ids = [archive_id]
+        
+        # 只打包已完成的文件，批次中仍在下载的任务不等待
+        file_paths = []
+        for download_id in download_ids:
+            progress = sync_follower_progress(download_id)
+            if progress and progress['status'] == 'completed' and os.path.exists(progress.get('file_path', '')):
+                file_paths.append(progress['file_path'])
+        if not file_paths:
+            return jsonify({'error': '没有已完成的文件'}), 404
+        
+        # 传输期间持有缓存引用，防止文件被淘汰
+        result_cache = get_result_cache()
+        pinned = [path for path in file_paths if result_cache is not None and result_cache.contains_path(path)]
+        for path in pinned:
+            result_cache.acquire(path)
+        
+        def release_files():
+            for path in pinned:
+                result_cache.release(path)
+            pinned.clear()
+        
+        try:
+            archive = ZipStream([(os.path.basename(path), path) for path in file_paths])
+        except OSError as e:
+            release_files()
+            logger.warning(f"打包文件失败: {e}")
+            return jsonify({'error': '文件不存在或已被清理'}), 404
+        
+        if record['status'] == 'batch':
+            archive_name = f'{archive_id}.zip'
+        else:
+            archive_name = f'{os.path.splitext(os.path.basename(file_paths[0]))[0]}.zip'
+        logger.info(f"📦 打包下载: {archive_name} ({len(file_paths)}/{len(download_ids)} 个文件, "
+                    f"{len(archive) / 1024 / 1024:.2f} MB)")
+        
+        def on_close():
+            archive.close()
+            release_files()
+            logger.info(f"📤 打包传输结束: {archive_name}")
+        
+        response = Response(iter(archive), mimetype='application/zip')
+        response.headers['Content-Length'] = str(len(archive))
+        response.headers['Content-Disposition'] = content_disposition('attachment', archive_name, fallback='videos.zip')
+        response.headers['Cache-Control'] = 'no-cache'
+        # 禁止nginx缓冲到磁盘，否则大压缩包会在代理上占用同样大小的临时空间
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.call_on_close(on_close)
+        return response
+    
+    except Exception as e:
+        logger.error(f"打包下载接口出错: {e}")
+        return jsonify({'error': f'服务器错误: {str(e)}'}), 500
+
 def get_progress_message(progress_info):
     """根据进度信息生成消息"""
     status = progress_info['status']
@@ -406,9 +1420,38 @@ def get_progress_message(progress_info):
         return '下载完成'
     elif status == 'failed':
         return f'下载失败: {progress_info.get("error", "未知错误")}'
+    elif status == 'queued':
+        return '正在排队等待下载...'
+    elif status == 'cancelled':
+        return '下载已取消'
     else:
         return '正在准备下载...'
 
+@bp.route('/scheduler-stats')
+def scheduler_stats():
+    """调度器和下载进程池运行状态"""
+    stats = get_scheduler().stats()
+    pool = get_process_pool()
+    stats['process_pool'] = pool.stats() if pool else None
+    stats['hosts'] = get_host_limiter().stats()
+    stats['disk'] = get_disk_budget().stats()
+    return jsonify(stats)
+
+@bp.route('/cache-stats')
+def cache_stats():
+    """元数据缓存和结果缓存命中统计"""
+    result_cache = get_result_cache()
+    return jsonify({
+        'metadata': get_metadata_cache().stats(),
+        'results': result_cache.stats() if result_cache else None
+    })
+
+@bp.route('/reaper-stats')
+def reaper_stats():
+    """定期清理的回收统计和工作目录占用"""
+    reaper = get_reaper()
+    return jsonify(reaper.stats() if reaper else None)
+
 @bp.route('/test')
 def test():
     return "Flask 应用运行正常！"
\ No newline at end of file
@@ -0,0 +1,358 @@
+"""
+下载任务调度器 - 固定大小的工作线程池 + 有界等待队列
+避免突发请求时无限制地同时启动 yt-dlp / ffmpeg 进程
+按平台限制并发数和开始速率，受限平台的任务继续排队，其他平台的任务可以越过它先执行
+排队顺序为短任务优先：按预估文件大小排序，等待时间越长优先级越高，大任务不会被无限推后
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+from .rate_limit import DEFAULT_PLATFORM_LIMITS, create_limiter
+
+logger = logging.getLogger(__name__)
+
+# 尚未探测到大小的任务按此大小排序
+DEFAULT_JOB_COST = 200 * 1024 * 1024
+# 只知道时长时按约3Mbps（1080P）估算大小
+ESTIMATED_BYTES_PER_SECOND = 375 * 1024
+# 老化速率：每等待1秒，排序用的预估大小减少的字节数
+DEFAULT_AGING_RATE = 2 * 1024 * 1024
+
+
+def estimate_job_cost(info: Optional[Dict[str, Any]]) -> Optional[int]:
+    """根据视频信息估算下载大小（字节），无法估算时返回 None"""
+    if not info:
+        return None
+    if info.get('filesize'):
+        return int(info['filesize'])
+    if info.get('duration'):
+        return int(float(info['duration']) * ESTIMATED_BYTES_PER_SECOND)
+    return None
+
+
+class QueueFullError(Exception):
+    """等待队列已满，调用方应返回 429 并附带 Retry-After"""
+
+    def __init__(self, retry_after: int):
+        super().__init__('下载队列已满，请稍后再试')
+        self.retry_after = retry_after
+
+
+class SchedulerClosedError(Exception):
+    """进程正在平滑退出，不再接受新任务，调用方应返回 503 让客户端重试到其他worker"""
+
+    def __init__(self):
+        super().__init__('服务正在重启，请稍后再试')
+
+
+class JobScheduler:
+    def __init__(self, max_workers: int = 4, max_queue: int = 50,
+                 platform_limits: Optional[Dict[str, Dict[str, Any]]] = None,
+                 aging_rate: float = DEFAULT_AGING_RATE, probe_workers: int = 2,
+                 shared_dir: Optional[str] = None):
+        self.max_workers = max(1, int(max_workers))
+        # 刚提交、即将开始执行的任务也要先进入等待队列，至少为1
+        self.max_queue = max(1, int(max_queue))
+        self.aging_rate = float(aging_rate)
+        self.probe_workers = max(1, int(probe_workers))
+        # 指定 shared_dir 时平台限制和 max_workers 由共享该目录的所有worker进程合计，而不是每个进程各自一份
+        self.platform_limiter = create_limiter(platform_limits or DEFAULT_PLATFORM_LIMITS, '平台', shared_dir,
+                                               total=self.max_workers)
+
+        self._cond = threading.Condition()
+        self._queue = deque()          # 等待中的任务ID，按提交顺序；执行顺序见 _ordered_locked
+        self._tasks: Dict[str, Callable[[], Any]] = {}
+        self._platforms: Dict[str, str] = {}
+        self._costs: Dict[str, int] = {}
+        self._submitted: Dict[str, float] = {}
+        # 放回队列的任务在此时间之前不会被取出
+        self._not_before: Dict[str, float] = {}
+        self._running = set()
+        # 运行中任务的原始提交时间，以及执行中要求放回队列的任务
+        self._started: Dict[str, float] = {}
+        self._requeued: Dict[str, tuple] = {}
+        self._workers = []
+        # 元数据探测任务使用独立的线程，不会排在长时间下载任务后面
+        self._probe_queue = deque()
+        self._probe_workers = []
+        self.accepting = True
+
+        # 统计信息，用于估算 Retry-After
+        self._completed = 0
+        self._total_runtime = 0.0
+
+    def _ensure_workers(self):
+        """懒启动工作线程，避免 Flask reloader 父进程中也启动线程"""
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._worker_loop,
+                name=f"download-worker-{len(self._workers) + 1}",
+                daemon=True,
+            )
+            self._workers.append(worker)
+            worker.start()
+
+    def _ensure_probe_workers(self):
+        while len(self._probe_workers) < self.probe_workers:
+            worker = threading.Thread(
+                target=self._probe_loop,
+                name=f"probe-worker-{len(self._probe_workers) + 1}",
+                daemon=True,
+            )
+            self._probe_workers.append(worker)
+            worker.start()
+
+    def submit(self, job_id: str, func: Callable[[], Any], platform: str = 'unknown',
+               cost: Optional[int] = None) -> int:
+        """提交任务，返回排队位置（0 表示会立即开始执行）
+
+        cost 为预估下载大小（字节），未知时可以稍后通过 set_cost 补充
+        """
+        with self._cond:
+            if not self.accepting:
+                raise SchedulerClosedError()
+            # 只看等待队列：受平台并发限制时运行中的任务可能一直少于 max_workers，不能以此放行
+            if len(self._queue) >= self.max_queue:
+                raise QueueFullError(self._estimate_retry_after())
+
+            self._ensure_workers()
+            self._tasks[job_id] = func
+            self._platforms[job_id] = platform
+            self._costs[job_id] = DEFAULT_JOB_COST if cost is None else int(cost)
+            self._submitted[job_id] = time.time()
+            self._queue.append(job_id)
+            position = self._position_locked(job_id)
+            self._cond.notify()
+
+        logger.info(f"📥 任务入队: {job_id} (排队位置: {position}, 运行中: {len(self._running)}/{self.max_workers})")
+        return position
+
+    def requeue(self, job_id: str, func: Callable[[], Any], platform: str = 'unknown',
+                cost: Optional[int] = None, delay: float = 0.0):
+        """把任务放回等待队列（如等待磁盘空间），delay 秒后才会再次执行，期间工作线程可以执行其他任务
+
+        由任务自己在执行中调用时，任务返回后才放回队列。任务已被接受过，不受队列上限和停止接受新任务的限制；
+        保留原来的提交时间，老化不会重新计算
+        """
+        with self._cond:
+            entry = (func, platform, cost, delay)
+            if job_id in self._running:
+                self._requeued[job_id] = entry
+            else:
+                self._enqueue_locked(job_id, entry, time.time())
+                self._cond.notify()
+
+    def _enqueue_locked(self, job_id: str, entry: tuple, submitted: float):
+        func, platform, cost, delay = entry
+        self._tasks[job_id] = func
+        self._platforms[job_id] = platform
+        self._costs[job_id] = DEFAULT_JOB_COST if cost is None else int(cost)
+        self._submitted[job_id] = submitted
+        self._not_before[job_id] = time.time() + delay
+        self._queue.append(job_id)
+
+    def submit_probe(self, job_id: str, func: Callable[[], Any]):
+        """提交元数据探测任务（获取时长/大小用于排序），优先于所有下载任务执行"""
+        with self._cond:
+            if not self.accepting:
+                return
+            self._ensure_probe_workers()
+            self._probe_queue.append((job_id, func))
+            self._cond.notify_all()
+
+    def set_cost(self, job_id: str, cost: Optional[int]) -> bool:
+        """更新排队中任务的预估大小"""
+        if cost is None:
+            return False
+        with self._cond:
+            if job_id not in self._costs:
+                return False
+            self._costs[job_id] = int(cost)
+        logger.info(f"📏 任务预估大小: {job_id} ({cost / 1024 / 1024:.1f} MB)")
+        return True
+
+    def close(self):
+        """停止接受新任务；已入队和运行中的任务继续执行直到完成"""
+        with self._cond:
+            self.accepting = False
+        logger.info(f"🚪 调度器停止接受新任务 (运行中: {len(self._running)}, 排队: {len(self._queue)})")
+
+    def wait_idle(self, timeout: Optional[float] = None, heartbeat: Optional[Callable[[], Any]] = None) -> bool:
+        """等待所有任务执行完毕，超时返回 False；heartbeat 每秒调用一次，用于向进程管理器报活"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queue or self._running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(1 if remaining is None else min(1, remaining))
+                if heartbeat is not None:
+                    heartbeat()
+        return True
+
+    def cancel(self, job_id: str) -> bool:
+        """从等待队列中移除尚未开始的任务"""
+        with self._cond:
+            if job_id in self._tasks and job_id in self._queue:
+                self._queue.remove(job_id)
+                self._forget_locked(job_id)
+                return True
+        return False
+
+    def queue_position(self, job_id: str) -> Optional[int]:
+        """返回任务在队列中的位置，1 表示下一个执行；不在队列中返回 None"""
+        with self._cond:
+            if job_id not in self._queue:
+                return None
+            return self._position_locked(job_id)
+
+    def _forget_locked(self, job_id: str):
+        del self._tasks[job_id]
+        del self._costs[job_id]
+        self._not_before.pop(job_id, None)
+        return self._platforms.pop(job_id), self._submitted.pop(job_id)
+
+    def _ordered_locked(self):
+        """按 预估大小 - 老化量 排序的等待任务，相同时先提交的在前"""
+        now = time.time()
+        return sorted(self._queue, key=lambda job_id: (
+            self._costs[job_id] - self.aging_rate * (now - self._submitted[job_id]),
+            self._submitted[job_id],
+        ))
+
+    def _position_locked(self, job_id: str) -> int:
+        index = self._ordered_locked().index(job_id)
+        free_slots = self.max_workers - len(self._running)
+        return max(0, index + 1 - free_slots)
+
+    def _estimate_retry_after(self) -> int:
+        """根据历史平均耗时估算队列腾出空位所需时间（秒）"""
+        avg_runtime = self._total_runtime / self._completed if self._completed else 60.0
+        waves = (len(self._queue) // self.max_workers) + 1
+        return int(min(600, max(5, avg_runtime * waves / 2)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'accepting': self.accepting,
+                'running': len(self._running),
+                'queued': len(self._queue),
+                'probes_queued': len(self._probe_queue),
+                'aging_rate': self.aging_rate,
+                'completed': self._completed,
+                'avg_runtime': round(self._total_runtime / self._completed, 2) if self._completed else 0,
+                'platforms': self.platform_limiter.stats(),
+            }
+
+    def _next_job_locked(self):
+        """按排队顺序找出第一个所属平台未受限的任务，返回 (任务ID, None)；
+        全部受限时返回 (None, 最短等待秒数)，只受并发限制时等待秒数为 None（等任务结束时唤醒）
+        """
+        shortest_wait = None
+        blocked = set()
+        rate_limited = set()
+        now = time.time()
+        for job_id in self._ordered_locked():
+            not_before = self._not_before.get(job_id)
+            if not_before is not None and not_before > now:
+                wait = not_before - now
+                shortest_wait = wait if shortest_wait is None else min(shortest_wait, wait)
+                continue
+            platform = self._platforms[job_id]
+            # 放回队列的任务第一次执行时已经消耗过速率令牌，重试只占用并发名额，不会挤占新任务的令牌
+            retry = not_before is not None
+            if platform in blocked or (platform in rate_limited and not retry):
+                continue
+            wait = self.platform_limiter.try_acquire(platform, rate=not retry)
+            if wait == 0:
+                return job_id, None
+            if wait is None:
+                blocked.add(platform)
+            else:
+                rate_limited.add(platform)
+                shortest_wait = wait if shortest_wait is None else min(shortest_wait, wait)
+        # 共享的名额被其他进程释放时本进程不会被唤醒，定期重试
+        poll = self.platform_limiter.poll_interval
+        if blocked and poll is not None:
+            shortest_wait = poll if shortest_wait is None else min(shortest_wait, poll)
+        return None, shortest_wait
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._queue:
+                        job_id, wait = self._next_job_locked()
+                        if job_id is not None:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                self._queue.remove(job_id)
+                func = self._tasks[job_id]
+                platform, submitted = self._forget_locked(job_id)
+                self._started[job_id] = submitted
+                self._running.add(job_id)
+
+            start_time = time.time()
+            try:
+                func()
+            except Exception as e:
+                logger.error(f"任务执行异常: {job_id} - {e}")
+            finally:
+                elapsed = time.time() - start_time
+                self.platform_limiter.release(platform)
+                with self._cond:
+                    self._running.discard(job_id)
+                    submitted = self._started.pop(job_id)
+                    entry = self._requeued.pop(job_id, None)
+                    if entry is not None:
+                        self._enqueue_locked(job_id, entry, submitted)
+                    else:
+                        self._completed += 1
+                        self._total_runtime += elapsed
+                    self._cond.notify_all()
+
+    def _probe_loop(self):
+        while True:
+            with self._cond:
+                while not self._probe_queue:
+                    self._cond.wait()
+                job_id, func = self._probe_queue.popleft()
+            try:
+                func()
+            except Exception as e:
+                logger.warning(f"探测任务失败: {job_id} - {e}")
+
+
+# 全局调度器实例
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def init_scheduler(max_workers: int = 4, max_queue: int = 50,
+                   platform_limits: Optional[Dict[str, Dict[str, Any]]] = None,
+                   aging_rate: float = DEFAULT_AGING_RATE, probe_workers: int = 2,
+                   shared_dir: Optional[str] = None) -> JobScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = JobScheduler(max_workers=max_workers, max_queue=max_queue,
+                                      platform_limits=platform_limits,
+                                      aging_rate=aging_rate, probe_workers=probe_workers,
+                                      shared_dir=shared_dir)
+            shared = '（并发数和平台限流由所有worker进程共享）' if shared_dir else ''
+            logger.info(f"🧵 下载调度器已初始化: {max_workers} 个工作线程, 队列上限 {max_queue}{shared}")
+    return _scheduler
+
+
+def get_scheduler() -> JobScheduler:
+    if _scheduler is None:
+        return init_scheduler()
+    return _scheduler
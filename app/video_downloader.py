@@ -4,9 +4,11 @@
 """
 
 import os
+import copy
 import tempfile
 import logging
 import time
+import threading
 import yt_dlp
 import subprocess
 import sys
@@ -14,6 +16,12 @@ import platform as sys_platform
 from typing import Dict, Any, Optional, Callable
 import requests
 
+from .format_planner import plan_format
+from .cache import canonical_video_id, get_metadata_cache
+from .rate_limit import get_host_limiter
+from .checkpoint import job_part_dir
+from .finalize import finalize_file
+
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -57,8 +65,125 @@ def analyze_bilibili_error(error_msg: str) -> Dict[str, Any]:
             'fatal': False
         }
 
-class ProgressTracker:
+class DownloadFailedError(Exception):
+    """下载失败，携带错误分类信息供进度接口展示"""
+    
+    def __init__(self, user_friendly: str, error_type: str = 'download_failed', fatal: bool = False):
+        super().__init__(user_friendly)
+        self.user_friendly = user_friendly
+        self.error_type = error_type
+        self.fatal = fatal
+
+class DownloadCancelledError(DownloadFailedError):
+    """用户取消了下载"""
+    
     def __init__(self):
+        super().__init__('下载已取消', 'cancelled', True)
+
+def detect_platform(url: str) -> str:
+    """根据链接判断平台：youtube / bilibili / unknown"""
+    if 'youtube.com' in url or 'youtu.be' in url:
+        return 'youtube'
+    if 'bilibili.com' in url or 'b23.tv' in url:
+        return 'bilibili'
+    return 'unknown'
+
+def normalize_bilibili_url(url: str) -> str:
+    """B站链接统一为桌面版并去掉分享跟踪参数；保留分P参数 p，否则多P视频只能下载第一P"""
+    url = url.replace('m.bilibili.com', 'www.bilibili.com')
+    url = url.replace('//bilibili.com', '//www.bilibili.com')
+    if '?' in url:
+        from urllib.parse import parse_qs
+        base, query = url.split('?', 1)
+        page = parse_qs(query.split('#')[0]).get('p')
+        url = f'{base}?p={page[0]}' if page else base
+    return url
+
+def cdn_hosts(info_dict: Optional[Dict[str, Any]], format_spec: Optional[str] = None) -> set:
+    """从已提取的信息中找出下载会连接的CDN主机
+
+    format_spec 为格式规划得到的 'vid+aid' 时只取这两个格式的主机，否则取所有格式的主机
+    """
+    if not info_dict:
+        return set()
+    from urllib.parse import urlparse
+    formats = info_dict.get('formats') or [info_dict]
+    if format_spec:
+        wanted = set(format_spec.split('/')[0].split('+'))
+        selected = [fmt for fmt in formats if fmt.get('format_id') in wanted]
+        formats = selected or formats
+    hosts = set()
+    for fmt in formats:
+        host = urlparse(fmt.get('url') or '').hostname
+        if host:
+            hosts.add(host)
+    return hosts
+
+def terminate_ffmpeg_processes(path_fragment: str) -> int:
+    """终止本进程启动的、命令行中包含指定路径的ffmpeg子进程（仅Linux /proc 可用时）
+    
+    按任务目录匹配，不会误杀其他任务正在进行的合并
+    """
+    if not path_fragment or not os.path.isdir('/proc'):
+        return 0
+    
+    import signal
+    terminated = 0
+    my_pid = str(os.getpid())
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                # 格式: pid (comm) state ppid ...，comm 可能包含空格
+                stat = f.read()
+            ppid = stat[stat.rindex(')') + 2:].split()[1]
+            if ppid != my_pid:
+                continue
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                cmdline = f.read().decode('utf-8', 'replace').split('\0')
+            if 'ffmpeg' in os.path.basename(cmdline[0]) and any(path_fragment in arg for arg in cmdline):
+                os.kill(int(pid), signal.SIGTERM)
+                terminated += 1
+                logger.info(f"🛑 已终止ffmpeg子进程: {pid}")
+        except (OSError, ValueError, IndexError):
+            continue
+    return terminated
+
+def classify_download_error(error: Exception) -> Dict[str, Any]:
+    """根据yt-dlp异常类型 + 关键词规则对单次策略失败进行分类"""
+    from yt_dlp.utils import DownloadError, ExtractorError, GeoRestrictedError, UnsupportedError
+    from yt_dlp.networking.exceptions import HTTPError
+    
+    # DownloadError 只是外层包装，取出真正的异常
+    cause = error
+    if isinstance(error, DownloadError) and error.exc_info and error.exc_info[1] is not None:
+        cause = error.exc_info[1]
+    
+    if isinstance(cause, GeoRestrictedError):
+        return analyze_bilibili_error('geo-restricted')
+    
+    if isinstance(cause, UnsupportedError):
+        return {
+            'user_friendly': '不支持该链接，请检查视频地址是否正确',
+            'error_type': 'unsupported_url',
+            'fatal': True
+        }
+    
+    # 只有提取阶段(页面/API)的404/410才说明视频不存在；媒体CDN的404可能只是签名过期
+    if isinstance(cause, ExtractorError) and isinstance(cause.cause, HTTPError) and cause.cause.status in (404, 410):
+        return {
+            'user_friendly': '视频无法访问，可能已被删除或设为私有',
+            'error_type': 'access_denied',
+            'fatal': True
+        }
+    
+    message = cause.orig_msg if isinstance(cause, ExtractorError) and cause.orig_msg else str(error)
+    return analyze_bilibili_error(message)
+
+class ProgressTracker:
+    def __init__(self, cancel_event: Optional[threading.Event] = None):
+        self.cancel_event = cancel_event
         self.start_time = time.time()
         self.last_percent = 0
         self.progress_callback = None
@@ -72,7 +197,14 @@ class ProgressTracker:
         if callback:
             self.progress_callback = callback
     
+    def check_cancelled(self, d=None):
+        """取消标志已设置时中止yt-dlp的下载/后处理（同时用作postprocessor hook）"""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled('下载已取消')
+    
     def update(self, d):
+        self.check_cancelled()
+        
         if not self.progress_callback or self.is_completed:
             return
             
@@ -184,6 +316,7 @@ class CompletelyFixedVideoDownloader:
             'no_warnings': True,
             'quiet': True,
             'extract_flat': False,
+            'noplaylist': True,  # 每个任务只下载一个视频（多P视频为链接指定的那一P）
             # 🔥性能优化配置
             'socket_timeout': 45,  # 更长的socket超时
             'retries': 3,
@@ -209,8 +342,17 @@ class CompletelyFixedVideoDownloader:
             'ffmpeg_location': None,  # 自动检测FFmpeg位置
         }
     
-    def download_video(self, url: str, output_template: str, progress_callback: Optional[Callable] = None) -> str:
-        """主下载函数 - 彻底修复B站手机/平板端下载"""
+    def download_video(self, url: str, output_template: str, progress_callback: Optional[Callable] = None,
+                       info_dict: Optional[Dict[str, Any]] = None, device_type: str = 'desktop',
+                       cancel_event: Optional[threading.Event] = None,
+                       preferred_format: Optional[str] = None) -> str:
+        """主下载函数 - 彻底修复B站手机/平板端下载
+        
+        info_dict: 预检测阶段已提取的完整信息(含formats)，传入后下载阶段不再重复提取
+        device_type: 请求来源设备类型，用于格式规划
+        cancel_event: 设置后中止下载，抛出 DownloadCancelledError
+        preferred_format: 恢复中断的任务时沿用上次选定的格式，保证 .part 文件可以续传
+        """
         logger.info(f"🎯 开始下载: {url}")
         
         try:
@@ -234,11 +376,7 @@ class CompletelyFixedVideoDownloader:
                 })
             
             # 检测平台
-            platform = 'unknown'
-            if 'youtube.com' in url or 'youtu.be' in url:
-                platform = 'youtube'
-            elif 'bilibili.com' in url or 'b23.tv' in url:
-                platform = 'bilibili'
+            platform = detect_platform(url)
             
             logger.info(f"📱 检测到平台: {platform}")
             
@@ -250,8 +388,12 @@ class CompletelyFixedVideoDownloader:
                 })
             
             # 执行下载
-            return self._execute_download(url, output_template, progress_callback, platform)
+            return self._execute_download(url, output_template, progress_callback, platform, info_dict, device_type,
+                                          cancel_event, preferred_format)
             
+        except DownloadCancelledError:
+            logger.info(f"🛑 下载已取消: {url}")
+            raise
         except Exception as e:
             error_msg = str(e)
             logger.error(f"💀 所有下载策略失败: {error_msg}")
@@ -264,27 +406,28 @@ class CompletelyFixedVideoDownloader:
                     'status': 'failed',
                     'percent': 0,
                     'error': error_msg,
-                    'error_type': 'download_failed',
+                    'error_type': getattr(e, 'error_type', 'download_failed'),
                     'fatal': True,
                     'final': True
                 })
             
             raise
     
-    def _execute_download(self, url: str, output_template: str, progress_callback: Optional[Callable], platform: str) -> str:
+    def _execute_download(self, url: str, output_template: str, progress_callback: Optional[Callable], platform: str,
+                          info_dict: Optional[Dict[str, Any]] = None, device_type: str = 'desktop',
+                          cancel_event: Optional[threading.Event] = None,
+                          preferred_format: Optional[str] = None) -> str:
         """🔥终极修复版下载函数 - 彻底解决B站下载问题"""
         temp_dir = os.path.dirname(output_template)
         
         # 🔥核心修复：确保URL格式正确且不会被转换
         if 'bilibili.com' in url:
-            url = url.replace('m.bilibili.com', 'www.bilibili.com')
-            url = url.replace('//bilibili.com', '//www.bilibili.com')
-            if '?' in url:
-                url = url.split('?')[0]
+            url = normalize_bilibili_url(url)
             logger.info(f"🔧 URL标准化: {url}")
         
-        # 创建专用下载目录
-        download_subdir = os.path.join(temp_dir, f"dl_{int(time.time())}")
+        # 创建专用下载目录 - 名称固定，任务中断后恢复时能找到上次的 .part 文件继续下载
+        # 可配置到单独的根目录（如tmpfs），完成后再落盘到任务目录
+        download_subdir = job_part_dir(temp_dir)
         os.makedirs(download_subdir, exist_ok=True)
         
         logger.info(f"📁 使用下载目录: {download_subdir}")
@@ -340,6 +483,7 @@ class CompletelyFixedVideoDownloader:
                 {
                     'name': '🔧B站音视频ID组合策略(最优质量) - 优化版',
                     'format': '30077+30280/30066+30280/100048+30280/100047+30232/30011+30216/30002+30216',
+                    'raw_format_ids': True,  # 有格式规划结果时由规划器取代
                     'options': {
                         'merge_output_format': 'mp4',
                         'geo_bypass': True,
@@ -435,18 +579,46 @@ class CompletelyFixedVideoDownloader:
                 }
             ]
         
+        # 🧠格式规划：已有formats列表时在本地选出音视频组合，作为首选策略
+        # 盲目级联只作为真正的兜底
+        plan = plan_format(info_dict.get('formats'), device_type) if info_dict else None
+        if plan:
+            primary = strategies[0]
+            strategies = [{
+                'name': f"🧠格式规划策略({plan['description']})",
+                'format': f"{plan['format']}/{primary['format']}",
+                'options': dict(primary['options']),
+            }] + [strategy for strategy in strategies if not strategy.get('raw_format_ids')]
+        
+        # 🔁恢复中断的任务：优先使用上次选定的格式，文件名相同才能续传
+        if preferred_format and preferred_format != strategies[0]['format']:
+            strategies = [{
+                'name': '🔁断点续传策略',
+                'format': preferred_format,
+                'options': dict(strategies[0]['options']),
+            }] + strategies
+        
         last_error = None
         output_template = os.path.join(download_subdir, "%(title)s.%(ext)s")
         
+        # 🚦按CDN主机限制并发和速率，每次尝试策略都占用名额，避免级联重试放大请求量
+        host_limiter = get_host_limiter()
+        hosts = cdn_hosts(info_dict, plan['format'] if plan else None)
+        
         for i, strategy in enumerate(strategies, 1):
             try:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise yt_dlp.utils.DownloadCancelled('下载已取消')
+                
                 logger.info(f"🎯 尝试策略 {i}/{len(strategies)}: {strategy['name']}")
                 
-                if i == 1 and progress_callback:
+                # 每个策略都上报所用格式，检查点记录的是最后实际下载的格式
+                if progress_callback:
                     progress_callback({
                         'status': 'downloading',
                         'percent': 50,
-                        'message': f'正在尝试下载...'
+                        'message': f'正在尝试下载...',
+                        'format': strategy['format']
                     })
                 
                 # 配置下载选项
@@ -454,100 +626,122 @@ class CompletelyFixedVideoDownloader:
                 ydl_opts.update(strategy['options'])
                 ydl_opts['format'] = strategy['format']
                 ydl_opts['outtmpl'] = output_template
+                # 让错误以异常形式抛出，才能分类并决定是否继续级联
+                ydl_opts['ignoreerrors'] = False
                 
                 # 进度跟踪
-                progress_tracker = ProgressTracker()
-                if progress_callback:
-                    progress_tracker.set_callback(progress_callback)
-                    ydl_opts['progress_hooks'] = [progress_tracker.update]
+                progress_tracker = ProgressTracker(cancel_event)
+                progress_tracker.set_callback(progress_callback)
+                ydl_opts['progress_hooks'] = [progress_tracker.update]
+                ydl_opts['postprocessor_hooks'] = [progress_tracker.check_cancelled]
                 
                 # 🔥关键：确保URL不被修改
                 download_url = url
                 
                 start_time = time.time()
                 
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([download_url])
+                if not host_limiter.acquire_many(hosts, cancel_event):
+                    raise yt_dlp.utils.DownloadCancelled('下载已取消')
+                try:
+                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                        if info_dict:
+                            # 🔥复用已提取的信息，只做格式选择和下载，不再请求提取接口
+                            result = ydl.process_ie_result(copy.deepcopy(info_dict), download=True)
+                        else:
+                            result = ydl.extract_info(download_url, download=True)
+                finally:
+                    host_limiter.release_many(hosts)
                 
-                # 检查下载结果
-                files = os.listdir(download_subdir) if os.path.exists(download_subdir) else []
+                # 🎯直接从yt-dlp返回结果中获取最终文件路径，不再扫描目录
+                file_path = self._resolve_downloaded_file(result)
                 
-                if files:
-                    video_files = []
-                    for filename in files:
-                        file_path = os.path.join(download_subdir, filename)
-                        if os.path.isfile(file_path):
-                            size = os.path.getsize(file_path)
-                            # 🎯优化：检查视频文件质量，优先选择大文件（通常质量更好）
-                            if filename.lower().endswith(('.mp4', '.webm', '.mkv', '.avi', '.mov', '.flv', '.m4v')) and size > 1024:
-                                logger.info(f"📦 发现视频文件: {filename} ({size/1024/1024:.1f} MB)")
-                                video_files.append((filename, size, file_path))
+                if file_path:
+                    largest_file = os.path.basename(file_path)
+                    largest_size = os.path.getsize(file_path)
+                    logger.info(f"📦 下载文件: {largest_file} ({largest_size/1024/1024:.1f} MB)")
+                    
+                    # 🔍质量验证：确保下载的是高质量文件
+                    quality_info = ""
+                    if largest_size > 50 * 1024 * 1024:  # 50MB+
+                        quality_info = "🎯高画质"
+                    elif largest_size > 20 * 1024 * 1024:  # 20MB+
+                        quality_info = "📹中画质"
+                    else:
+                        quality_info = "📱标准画质"
                     
-                    if video_files:
-                        # 🎯关键：按文件大小排序，优先选择最大的文件（通常是最高画质）
-                        video_files.sort(key=lambda x: x[1], reverse=True)
-                        largest_file, largest_size, file_path = video_files[0]
+                    # 移动到最终位置：同一文件系统内原子重命名，跨设备时用reflink/copy_file_range
+                    final_path = os.path.join(temp_dir, largest_file)
+                    try:
+                        finalize_file(file_path, final_path)
                         
-                        # 🔍质量验证：确保下载的是高质量文件
-                        quality_info = ""
-                        if largest_size > 50 * 1024 * 1024:  # 50MB+
-                            quality_info = "🎯高画质"
-                        elif largest_size > 20 * 1024 * 1024:  # 20MB+
-                            quality_info = "📹中画质"
-                        else:
-                            quality_info = "📱标准画质"
+                        elapsed = max(time.time() - start_time, 0.001)
+                        
+                        logger.info(f"🎉 下载成功！策略: {strategy['name']}")
+                        logger.info(f"📁 文件: {largest_file} ({largest_size/1024/1024:.2f} MB) - {quality_info}")
+                        logger.info(f"⏱️ 耗时: {elapsed:.1f}秒")
+                        logger.info(f"📊 平均速度: {(largest_size/1024/1024)/elapsed:.1f} MB/s")
+                        
+                        if progress_callback:
+                            progress_callback({
+                                'status': 'completed',
+                                'percent': 100,
+                                'filename': largest_file,
+                                'file_size_mb': largest_size / 1024 / 1024,
+                                'quality_info': quality_info,
+                                'strategy': strategy['name'],
+                                'download_speed': f"{(largest_size/1024/1024)/elapsed:.1f} MB/s",
+                                'final': True
+                            })
                         
-                        # 移动到最终位置
-                        final_path = os.path.join(temp_dir, largest_file)
+                        # 清理下载目录
                         try:
-                            if os.path.exists(final_path):
-                                os.remove(final_path)
-                            
                             import shutil
-                            shutil.move(file_path, final_path)
-                            
-                            elapsed = time.time() - start_time
-                            
-                            logger.info(f"🎉 下载成功！策略: {strategy['name']}")
-                            logger.info(f"📁 文件: {largest_file} ({largest_size/1024/1024:.2f} MB) - {quality_info}")
-                            logger.info(f"⏱️ 耗时: {elapsed:.1f}秒")
-                            logger.info(f"📊 平均速度: {(largest_size/1024/1024)/elapsed:.1f} MB/s")
-                            
-                            if progress_callback:
-                                progress_callback({
-                                    'status': 'completed',
-                                    'percent': 100,
-                                    'filename': largest_file,
-                                    'file_size_mb': largest_size / 1024 / 1024,
-                                    'quality_info': quality_info,
-                                    'strategy': strategy['name'],
-                                    'download_speed': f"{(largest_size/1024/1024)/elapsed:.1f} MB/s",
-                                    'final': True
-                                })
-                            
-                            # 清理下载目录
-                            try:
-                                import shutil
-                                shutil.rmtree(download_subdir)
-                            except:
-                                pass
-                            
-                            return final_path
-                            
-                        except Exception as e:
-                            logger.error(f"移动文件失败: {e}")
-                    else:
-                        logger.warning(f"⚠️ 未发现有效视频文件")
+                            shutil.rmtree(download_subdir)
+                        except:
+                            pass
+                        
+                        return final_path
+                        
+                    except Exception as e:
+                        logger.error(f"移动文件失败: {e}")
                 else:
-                    logger.warning(f"⚠️ 下载目录为空")
+                    logger.warning(f"⚠️ yt-dlp未返回有效的输出文件")
                 
                 logger.info(f"⚠️ 策略 {i} 未产生有效文件，继续下一个")
                 
             except Exception as e:
+                # 🛑用户取消：立即清理并终止，不再尝试其他策略
+                if cancel_event is not None and cancel_event.is_set():
+                    try:
+                        import shutil
+                        shutil.rmtree(download_subdir)
+                    except:
+                        pass
+                    raise DownloadCancelledError()
+                
                 error_msg = str(e)
                 last_error = error_msg
                 logger.info(f"⚠️ 策略 {i} 失败: {error_msg[:100]}...")
                 
+                # 💀致命错误（付费/需登录/无法访问）换策略也不会成功，立即终止级联
+                error_analysis = classify_download_error(e)
+                if error_analysis.get('fatal'):
+                    logger.error(f"💀 致命错误({error_analysis['error_type']})，终止剩余策略")
+                    try:
+                        import shutil
+                        shutil.rmtree(download_subdir)
+                    except:
+                        pass
+                    raise DownloadFailedError(error_analysis['user_friendly'], error_analysis['error_type'], True)
+                
+                # 复用的 info_dict 可能已经过期（签名地址失效、403），后续策略重新提取，缓存同时作废
+                if info_dict is not None:
+                    info_dict = None
+                    video_key = canonical_video_id(url)
+                    if video_key:
+                        get_metadata_cache().invalidate(video_key)
+                    logger.info("🔄 缓存的视频信息可能已过期，后续策略重新提取")
+                
                 if i < len(strategies):
                     logger.info(f"🔄 继续尝试下一个策略...")
                     time.sleep(0.5)
@@ -563,24 +757,58 @@ class CompletelyFixedVideoDownloader:
         # 所有策略都失败
         logger.error(f"💀 所有 {len(strategies)} 个策略都失败")
         error_analysis = analyze_bilibili_error(last_error or '下载失败')
-        raise Exception(error_analysis.get('user_friendly', '所有下载策略都失败，请检查视频链接'))
+        raise DownloadFailedError(
+            error_analysis.get('user_friendly', '所有下载策略都失败，请检查视频链接'),
+            error_analysis.get('error_type', 'download_failed'),
+            error_analysis.get('fatal', False)
+        )
+    
+    def _resolve_downloaded_file(self, result: Optional[Dict[str, Any]]) -> Optional[str]:
+        """从yt-dlp的返回结果(requested_downloads/filepath)中确定最终输出文件"""
+        if not result:
+            return None
+        
+        # 播放列表类型的结果取第一个条目
+        if result.get('_type') == 'playlist':
+            entries = [entry for entry in (result.get('entries') or []) if entry]
+            if not entries:
+                return None
+            result = entries[0]
+        
+        candidates = []
+        for item in result.get('requested_downloads') or []:
+            candidates.append(item.get('filepath') or item.get('_filename'))
+        candidates.append(result.get('filepath'))
+        candidates.append(result.get('_filename'))
+        
+        for path in candidates:
+            if path and os.path.isfile(path) and os.path.getsize(path) > 1024:
+                return path
+        return None
     
     def _get_video_info(self, url: str) -> Dict[str, Any]:
         """获取视频信息 - 彻底修复B站访问问题"""
+        # 🗂️先查元数据缓存，同一视频的重复请求不再访问上游
+        cache = get_metadata_cache()
+        cache_key = canonical_video_id(url)
+        cached = cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            logger.info(f"⚡ 元数据缓存命中: {cache_key}")
+            return dict(cached)
+        
         try:
             # 🔥关键修复：确保URL始终为桌面版格式
             if 'bilibili.com' in url:
-                url = url.replace('m.bilibili.com', 'www.bilibili.com')
-                url = url.replace('//bilibili.com', '//www.bilibili.com')
-                # 移除可能导致问题的参数
-                if '?' in url:
-                    url = url.split('?')[0]
+                # 移除可能导致问题的参数（保留分P参数）
+                url = normalize_bilibili_url(url)
             
             # 🔥新的简化配置 - 专门针对B站JSON解析错误
             ydl_opts = {
                 'quiet': True,
                 'no_warnings': True,
                 'extract_flat': False,
+                # 多P视频/合集只取链接指向的那一个视频，展开分P见 expand_playlist
+                'noplaylist': True,
                 'skip_download': True,
                 'socket_timeout': 30,
                 'retries': 1,
@@ -605,19 +833,26 @@ class CompletelyFixedVideoDownloader:
                     info = ydl.extract_info(url, download=False)
                     
                     if info and info.get('title'):
+                        # 保留完整信息(含formats)，供下载阶段复用，避免二次提取
+                        info = ydl.sanitize_info(info)
                         raw_title = info.get('title', 'Unknown_Video')
                         clean_title = self._clean_filename(raw_title)
                         
                         logger.info(f"✅ 获取视频信息成功")
                         logger.info(f"   标题: {clean_title}")
                         
-                        return {
+                        result = {
                             'title': clean_title,
                             'raw_title': raw_title,
                             'duration': info.get('duration', 0),
                             'uploader': info.get('uploader', ''),
                             'upload_date': info.get('upload_date', ''),
+                            'info_dict': info,
                         }
+                        # 只缓存真正提取成功的结果，兜底标题不缓存；识别不出视频ID的链接不缓存
+                        if cache_key:
+                            cache.set(cache_key, result)
+                        return dict(result)
             except Exception as e:
                 logger.warning(f"⚠️ 获取信息失败，使用默认标题: {str(e)[:50]}...")
             
@@ -643,6 +878,57 @@ class CompletelyFixedVideoDownloader:
             logger.warning(f"❌ 获取视频信息异常: {e}")
             return {'title': 'Unknown_Video', 'raw_title': 'Unknown_Video'}
     
+    def expand_playlist(self, url: str, playlist_items: Optional[str] = None) -> Dict[str, Any]:
+        """展开多P视频、合集、列表为单个视频链接（只读取列表，不提取每个视频的格式）
+        
+        playlist_items: 选择的分P范围，yt-dlp 语法，如 '1-10,15'；为空表示全部
+        """
+        if 'bilibili.com' in url:
+            # 链接中的 p 参数表示单独一P，展开时去掉
+            url = normalize_bilibili_url(url).split('?')[0]
+        
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': 'in_playlist',
+            'noplaylist': False,
+            'skip_download': True,
+            'socket_timeout': 30,
+            'retries': 1,
+            'geo_bypass': True,
+            'nocheckcertificate': True,
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                'Referer': 'https://www.bilibili.com/',
+            }
+        }
+        if playlist_items:
+            ydl_opts['playlist_items'] = playlist_items
+        
+        logger.info(f"📚 展开分P/合集: {url} (范围: {playlist_items or '全部'})")
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        except Exception as e:
+            error_analysis = classify_download_error(e)
+            raise DownloadFailedError(error_analysis['user_friendly'], error_analysis['error_type'],
+                                      error_analysis['fatal'])
+        
+        if info.get('_type') != 'playlist':
+            # 单个视频
+            return {
+                'title': self._clean_filename(info.get('title', '')),
+                'entries': [{'url': url, 'title': info.get('title')}]
+            }
+        
+        entries = []
+        for entry in info.get('entries') or []:
+            entry_url = entry and (entry.get('url') or entry.get('webpage_url'))
+            if entry_url:
+                entries.append({'url': entry_url, 'title': entry.get('title')})
+        logger.info(f"📚 共 {len(entries)} 个视频: {info.get('title', '')}")
+        return {'title': self._clean_filename(info.get('title', '')), 'entries': entries}
+    
     def _clean_filename(self, title: str) -> str:
         """高级文件名清理 - 保留更多原始信息但确保Windows兼容"""
         import re
@@ -714,30 +1000,44 @@ def get_downloader():
         _downloader = CompletelyFixedVideoDownloader()
     return _downloader
 
-def download_video(url: str, output_template: str, progress_callback: Optional[Callable] = None) -> str:
+def download_video(url: str, output_template: str, progress_callback: Optional[Callable] = None,
+                   info_dict: Optional[Dict[str, Any]] = None, device_type: str = 'desktop',
+                   cancel_event: Optional[threading.Event] = None, preferred_format: Optional[str] = None) -> str:
     """公共下载接口"""
     downloader = get_downloader()
-    return downloader.download_video(url, output_template, progress_callback)
+    return downloader.download_video(url, output_template, progress_callback, info_dict, device_type, cancel_event,
+                                     preferred_format)
 
-def get_video_info(url: str) -> Dict[str, Any]:
-    """获取视频信息用于预检测"""
+def get_video_info(url: str, include_info: bool = False) -> Dict[str, Any]:
+    """获取视频信息用于预检测
+    
+    include_info=True 时额外返回 info_dict，供 download_video 复用
+    """
     try:
         downloader = get_downloader()
         info = downloader._get_video_info(url)
         
-        platform = 'unknown'
-        if 'youtube.com' in url or 'youtu.be' in url:
-            platform = 'youtube'
-        elif 'bilibili.com' in url or 'b23.tv' in url:
-            platform = 'bilibili'
+        platform = detect_platform(url)
         
-        return {
+        result = {
             'title': info.get('title', '未知标题'),
             'duration': info.get('duration', 0),
             'platform': platform,
             'uploader': info.get('uploader', ''),
             'available': True
         }
+        # 预估下载大小，供调度器短任务优先排序
+        info_dict = info.get('info_dict')
+        plan = plan_format(info_dict.get('formats'), 'desktop') if info_dict else None
+        if plan and plan.get('filesize'):
+            result['filesize'] = plan['filesize']
+        if include_info:
+            result['info_dict'] = info.get('info_dict')
+        return result
     except Exception as e:
         logger.warning(f"获取视频信息失败: {str(e)}")
         raise Exception("无法获取视频信息，请检查链接是否有效")
+
+def expand_playlist(url: str, playlist_items: Optional[str] = None) -> Dict[str, Any]:
+    """展开多P视频/合集：返回 {'title': 列表标题, 'entries': [{'url', 'title'}]}"""
+    return get_downloader().expand_playlist(url, playlist_items)
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""
+流式ZIP打包 - 边读文件边输出，不生成临时压缩包
+
+- 只存储不压缩（视频本身已压缩，再压缩只浪费CPU），输出大小在开始前即可精确计算，可以发送 Content-Length
+- CRC 在传输过程中计算，写在每个文件数据之后的数据描述符中，无需预先读一遍文件
+- 单个文件或总大小超过 4GB 时自动使用 ZIP64 扩展
+- 内存占用恒定：每次只读取一个数据块
+"""
+
+import os
+import struct
+import time
+import zlib
+from typing import Iterator, List, Tuple
+
+CHUNK_SIZE = 1024 * 1024
+
+# 超过该值的大小/偏移需要 ZIP64 扩展字段，原字段填 0xFFFFFFFF
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+_ZIP64_MARKER = 0xFFFFFFFF
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_RECORD = struct.Struct('<IHHHHIIH')
+_ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+_ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+_MADE_BY_UNIX = 3 << 8
+# 位3：CRC写在数据描述符中；位11：文件名为UTF-8
+_FLAGS = 0x08 | 0x800
+
+
+def _dos_datetime(timestamp: float) -> Tuple[int, int]:
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class _Entry:
+    def __init__(self, name: str, path: str):
+        self.name = name.encode('utf-8')
+        # 先打开文件：传输期间文件被清理/淘汰也不影响已计算好的总大小
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.dos_time, self.dos_date = _dos_datetime(stat.st_mtime)
+        self.zip64 = self.size >= ZIP64_LIMIT
+        self.offset = 0
+        self.crc = 0
+
+    def local_header(self) -> bytes:
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 1, 16, self.size, self.size)
+            size = _ZIP64_MARKER
+        else:
+            extra = b''
+            size = self.size
+        return _LOCAL_HEADER.pack(
+            0x04034b50, _VERSION_ZIP64 if self.zip64 else _VERSION_DEFAULT, _FLAGS, 0,
+            self.dos_time, self.dos_date, 0, size, size, len(self.name), len(extra)
+        ) + self.name + extra
+
+    def local_size(self) -> int:
+        return _LOCAL_HEADER.size + len(self.name) + (20 if self.zip64 else 0) + self.size + self.descriptor_size()
+
+    def descriptor(self) -> bytes:
+        if self.zip64:
+            return struct.pack('<IIQQ', 0x08074b50, self.crc, self.size, self.size)
+        return struct.pack('<IIII', 0x08074b50, self.crc, self.size, self.size)
+
+    def descriptor_size(self) -> int:
+        return 24 if self.zip64 else 16
+
+    def _central_extra(self) -> bytes:
+        fields = []
+        if self.zip64:
+            fields += [self.size, self.size]
+        if self.offset >= ZIP64_LIMIT:
+            fields.append(self.offset)
+        if not fields:
+            return b''
+        return struct.pack(f'<HH{len(fields)}Q', 1, 8 * len(fields), *fields)
+
+    def central_header(self) -> bytes:
+        extra = self._central_extra()
+        size = _ZIP64_MARKER if self.zip64 else self.size
+        version = _VERSION_ZIP64 if extra else _VERSION_DEFAULT
+        return _CENTRAL_HEADER.pack(
+            0x02014b50, _MADE_BY_UNIX | version, version, _FLAGS, 0,
+            self.dos_time, self.dos_date, self.crc, size, size,
+            len(self.name), len(extra), 0, 0, 0, 0o100644 << 16,
+            _ZIP64_MARKER if self.offset >= ZIP64_LIMIT else self.offset
+        ) + self.name + extra
+
+    def central_size(self) -> int:
+        return _CENTRAL_HEADER.size + len(self.name) + len(self._central_extra())
+
+
+class ZipStream:
+    """把一组文件打包为ZIP数据流；len() 为输出的总字节数，迭代得到数据块，用完后需 close()"""
+
+    def __init__(self, files: List[Tuple[str, str]], chunk_size: int = CHUNK_SIZE):
+        """files: [(压缩包内的文件名, 文件路径)]，文件名重复时自动加序号"""
+        self.chunk_size = chunk_size
+        self.entries: List[_Entry] = []
+        names = set()
+        try:
+            for name, path in files:
+                stem, ext = os.path.splitext(name)
+                index = 1
+                while name in names:
+                    index += 1
+                    name = f'{stem} ({index}){ext}'
+                names.add(name)
+                self.entries.append(_Entry(name, path))
+        except OSError:
+            self.close()
+            raise
+
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset += entry.local_size()
+        self.central_offset = offset
+        self.central_size = sum(entry.central_size() for entry in self.entries)
+        self.zip64_end = (len(self.entries) >= ZIP_MAX_ENTRIES or self.central_offset >= ZIP64_LIMIT
+                          or self.central_size >= ZIP64_LIMIT)
+        self.total_size = (self.central_offset + self.central_size + _END_RECORD.size
+                           + (_ZIP64_END_RECORD.size + _ZIP64_END_LOCATOR.size if self.zip64_end else 0))
+
+    def __len__(self) -> int:
+        return self.total_size
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            for entry in self.entries:
+                yield entry.local_header()
+                remaining = entry.size
+                crc = 0
+                while remaining > 0:
+                    chunk = entry.file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        # 文件被截断，已声明的长度无法满足，只能中断传输
+                        raise IOError(f'文件大小发生变化: {entry.name.decode("utf-8")}')
+                    crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    yield chunk
+                entry.crc = crc
+                entry.file.close()
+                yield entry.descriptor()
+
+            yield b''.join(entry.central_header() for entry in self.entries)
+            yield self._end_records()
+        finally:
+            self.close()
+
+    def _end_records(self) -> bytes:
+        count = len(self.entries)
+        if not self.zip64_end:
+            return _END_RECORD.pack(0x06054b50, 0, 0, count, count, self.central_size, self.central_offset, 0)
+
+        # ZIP64 结束记录 + 定位器，原结束记录中的字段填最大值
+        zip64_end_offset = self.central_offset + self.central_size
+        return (_ZIP64_END_RECORD.pack(
+                    0x06064b50, _ZIP64_END_RECORD.size - 12, _MADE_BY_UNIX | _VERSION_ZIP64, _VERSION_ZIP64,
+                    0, 0, count, count, self.central_size, self.central_offset)
+                + _ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1)
+                + _END_RECORD.pack(0x06054b50, 0, 0, ZIP_MAX_ENTRIES, ZIP_MAX_ENTRIES,
+                                   _ZIP64_MARKER, _ZIP64_MARKER, 0))
+
+    def close(self):
+        for entry in self.entries:
+            if not entry.file.closed:
+                entry.file.close()
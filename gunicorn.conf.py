@@ -0,0 +1,92 @@
+"""
+生产环境启动配置：gunicorn -c gunicorn.conf.py run:app
+
+- 多进程（默认每个CPU核心一个worker） + 每进程多线程（gthread），吞吐随核心数扩展
+- 多进程时任务状态必须放在共享存储中，未指定 JOB_STORE 时自动使用 SQLite
+- 平滑退出（部署/重启时收到 SIGTERM 或 HUP）：
+  1. 立即停止接受新的下载任务，结束SSE推送（浏览器会重连到新worker）
+  2. 正在进行的 /download-file 传输由 gunicorn 等待完成
+  3. 已接受的下载任务继续执行直到完成，最长等待 graceful_timeout
+
+容量规划:
+- gthread 下每个打开的进度页面（/progress/<id>/stream、/batch/<id>/stream）在连接期间一直占用一个请求线程，
+  正在进行的 /download-file 传输同样占用一个线程。可同时服务的连接数 = workers × threads，
+  线程用完后新请求（包括轻量接口）会排队。线程大部分时间在等待，默认每进程 64 个；
+  SSE连接默认 300 秒后结束并由浏览器自动重连，断开的客户端不会长期占用线程，重连也会分散到各个worker。
+  同时观看进度的用户更多时调大 WEB_THREADS，或使用 gevent（WEB_WORKER_CLASS=gevent，需要额外安装）
+- 下载并发数（DOWNLOAD_WORKERS）和平台/CDN限流是整台机器的总量：各worker进程通过 RATE_LIMIT_DIR 中的
+  文件锁共享名额和令牌桶，增加 workers 不会增加同时访问B站等平台的会话数。
+  进程池大小（PROCESS_POOL_SIZE）和等待队列长度（DOWNLOAD_QUEUE_SIZE）仍是每个worker进程各自一份
+"""
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '5000')}")
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# gthread 适合本项目：下载在后台线程中进行，请求线程只处理轻量接口和文件传输
+# 也可以设置为 gevent（需要额外安装）
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('WEB_THREADS', 64))
+
+# 多个worker进程时应用在进程之间共享下载并发数和限流
+os.environ.setdefault('WEB_WORKERS', str(workers))
+os.environ.setdefault('SSE_MAX_STREAM_DURATION', '300')
+
+# 普通请求超时；大文件传输和SSE长连接靠心跳维持，不受影响
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+keepalive = 5
+
+# 平滑退出的最长等待时间，超过后强制结束worker
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 300))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+if workers > 1:
+    # 进度查询、取消请求可能落到任意worker上，任务状态需要跨进程共享
+    os.environ.setdefault('JOB_STORE', 'sqlite')
+
+
+# 这些配置是每个worker进程的值，整台机器的总量为其 workers 倍
+PER_WORKER_SETTINGS = ('PROCESS_POOL_SIZE', 'DOWNLOAD_QUEUE_SIZE')
+
+
+def on_starting(server):
+    if workers > 1:
+        for name in PER_WORKER_SETTINGS:
+            if name in os.environ:
+                server.log.warning(f"⚠️ {name}={os.environ[name]} 是每个worker进程的值，"
+                                   f"{workers} 个worker合计为 {workers} 倍")
+    if worker_class == 'gthread':
+        server.log.info(f"🧵 最多同时服务 {workers * threads} 个连接（SSE进度推送和文件传输各占一个）")
+
+
+def post_worker_init(worker):
+    """收到退出信号时先停止接收下载任务；连接处理完毕后再等待下载任务完成才退出进程"""
+    original_handle_exit = worker.handle_exit
+    original_run = worker.run
+
+    def handle_exit(sig, frame):
+        from app.routes import begin_drain
+        worker.drain_deadline = time.time() + graceful_timeout - 5
+        # 信号处理函数中不获取锁，交给独立线程执行
+        threading.Thread(target=begin_drain, name='drain', daemon=True).start()
+        original_handle_exit(sig, frame)
+
+    def run():
+        original_run()
+        deadline = getattr(worker, 'drain_deadline', None)
+        if deadline is not None:
+            from app.routes import wait_for_drain
+            # 等待期间持续向主进程报活，避免被判定为超时而强制结束
+            wait_for_drain(max(0, deadline - time.time()), heartbeat=worker.notify)
+
+    # SIGTERM 的处理函数在 post_worker_init 之前已注册，需要重新注册
+    signal.signal(signal.SIGTERM, handle_exit)
+    worker.run = run
@@ -1,6 +1,11 @@
+import os
+
 from app import create_app
 
 app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # 开发服务器（单进程）。生产环境请使用: gunicorn -c gunicorn.conf.py run:app
+    # reloader 会在父进程中再创建一份应用和全局单例，默认关闭，需要时设置 FLASK_RELOAD=1
+    app.run(debug=True, host='0.0.0.0', port=5000,
+            use_reloader=os.environ.get('FLASK_RELOAD') == '1')
@@ -8,6 +8,7 @@ const state = {
     currentDownloadId: null,
     currentPlatform: null,
     progressInterval: null,
+    progressEventSource: null,
     abortController: null,
     retryCount: 0,
     maxRetries: 3,
@@ -1226,6 +1227,12 @@ function identifyErrorType(errorMessage) {
 // ========================================
 
 function stopProgressPolling() {
+    if (state.progressEventSource) {
+        state.progressEventSource.close();
+        state.progressEventSource = null;
+        console.log('⏹️ 进度推送连接已关闭');
+    }
+    
     if (state.progressInterval) {
         // 🔥修复：支持clearTimeout和clearInterval
         try {
@@ -1303,8 +1310,8 @@ function startProgressPolling() {
             handleProgressUpdate(progressData);
             
             // 🔥修复：只有在明确完成或失败时才停止轮询
-            if (progressData.status === 'completed') {
-                console.log('✅ 任务已完成，停止轮询');
+            if (progressData.status === 'completed' || progressData.status === 'cancelled') {
+                console.log('✅ 任务已结束，停止轮询');
                 stopProgressPolling();
                 return;
             } else if (progressData.status === 'failed' && progressData.final) {
@@ -1316,6 +1323,9 @@ function startProgressPolling() {
             // 🔥优化轮询间隔：根据进度状态调整
             let nextInterval;
             switch (progressData.status) {
+                case 'queued':
+                    nextInterval = 3000; // 排队阶段降低轮询频率
+                    break;
                 case 'starting':
                     nextInterval = 800;  // 启动阶段更频繁检查
                     break;
@@ -1355,17 +1365,74 @@ function startProgressPolling() {
         }
     };
     
+    // 🚀优先使用SSE推送进度，不支持或连接失败时回退到轮询
+    if (window.EventSource) {
+        startProgressStream(pollProgress);
+        return;
+    }
+    
     // 🔥关键：立即开始第一次查询，不等待任何延迟
     console.log('⚡ 立即开始首次进度查询...');
     pollProgress();
 }
 
+function startProgressStream(fallbackToPolling) {
+    const downloadId = state.currentDownloadId;
+    let receivedEvents = 0;
+    
+    console.log('📡 建立进度推送连接:', downloadId);
+    const source = new EventSource(`/progress/${downloadId}/stream`);
+    state.progressEventSource = source;
+    
+    source.addEventListener('progress', (event) => {
+        if (!state.isDownloading || state.currentDownloadId !== downloadId) {
+            stopProgressPolling();
+            return;
+        }
+        
+        receivedEvents++;
+        const progressData = JSON.parse(event.data);
+        console.log('📈 推送进度数据:', progressData);
+        
+        state.lastProgressData = progressData;
+        state.lastProgressTime = Date.now();
+        handleProgressUpdate(progressData);
+        
+        if (progressData.status === 'completed' || (progressData.status === 'failed' && progressData.final)) {
+            console.log('✅ 任务结束，关闭推送连接');
+            stopProgressPolling();
+        }
+    });
+    
+    source.onerror = () => {
+        // 服务器正常结束连接后浏览器会自动携带Last-Event-ID重连；
+        // 从未收到过数据（代理不支持等）或连接被彻底关闭时，回退到轮询
+        const unusable = receivedEvents === 0 || source.readyState === EventSource.CLOSED;
+        if (unusable && state.progressEventSource === source) {
+            console.warn('⚠️ 进度推送不可用，回退到轮询');
+            source.close();
+            state.progressEventSource = null;
+            if (state.isDownloading && state.currentDownloadId === downloadId) {
+                fallbackToPolling();
+            }
+        }
+    };
+}
+
 function handleProgressUpdate(progressData) {
     const { status, percent, message, filename, speed, downloaded_mb, download_url, error } = progressData;
     
     console.log(`📊 处理进度更新:`, status, `${percent || 0}%`);
     
     switch (status) {
+        case 'queued':
+            const queuePosition = progressData.queue_position || 0;
+            updateProgress(Math.max(35, percent || 0), '正在排队等待...');
+            updateProgressDetails(queuePosition > 0 ? `排队第 ${queuePosition} 位` : '即将开始', '0 MB');
+            showMessage(message || '服务器繁忙，任务正在排队...', 'info');
+            setButtonState('analyzing');
+            break;
+            
         case 'starting':
             const startPercent = Math.max(40, percent || 0);
             updateProgress(startPercent, '正在分析视频格式...');
@@ -1433,6 +1500,16 @@ function handleProgressUpdate(progressData) {
             }, 30000); // 30秒后检查是否需要重置
             break;
             
+        case 'cancelled':
+            console.log('🛑 下载任务已取消');
+            stopProgressPolling();
+            state.isDownloading = false;
+            updateProgress(0, '已取消', true);
+            updateProgressDetails('已取消', '');
+            showMessage('下载已取消', 'info');
+            setButtonState('normal');
+            break;
+            
         case 'failed':
             console.log('❌ 下载任务失败');
             const errorMsg = error || message || '下载失败';
@@ -1856,6 +1933,18 @@ window.addEventListener('beforeunload', (e) => {
         e.preventDefault();
         e.returnValue = '下载正在进行中，确定要离开吗？';
     }
+});
+
+// 页面真正关闭时通知服务器取消未完成的任务，释放带宽和磁盘
+window.addEventListener('pagehide', () => {
+    if (state.isDownloading && state.currentDownloadId) {
+        const cancelUrl = `/cancel/${state.currentDownloadId}`;
+        if (navigator.sendBeacon) {
+            navigator.sendBeacon(cancelUrl);
+        } else {
+            fetch(cancelUrl, { method: 'POST', keepalive: true }).catch(() => {});
+        }
+    }
     completeReset();
 });
 
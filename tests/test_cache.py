@@ -0,0 +1,55 @@
+"""canonical_video_id：同一视频的不同链接形式得到同一个键，不同视频不能得到同一个键"""
+
+import pytest
+
+from app.cache import canonical_video_id
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://www.bilibili.com/video/BV1xx411c7mD', 'bilibili:BV1xx411c7mD'),
+    ('https://m.bilibili.com/video/BV1xx411c7mD?spm_id_from=333.1007&vd_source=abc', 'bilibili:BV1xx411c7mD'),
+    ('bilibili.com/video/BV1xx411c7mD/?p=1', 'bilibili:BV1xx411c7mD'),
+    ('https://www.bilibili.com/video/BV1xx411c7mD?p=3', 'bilibili:BV1xx411c7mD:p3'),
+    ('https://www.bilibili.com/video/av170001', 'bilibili:av170001'),
+    ('https://www.bilibili.com/list/watchlater?bvid=BV1xx411c7mD&oid=1', 'bilibili:BV1xx411c7mD'),
+    ('https://www.bilibili.com/festival/2021bnj?bvid=BV1yy411c7mE', 'bilibili:BV1yy411c7mE'),
+    ('https://www.bilibili.com/medialist/play/watchlater?aid=170001', 'bilibili:av170001'),
+    ('https://b23.tv/AbCdEf', 'b23:AbCdEf'),
+    ('https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=share', 'youtube:dQw4w9WgXcQ'),
+    ('https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ', 'youtube:dQw4w9WgXcQ'),
+    ('https://youtu.be/dQw4w9WgXcQ?t=42', 'youtube:dQw4w9WgXcQ'),
+    ('https://www.youtube.com/shorts/dQw4w9WgXcQ', 'youtube:dQw4w9WgXcQ'),
+])
+def test_known_platforms(url, expected):
+    assert canonical_video_id(url) == expected
+
+
+def test_bvid_query_keeps_videos_apart():
+    first = canonical_video_id('https://www.bilibili.com/list/watchlater?bvid=BV1xx411c7mD')
+    second = canonical_video_id('https://www.bilibili.com/list/watchlater?bvid=BV1yy411c7mE')
+    assert first != second
+
+
+@pytest.mark.parametrize('url', [
+    'https://www.bilibili.com/list/watchlater',
+    'https://www.bilibili.com/festival/2021bnj',
+    'https://www.bilibili.com/list/watchlater?bvid=not-a-bvid',
+    'https://www.youtube.com/watch?v=short',
+    'https://www.youtube.com/watch',
+    'https://b23.tv/',
+    '',
+])
+def test_no_video_id(url):
+    assert canonical_video_id(url) is None
+
+
+def test_other_hosts_keep_query():
+    first = canonical_video_id('https://example.com/play?id=1')
+    second = canonical_video_id('https://example.com/play?id=2')
+    assert first != second
+    assert first == 'example.com/play?id=1'
+
+
+def test_other_hosts_ignore_tracking_and_order():
+    plain = canonical_video_id('https://example.com/play?a=1&id=2')
+    assert canonical_video_id('https://example.com/play/?id=2&utm_source=x&a=1&fbclid=y') == plain
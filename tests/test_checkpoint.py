@@ -0,0 +1,120 @@
+"""JobCheckpoint：任务目录由一个进程独占，进程退出后孤儿任务只被接管一次，恢复时优先使用上次的格式"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from app import checkpoint as checkpoint_module
+from app import video_downloader
+from app.checkpoint import JobCheckpoint, claim_orphaned_jobs
+
+# 在子进程中接管孤儿任务（或占用指定任务），打印接管到的任务ID后一直持有，直到标准输入关闭
+CLAIM_SCRIPT = '''
+import sys
+from app import checkpoint
+checkpoint._work_root = sys.argv[1]
+if len(sys.argv) > 2:
+    job = checkpoint.JobCheckpoint(sys.argv[2])
+    assert job.claim()
+    job.save({'url': 'https://www.youtube.com/watch?v=x', 'format': '137+140'})
+    claimed = [job]
+else:
+    claimed = checkpoint.claim_orphaned_jobs()
+print(' '.join(job.download_id for job in claimed), flush=True)
+sys.stdin.read()
+'''
+
+
+@pytest.fixture
+def work_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint_module, '_work_root', str(tmp_path))
+    return tmp_path
+
+
+def start_claimer(work_root, *args):
+    return subprocess.Popen([sys.executable, '-c', CLAIM_SCRIPT, str(work_root), *args],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def stop(process):
+    process.stdin.close()
+    process.wait(10)
+
+
+def test_claim_refused_within_process(work_root):
+    first = JobCheckpoint(str(work_root / 'job'))
+    assert first.claim()
+    # 本进程的另一个检查点对象（例如定期接管孤儿任务时）不能再次占用
+    assert not JobCheckpoint(str(work_root / 'job')).claim()
+    first.save({'url': 'https://example.com/v'})
+    assert claim_orphaned_jobs() == []
+    first.release()
+    second = JobCheckpoint(str(work_root / 'job'))
+    assert second.claim()
+    second.release()
+
+
+def test_finished_job_is_not_adopted(work_root):
+    job = JobCheckpoint(str(work_root / 'job'))
+    assert job.claim()
+    job.save({'url': 'https://example.com/v'})
+    job.finish()
+    assert claim_orphaned_jobs() == []
+
+
+def test_killed_process_job_adopted_exactly_once(work_root):
+    owner = start_claimer(work_root, str(work_root / 'job'))
+    try:
+        assert owner.stdout.readline().strip() == 'job'
+        # 持有任务的进程还活着：不是孤儿任务
+        assert claim_orphaned_jobs() == []
+    finally:
+        owner.kill()
+        owner.wait(10)
+
+    # 进程被杀死后锁自动释放；多个进程同时启动，只有一个接管
+    claimers = [start_claimer(work_root) for _ in range(3)]
+    try:
+        claimed = [process.stdout.readline().split() for process in claimers]
+        assert sorted(sum(claimed, [])) == ['job']
+        assert claim_orphaned_jobs() == []
+    finally:
+        for process in claimers:
+            stop(process)
+    adopted = claim_orphaned_jobs()
+    assert [job.download_id for job in adopted] == ['job']
+    assert adopted[0].load()['format'] == '137+140'
+    adopted[0].release()
+
+
+def test_resume_retries_recorded_format_first(work_root, monkeypatch):
+    attempts = []
+
+    class FakeYoutubeDL:
+        def __init__(self, opts):
+            self.opts = opts
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def extract_info(self, url, download=True):
+            attempts.append(self.opts['format'])
+            path = self.opts['outtmpl'].replace('%(title)s.%(ext)s', 'video.mp4')
+            with open(path, 'wb') as f:
+                f.write(b'0' * 2048)
+            return {'filepath': path}
+
+    monkeypatch.setattr(video_downloader.yt_dlp, 'YoutubeDL', FakeYoutubeDL)
+    job_dir = work_root / 'job'
+    job_dir.mkdir()
+    path = video_downloader.download_video('https://www.youtube.com/watch?v=x',
+                                           str(job_dir / '%(title)s.%(ext)s'), preferred_format='137+140')
+    # 沿用上次的格式，.part 文件的文件名相同才能续传
+    assert attempts == ['137+140']
+    assert path == str(job_dir / 'video.mp4')
@@ -0,0 +1,143 @@
+"""DiskBudget：按配额和剩余空间预留，预留对其他进程（共享工作目录）立即可见；
+.part 目录在另一个文件系统上时两边都要放得下"""
+
+import collections
+import os
+
+import pytest
+
+from app import disk_budget as disk_budget_module
+from app.checkpoint import JobCheckpoint
+from app.disk_budget import DiskBudget, InsufficientStorageError
+
+DiskUsage = collections.namedtuple('DiskUsage', 'total used free')
+
+
+@pytest.fixture
+def work_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_budget_module, 'get_work_root', lambda: str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def disk(monkeypatch):
+    """模拟磁盘容量和剩余空间"""
+    usage = {'total': 10 ** 12, 'free': 10 ** 12}
+    monkeypatch.setattr(disk_budget_module.shutil, 'disk_usage',
+                        lambda path: DiskUsage(usage['total'], usage['total'] - usage['free'], usage['free']))
+    return usage
+
+
+def job(work_root, name, downloaded=0):
+    checkpoint = JobCheckpoint(os.path.join(work_root, name))
+    assert checkpoint.claim()
+    if downloaded:
+        with open(os.path.join(checkpoint.work_dir, 'video.mp4.part'), 'wb') as f:
+            f.write(b'0' * downloaded)
+    return checkpoint
+
+
+def test_reservations_share_quota(work_root, disk):
+    budget = DiskBudget(quota_bytes=100_000, min_free_bytes=0)
+    first = job(work_root, 'a')
+    assert budget.try_reserve(first, 60_000)
+    assert first.load()['reserved_bytes'] == 60_000
+    assert not budget.try_reserve(job(work_root, 'b'), 60_000)
+    assert budget.try_reserve(job(work_root, 'c'), 30_000)
+    stats = budget.stats()
+    assert (stats['admitted'], stats['deferred']) == (2, 1)
+
+
+def test_finished_job_frees_space(work_root, disk, monkeypatch):
+    monkeypatch.setattr(disk_budget_module, 'USAGE_CACHE_TTL', 0)
+    budget = DiskBudget(quota_bytes=100_000, min_free_bytes=0)
+    first = job(work_root, 'a')
+    assert budget.try_reserve(first, 60_000)
+    second = job(work_root, 'b')
+    assert not budget.try_reserve(second, 60_000)
+    first.finish()
+    assert budget.try_reserve(second, 60_000)
+
+
+def test_resumed_job_counts_downloaded_part(work_root, disk):
+    budget = DiskBudget(quota_bytes=100_000, min_free_bytes=0)
+    assert budget.try_reserve(job(work_root, 'other', downloaded=30_000), 30_000)
+    # 已下载的 50000 字节是本任务预留的一部分，不需要额外空间
+    assert budget.try_reserve(job(work_root, 'resumed', downloaded=50_000), 70_000)
+
+
+def test_outstanding_reservations_count_against_free_space(work_root, disk):
+    disk['free'] = 100_000
+    budget = DiskBudget(quota_bytes=0, min_free_bytes=20_000)
+    assert budget.try_reserve(job(work_root, 'a'), 50_000)
+    # 剩余 100000 - 已预留未写入 50000 - 保留 20000 = 30000
+    assert not budget.try_reserve(job(work_root, 'b'), 40_000)
+    assert budget.try_reserve(job(work_root, 'c'), 30_000)
+
+
+def test_admission_and_fits_ever(work_root, disk):
+    disk['total'] = disk['free'] = 100_000
+    budget = DiskBudget(quota_bytes=0, min_free_bytes=20_000)
+    assert budget.fits_ever(80_000)
+    assert not budget.fits_ever(80_001)
+    budget.check_admission()
+    assert budget.try_reserve(job(work_root, 'a'), 80_000)
+    with pytest.raises(InsufficientStorageError):
+        budget.check_admission()
+    assert budget.stats()['rejected'] == 1
+
+
+def test_reservation_visible_to_other_process(work_root, disk):
+    # 两个实例模拟共享工作目录的两个worker进程，各自缓存了扫描结果
+    first = DiskBudget(quota_bytes=100_000, min_free_bytes=0)
+    second = DiskBudget(quota_bytes=100_000, min_free_bytes=0)
+    assert second.stats()['work_dir_bytes'] == 0
+    assert first.try_reserve(job(work_root, 'a'), 60_000)
+    assert not second.try_reserve(job(work_root, 'b'), 60_000)
+    assert second.stats()['scans'] == 2
+
+
+@pytest.fixture
+def part_root(tmp_path, work_root, monkeypatch):
+    """.part 目录在另一个文件系统上，分别模拟两个文件系统的容量和剩余空间"""
+    root = tmp_path.parent / (tmp_path.name + '-part')
+    root.mkdir()
+    monkeypatch.setattr(disk_budget_module, 'get_part_root', lambda: str(root))
+    monkeypatch.setattr(disk_budget_module, 'job_part_dir', lambda work_dir: str(root / os.path.basename(work_dir)))
+    monkeypatch.setattr(disk_budget_module, 'same_filesystem', lambda a, b: False)
+    usage = {str(work_root): [10 ** 12, 10 ** 12], str(root): [10 ** 12, 10 ** 12]}
+    monkeypatch.setattr(disk_budget_module.shutil, 'disk_usage',
+                        lambda path: DiskUsage(usage[path][0], usage[path][0] - usage[path][1], usage[path][1]))
+    return root, usage
+
+
+def test_part_root_free_space_is_checked(work_root, part_root):
+    root, usage = part_root
+    usage[str(root)] = [200_000, 100_000]
+    budget = DiskBudget(quota_bytes=0, min_free_bytes=20_000)
+    assert not budget.fits_ever(180_001)
+    assert budget.try_reserve(job(work_root, 'a'), 50_000)
+    # 工作目录空间充足，但 .part 目录剩余 100000 - 已预留未写入 50000 - 保留 20000 = 30000
+    assert not budget.try_reserve(job(work_root, 'b'), 40_000)
+    assert budget.try_reserve(job(work_root, 'c'), 30_000)
+    stats = budget.stats()
+    assert stats['part_outstanding_reserved_bytes'] == 80_000
+
+
+def test_part_root_downloaded_bytes_count_towards_reservation(work_root, part_root):
+    root, usage = part_root
+    usage[str(root)] = [10 ** 6, 100_000]
+    budget = DiskBudget(quota_bytes=0, min_free_bytes=0)
+    checkpoint = job(work_root, 'resumed')
+    os.makedirs(root / 'resumed')
+    with open(root / 'resumed' / 'video.mp4.part', 'wb') as f:
+        f.write(b'0' * 50_000)
+    # 已写入 .part 目录的 50000 字节是预留的一部分
+    assert budget.try_reserve(checkpoint, 150_000)
+    assert budget.stats()['part_outstanding_reserved_bytes'] == 100_000
+
+
+def test_estimate_adds_merge_headroom():
+    budget = DiskBudget(merge_headroom=0.5)
+    assert budget.estimate({'filesize': 1000}) == 1500
+    assert budget.estimate(None) == int(disk_budget_module.DEFAULT_JOB_COST * 1.5)
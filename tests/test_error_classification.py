@@ -0,0 +1,69 @@
+"""classify_download_error：按yt-dlp异常类型和关键词区分致命错误与可重试错误"""
+
+import io
+
+import pytest
+from yt_dlp.networking import Response
+from yt_dlp.networking.exceptions import HTTPError
+from yt_dlp.utils import DownloadError, ExtractorError, GeoRestrictedError, UnsupportedError
+
+from app.video_downloader import classify_download_error
+
+
+def http_error(status):
+    return HTTPError(Response(io.BytesIO(b''), 'https://example.com/', {}, status=status))
+
+
+def wrapped(cause):
+    """yt-dlp 抛出的 DownloadError 在 exc_info 中携带真正的异常"""
+    return DownloadError(f'ERROR: {cause}', exc_info=(type(cause), cause, None))
+
+
+def test_unsupported_url_is_fatal():
+    result = classify_download_error(wrapped(UnsupportedError('https://example.com/x')))
+    assert result['error_type'] == 'unsupported_url'
+    assert result['fatal']
+
+
+def test_geo_restriction_is_retryable():
+    result = classify_download_error(wrapped(GeoRestrictedError('not available in your country')))
+    assert result['error_type'] == 'geo_restricted'
+    assert not result['fatal']
+
+
+@pytest.mark.parametrize('status', [404, 410])
+def test_extractor_not_found_is_fatal(status):
+    error = ExtractorError('Unable to download webpage', cause=http_error(status))
+    result = classify_download_error(wrapped(error))
+    assert result['error_type'] == 'access_denied'
+    assert result['fatal']
+
+
+def test_media_not_found_is_retryable():
+    # 媒体CDN的404可能只是签名过期，换策略重新提取即可
+    result = classify_download_error(wrapped(http_error(404)))
+    assert not result['fatal']
+
+
+def test_extractor_server_error_is_retryable():
+    error = ExtractorError('Unable to download JSON metadata', cause=http_error(503))
+    assert classify_download_error(wrapped(error))['error_type'] == 'retryable_error'
+
+
+@pytest.mark.parametrize('message, error_type, fatal', [
+    ('This video requires payment to watch', 'payment_required', True),
+    ('该视频为大会员专享', 'payment_required', True),
+    ('Sign in to confirm, login required', 'auth_required', True),
+    ('login request failed: connection reset', 'retryable_error', False),
+    ('Video unavailable', 'access_denied', True),
+    ('HTTP Error 412: Precondition Failed', 'retryable_error', False),
+])
+def test_keyword_rules(message, error_type, fatal):
+    result = classify_download_error(DownloadError(f'ERROR: {message}'))
+    assert (result['error_type'], result['fatal']) == (error_type, fatal)
+
+
+def test_extractor_message_without_prefix():
+    # 关键词匹配使用原始消息，不受yt-dlp附加的提示文字影响
+    error = ExtractorError('Private video', expected=True)
+    assert classify_download_error(wrapped(error))['error_type'] == 'access_denied'
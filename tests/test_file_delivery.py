@@ -0,0 +1,150 @@
+"""文件交付：Range 解析与合并、If-Range 校验、各种响应的头和响应体，交给代理发送时先租用再释放"""
+
+import os
+
+import pytest
+from werkzeug.http import http_date
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Response
+
+from app.file_delivery import FileDelivery, _file_etag, _if_range_matches, _resolve_ranges, content_disposition
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 100)]),
+    ('bytes=1000-', [(1000, 1024)]),
+    ('bytes=1000-5000', [(1000, 1024)]),
+    ('bytes=-24', [(1000, 1024)]),
+    ('bytes=-5000', [(0, 1024)]),
+    ('bytes=0-9, 5-19, 20-29', [(0, 30)]),
+    ('bytes=500-599,0-9', [(0, 10), (500, 600)]),
+    ('bytes=2000-', []),
+    ('bytes=9-5', None),
+    ('bytes=abc', None),
+    ('bytes=-', None),
+    ('items=0-9', None),
+    ('bytes=', None),
+])
+def test_resolve_ranges(header, expected):
+    assert _resolve_ranges(header, len(DATA)) == expected
+
+
+def test_too_many_ranges_sends_full_file():
+    header = 'bytes=' + ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(40))
+    assert _resolve_ranges(header, len(DATA)) is None
+
+
+def test_if_range(tmp_path):
+    path = tmp_path / 'a.mp4'
+    path.write_bytes(DATA)
+    stat = os.stat(path)
+    etag = _file_etag(stat)
+    assert _if_range_matches(etag, etag, stat.st_mtime)
+    assert not _if_range_matches('"other"', etag, stat.st_mtime)
+    # 弱校验ETag不能用于 If-Range
+    assert not _if_range_matches('W/' + etag, etag, stat.st_mtime)
+    assert _if_range_matches(http_date(stat.st_mtime), etag, stat.st_mtime)
+    assert not _if_range_matches(http_date(stat.st_mtime - 10), etag, stat.st_mtime)
+    assert not _if_range_matches('not a date', etag, stat.st_mtime)
+
+
+def test_content_disposition_ascii_fallback():
+    header = content_disposition('attachment', '测试 "视频".mp4')
+    assert header.startswith('attachment; filename="video.mp4"; ')
+    assert "filename*=UTF-8''%E6%B5%8B%E8%AF%95" in header
+    header.encode('latin-1')
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(DATA)
+    return str(path)
+
+
+def send(path, headers=None, method='GET'):
+    environ = EnvironBuilder(method=method, headers=headers or {}).get_environ()
+    closed = []
+    response = FileDelivery().send(path, environ, Response, {'Content-Type': 'video/mp4'},
+                                   on_close=lambda: closed.append(True))
+    body = b'' if method == 'HEAD' or response.status_code in (304, 416) else b''.join(response.iter_encoded())
+    response.close()
+    return response, body, closed
+
+
+def test_full_file(video):
+    response, body, closed = send(video)
+    assert response.status_code == 200
+    assert body == DATA
+    assert response.headers['Content-Length'] == str(len(DATA))
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert closed == [True]
+
+
+def test_single_range(video):
+    response, body, _ = send(video, {'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert body == DATA[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(DATA)}'
+    assert response.headers['Content-Length'] == '100'
+
+
+def test_multiple_ranges(video):
+    response, body, _ = send(video, {'Range': 'bytes=0-9,500-509'})
+    assert response.status_code == 206
+    boundary = response.headers['Content-Type'].split('boundary=')[1]
+    assert int(response.headers['Content-Length']) == len(body)
+    assert body.endswith(f'--{boundary}--\r\n'.encode())
+    assert DATA[0:10] in body and DATA[500:510] in body
+    assert f'Content-Range: bytes 500-509/{len(DATA)}'.encode() in body
+
+
+def test_unsatisfiable_range(video):
+    response, _, closed = send(video, {'Range': 'bytes=5000-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(DATA)}'
+    assert closed == [True]
+
+
+def test_stale_if_range_sends_full_file(video):
+    response, body, _ = send(video, {'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert body == DATA
+    etag = _file_etag(os.stat(video))
+    response, body, _ = send(video, {'Range': 'bytes=0-9', 'If-Range': etag})
+    assert response.status_code == 206
+    assert body == DATA[:10]
+
+
+def test_not_modified_and_head(video):
+    etag = _file_etag(os.stat(video))
+    response, _, closed = send(video, {'If-None-Match': etag})
+    assert response.status_code == 304
+    assert closed == [True]
+    response, body, closed = send(video, {'Range': 'bytes=0-9'}, method='HEAD')
+    assert response.status_code == 206
+    assert response.headers['Content-Length'] == '10'
+    assert closed == [True]
+
+
+def test_offload_outside_mapped_dirs_falls_back(tmp_path, video):
+    delivery = FileDelivery('x-accel', {str(tmp_path / 'cache'): '/_protected/cache/'})
+    assert delivery.offload_header(video) is None
+    os.makedirs(tmp_path / 'cache')
+    cached = tmp_path / 'cache' / '视频.mp4'
+    cached.write_bytes(DATA)
+    assert delivery.offload_header(str(cached)) == ('X-Accel-Redirect', '/_protected/cache/%E8%A7%86%E9%A2%91.mp4')
+
+
+def test_offloaded_response_leases_before_release(video):
+    delivery = FileDelivery('x-sendfile', offload_lease=60)
+    calls = []
+    environ = EnvironBuilder().get_environ()
+    response = delivery.send(video, environ, Response, {'Content-Type': 'video/mp4'},
+                             on_close=lambda: calls.append('close'),
+                             on_offload=lambda seconds: calls.append(('lease', seconds)))
+    assert delivery.is_offloaded(response)
+    assert response.headers['Content-Length'] == '0'
+    assert calls == [('lease', 60), 'close']
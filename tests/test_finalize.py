@@ -0,0 +1,117 @@
+"""finalize_file：同一文件系统直接重命名，跨设备时依次退回 reflink / copy_file_range / 普通复制"""
+
+import errno
+import os
+
+import pytest
+
+from app import finalize
+from app.finalize import finalize_file
+
+DATA = os.urandom(300_000)
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / 'src' / 'video.mp4'
+    path.parent.mkdir()
+    path.write_bytes(DATA)
+    return str(path)
+
+
+@pytest.fixture
+def dest(tmp_path):
+    (tmp_path / 'dest').mkdir()
+    return str(tmp_path / 'dest' / 'video.mp4')
+
+
+@pytest.fixture
+def cross_device(monkeypatch, src):
+    """源文件的重命名返回 EXDEV，模拟跨文件系统"""
+    replace = os.replace
+
+    def fake_replace(a, b):
+        if a == src:
+            cross_device_error()
+        return replace(a, b)
+
+    monkeypatch.setattr(finalize.os, 'replace', fake_replace)
+
+
+def copy_fd(src_fd, dst_fd, count=None):
+    data = os.read(src_fd, len(DATA) if count is None else count)
+    os.write(dst_fd, data)
+    return len(data)
+
+
+def cross_device_error(*args):
+    raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+
+def assert_moved(src, dest):
+    assert not os.path.exists(src)
+    with open(dest, 'rb') as f:
+        assert f.read() == DATA
+    assert [name for name in os.listdir(os.path.dirname(dest)) if name.endswith('.tmp')] == []
+
+
+def test_rename_on_same_filesystem(src, dest):
+    assert finalize_file(src, dest) == 'rename'
+    assert_moved(src, dest)
+
+
+def test_replaces_existing_destination(src, dest):
+    with open(dest, 'wb') as f:
+        f.write(b'old')
+    finalize_file(src, dest)
+    assert_moved(src, dest)
+
+
+def test_other_errors_propagate(src, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        finalize_file(src, str(tmp_path / 'missing' / 'video.mp4'))
+    assert os.path.exists(src)
+
+
+def test_reflink(src, dest, cross_device, monkeypatch):
+    monkeypatch.setattr(finalize, '_reflink', lambda src_fd, dst_fd: copy_fd(src_fd, dst_fd) > 0)
+    assert finalize_file(src, dest) == 'reflink'
+    assert_moved(src, dest)
+
+
+@pytest.mark.skipif(not hasattr(os, 'copy_file_range'), reason='需要 copy_file_range')
+def test_copy_file_range(src, dest, cross_device, monkeypatch):
+    monkeypatch.setattr(finalize, '_reflink', lambda src_fd, dst_fd: False)
+    monkeypatch.setattr(finalize, 'COPY_CHUNK_SIZE', 100_000)
+    assert finalize_file(src, dest) == 'copy_file_range'
+    assert_moved(src, dest)
+
+
+@pytest.mark.parametrize('copy_file_range', [cross_device_error, lambda *args: 0, None])
+def test_plain_copy_fallback(src, dest, cross_device, monkeypatch, copy_file_range):
+    monkeypatch.setattr(finalize, 'fcntl', None)
+    if copy_file_range is None:
+        monkeypatch.delattr(finalize.os, 'copy_file_range', raising=False)
+    else:
+        monkeypatch.setattr(finalize.os, 'copy_file_range', copy_file_range, raising=False)
+    assert finalize_file(src, dest) == 'copy'
+    assert_moved(src, dest)
+
+
+def test_failure_mid_copy_keeps_source(src, dest, cross_device, monkeypatch):
+    calls = []
+
+    def failing_copy_file_range(src_fd, dst_fd, count):
+        calls.append(count)
+        if len(calls) > 1:
+            raise OSError(errno.EIO, 'I/O error')
+        return copy_fd(src_fd, dst_fd, count)
+
+    monkeypatch.setattr(finalize, '_reflink', lambda src_fd, dst_fd: False)
+    monkeypatch.setattr(finalize, 'COPY_CHUNK_SIZE', 100_000)
+    monkeypatch.setattr(finalize.os, 'copy_file_range', failing_copy_file_range, raising=False)
+    with pytest.raises(OSError):
+        finalize_file(src, dest)
+    with open(src, 'rb') as f:
+        assert f.read() == DATA
+    assert os.listdir(os.path.dirname(dest)) == []
@@ -0,0 +1,93 @@
+"""plan_format：按画质策略和编码偏好在本地选出音视频组合"""
+
+import pytest
+
+from app.format_planner import plan_format
+
+
+def video(format_id, height, vcodec='avc1.640028', fps=30, tbr=1000, **extra):
+    return {'format_id': format_id, 'url': f'https://cdn/{format_id}', 'height': height,
+            'vcodec': vcodec, 'acodec': 'none', 'fps': fps, 'tbr': tbr, **extra}
+
+
+def audio(format_id, acodec='mp4a.40.2', abr=128, **extra):
+    return {'format_id': format_id, 'url': f'https://cdn/{format_id}', 'vcodec': 'none',
+            'acodec': acodec, 'abr': abr, **extra}
+
+
+def combined(format_id, height, vcodec='avc1.64001F', **extra):
+    return {'format_id': format_id, 'url': f'https://cdn/{format_id}', 'height': height,
+            'vcodec': vcodec, 'acodec': 'mp4a.40.2', **extra}
+
+
+@pytest.mark.parametrize('formats, device_type, expected', [
+    # 分辨率优先，超出策略的 1440p/4K 和 120fps 被排除
+    ([video('1080', 1080), video('720', 720), video('2160', 2160), video('1080hfr', 1080, fps=120), audio('a')],
+     'desktop', '1080+a'),
+    # 同分辨率按编码偏好：H.264 > HEVC > AV1/VP9
+    ([video('av1', 1080, 'av01.0.08M.08'), video('hevc', 1080, 'hev1.1.6.L120'), audio('a')], 'desktop', 'hevc+a'),
+    ([video('vp9', 1080, 'vp09.00.40.08'), video('hevc', 1080, 'hev1.1.6.L120'), video('avc', 1080), audio('a')],
+     'desktop', 'avc+a'),
+    # 分辨率优先于编码偏好
+    ([video('avc', 720), video('av1', 1080, 'av01.0.08M.08'), audio('a')], 'desktop', 'av1+a'),
+    # 音频：AAC 优先于 Opus，同编码按码率
+    ([video('v', 720), audio('opus', 'opus', 160), audio('aac-low', abr=64), audio('aac', abr=128)],
+     'desktop', 'v+aac'),
+    # 合并流画质不低于分离流时直接使用，否则下载分离流再合并
+    ([video('v', 720), audio('a'), combined('c', 720)], 'desktop', 'c'),
+    ([video('v', 1080), audio('a'), combined('c', 720)], 'desktop', 'v+a'),
+    # 只有合并流
+    ([combined('c360', 360), combined('c720', 720)], 'mobile', 'c720'),
+])
+def test_plan_picks_format(formats, device_type, expected):
+    assert plan_format(formats, device_type)['format'] == expected
+
+
+@pytest.mark.parametrize('formats', [
+    [video('av1', 1080, 'av01.0.08M.08'), video('hevc', 1080, 'hev1.1.6.L120'), audio('a')],
+    [video('v', 1080), audio('a'), combined('c', 1080)],
+])
+def test_same_plan_for_every_device(formats):
+    # 各设备类型使用同一套画质策略和编码偏好
+    assert len({plan_format(formats, device)['format'] for device in ('desktop', 'mobile', 'tablet')}) == 1
+
+
+@pytest.mark.parametrize('formats', [
+    None,
+    [],
+    # 只有纯视频或纯音频流：没有可用的组合，由调用方退回到按策略下载
+    [video('v', 1080)],
+    [audio('a')],
+    # 缺少 format_id 或 url 的格式不可用
+    [video('v', 1080, url=None), audio('a')],
+    [{**video('v', 1080), 'format_id': None}, audio('a')],
+    # 全部超出画质策略
+    [video('2160', 2160), audio('a')],
+])
+def test_no_usable_plan(formats):
+    assert plan_format(formats) is None
+
+
+@pytest.mark.parametrize('video_size, audio_size, expected', [
+    ({'filesize': 1000}, {'filesize': 100}, 1100),
+    ({'filesize_approx': 1000}, {'filesize': 100}, 1100),
+    # 任一部分大小未知时整体未知，不用偏小的值
+    ({}, {'filesize': 100}, 0),
+    ({'filesize': 1000}, {'filesize': None}, 0),
+])
+def test_pair_filesize(video_size, audio_size, expected):
+    plan = plan_format([video('v', 1080, **video_size), audio('a', **audio_size)])
+    assert plan['filesize'] == expected
+
+
+def test_combined_plan_details():
+    plan = plan_format([combined('c', 720, filesize_approx=5000)], 'mobile')
+    assert plan == {'format': 'c', 'height': 720, 'filesize': 5000, 'description': '720p avc1.64001F'}
+    assert plan_format([combined('c', 720)])['filesize'] == 0
+
+
+def test_unknown_codecs_still_planned():
+    # 编码未知但有分辨率/音频码率信息的格式也能参与规划
+    formats = [{'format_id': 'v', 'url': 'https://cdn/v', 'height': 480, 'acodec': 'none'},
+               {'format_id': 'a', 'url': 'https://cdn/a', 'vcodec': 'none', 'abr': 96}]
+    assert plan_format(formats)['format'] == 'v+a'
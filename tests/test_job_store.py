@@ -0,0 +1,229 @@
+"""任务存储：三种后端的创建、原子更新、按状态查询、删除、过期清理和占用；RedisJobStore 使用 fakeredis"""
+
+import threading
+import time
+
+import pytest
+
+from app import job_store as job_store_module
+from app.job_store import MemoryJobStore, RedisJobStore, SQLiteJobStore
+
+
+def make_store(backend, tmp_path, ttl=60):
+    if backend == 'memory':
+        return MemoryJobStore(ttl=ttl)
+    if backend == 'sqlite':
+        return SQLiteJobStore(str(tmp_path / 'jobs.sqlite3'), ttl=ttl)
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisJobStore(client=fakeredis.FakeRedis(), ttl=ttl)
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def any_store(request, tmp_path):
+    return make_store(request.param, tmp_path)
+
+
+@pytest.fixture
+def later(monkeypatch):
+    """把时钟拨到 seconds 秒之后，模拟记录过期"""
+    now = time.time()
+
+    def advance(seconds):
+        monkeypatch.setattr(job_store_module.time, 'time', lambda: now + seconds)
+    return advance
+
+
+def test_update_merges_removes_and_counts_versions(any_store):
+    any_store.create('a', {'status': 'queued', 'queue_position': 3})
+    assert any_store.update('a', {'status': 'downloading'}, remove=('queue_position',)) == \
+        {'status': 'downloading', 'seq': 1}
+    data = any_store.update('a', {'percent': 10, 'missing_key': None}, remove=('missing',))
+    assert data == {'status': 'downloading', 'percent': 10, 'missing_key': None, 'seq': 2}
+    assert any_store.get('a') == data
+    assert any_store.update('missing', {'status': 'failed'}) is None
+    assert 'missing' not in any_store
+
+
+def test_concurrent_updates_are_not_lost(any_store):
+    any_store.create('a', {'status': 'downloading', 'count': 0})
+
+    def worker(name):
+        for i in range(20):
+            any_store.update('a', {f'{name}-{i}': True})
+
+    threads = [threading.Thread(target=worker, args=(name,)) for name in 'xyz']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    data = any_store.get('a')
+    assert data['seq'] == 60
+    assert len([key for key in data if '-' in key]) == 60
+
+
+def test_delete_and_find_by_status(any_store):
+    any_store.create('a', {'status': 'queued'})
+    any_store.create('b', {'status': 'downloading'})
+    any_store.create('c', {'status': 'queued'})
+    assert sorted(job_id for job_id, _ in any_store.find_by_status('queued', 'downloading')) == ['a', 'b', 'c']
+    assert any_store.find_by_status() == []
+    any_store.update('c', {'status': 'completed'})
+    any_store.delete('a')
+    assert any_store.find_by_status('queued') == []
+    assert [job_id for job_id, _ in any_store.find_by_status('completed')] == ['c']
+    assert sorted(job_id for job_id, _ in any_store.items()) == ['b', 'c']
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_purge_expired(backend, tmp_path, later):
+    store = make_store(backend, tmp_path, ttl=60)
+    store.create('old', {'status': 'completed'})
+    store.create('stale', {'status': 'failed'})
+    later(30)
+    # 更新会续期
+    store.update('old', {'percent': 100})
+    store.create('new', {'status': 'queued'})
+    later(70)
+    assert store.purge_expired() == 1
+    assert store.get('stale') is None
+    assert store.find_by_status('failed') == []
+    assert sorted(job_id for job_id, _ in store.items()) == ['new', 'old']
+    later(100)
+    assert store.purge_expired() == 2
+    assert store.items() == []
+    assert store.purge_expired() == 0
+
+
+def test_claim_is_exclusive_and_released_by_owner(any_store):
+    assert any_store.claim('inflight:v:desktop', 'a') == 'a'
+    assert any_store.claim('inflight:v:desktop', 'b') == 'a'
+    assert any_store.claim('inflight:v:mobile', 'b') == 'b'
+    # 只有指定的旧占用者可以被接替
+    assert any_store.claim('inflight:v:desktop', 'c', replace='x') == 'a'
+    assert any_store.claim('inflight:v:desktop', 'c', replace='a') == 'c'
+    # 已被接替的旧占用者释放时不影响新的占用
+    any_store.release_claim('inflight:v:desktop', 'a')
+    assert any_store.claim('inflight:v:desktop', 'd') == 'c'
+    any_store.release_claim('inflight:v:desktop', 'c')
+    assert any_store.claim('inflight:v:desktop', 'd') == 'd'
+    # 占用记录不是任务记录
+    assert any_store.items() == []
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'redis'])
+def test_claim_across_processes_has_one_winner(backend, tmp_path):
+    # 各线程使用自己的存储实例，相当于多个worker进程同时收到同一视频的请求
+    if backend == 'sqlite':
+        stores = [SQLiteJobStore(str(tmp_path / 'jobs.sqlite3')) for _ in range(8)]
+    else:
+        fakeredis = pytest.importorskip('fakeredis')
+        server = fakeredis.FakeServer()
+        stores = [RedisJobStore(client=fakeredis.FakeRedis(server=server)) for _ in range(8)]
+    barrier = threading.Barrier(len(stores))
+    results = []
+
+    def worker(index):
+        barrier.wait()
+        results.append(stores[index].claim('inflight:v:desktop', f'job-{index}'))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(stores))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert len(results) == len(stores) and len(set(results)) == 1
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_claim_expires(backend, tmp_path, later):
+    store = make_store(backend, tmp_path, ttl=60)
+    assert store.claim('inflight:v:desktop', 'a') == 'a'
+    later(70)
+    store.purge_expired()
+    assert store.claim('inflight:v:desktop', 'b') == 'b'
+
+
+def test_sqlite_store_shared_between_connections(tmp_path):
+    # 两个实例相当于两个worker进程
+    first = SQLiteJobStore(str(tmp_path / 'jobs.sqlite3'))
+    second = SQLiteJobStore(str(tmp_path / 'jobs.sqlite3'))
+    first.create('a', {'status': 'queued'})
+    second.update('a', {'cancel_requested': True})
+    assert first.update('a', {'status': 'cancelled'}) == {'status': 'cancelled', 'cancel_requested': True, 'seq': 2}
+
+
+# 以下为 RedisJobStore 特有的行为：键的过期时间、乐观事务重试、状态索引
+
+
+@pytest.fixture
+def server():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def store(server):
+    import fakeredis
+    return RedisJobStore(client=fakeredis.FakeRedis(server=server), ttl=60)
+
+
+def test_create_and_get(store):
+    store.create('a', {'status': 'queued', 'title': '测试'})
+    assert store.get('a') == {'status': 'queued', 'title': '测试'}
+    assert 'a' in store
+    assert store.get('missing') is None
+    assert 0 < store.client.ttl(store._job_key('a')) <= 60
+
+
+def test_update_merges_and_moves_status_index(store):
+    store.create('a', {'status': 'queued', 'queue_position': 3})
+    data = store.update('a', {'status': 'downloading', 'percent': 10}, remove=('queue_position',))
+    assert data == {'status': 'downloading', 'percent': 10, 'seq': 1}
+    assert store.get('a') == data
+    assert store.find_by_status('queued') == []
+    assert store.find_by_status('downloading') == [('a', data)]
+    assert store.update('missing', {'status': 'failed'}) is None
+
+
+def test_update_retries_after_concurrent_change(store, server, monkeypatch):
+    store.create('a', {'status': 'downloading'})
+    import fakeredis
+    other = RedisJobStore(client=fakeredis.FakeRedis(server=server), ttl=60)
+    decode = store._decode
+    calls = []
+
+    def decode_then_race(raw):
+        calls.append(raw)
+        if len(calls) == 1:
+            # 读取之后、提交之前另一个进程请求取消，事务被放弃后重试
+            other.update('a', {'cancel_requested': True})
+        return decode(raw)
+
+    monkeypatch.setattr(store, '_decode', decode_then_race)
+    data = store.update('a', {'percent': 50})
+    assert len(calls) == 2
+    # 两次更新各递增一次版本号，其他进程读到的版本号相同
+    assert data == {'status': 'downloading', 'cancel_requested': True, 'percent': 50, 'seq': 2}
+    assert other.get('a')['seq'] == 2
+
+
+def test_find_by_status(store):
+    store.create('a', {'status': 'queued'})
+    store.create('b', {'status': 'downloading'})
+    store.create('c', {'status': 'queued'})
+    found = dict(store.find_by_status('queued', 'downloading'))
+    assert set(found) == {'a', 'b', 'c'}
+    store.delete('c')
+    assert [job_id for job_id, _ in store.find_by_status('queued')] == ['a']
+
+
+def test_purge_expired_cleans_status_index(store):
+    store.create('a', {'status': 'queued'})
+    store.create('b', {'status': 'completed'})
+    # 模拟Redis让任务键过期：记录消失，状态索引中的ID还在
+    store.client.delete(store._job_key('a'))
+    assert store.purge_expired() == 1
+    assert not store.client.sismember(store._status_key('queued'), 'a')
+    assert store.client.sismember(store._status_key('completed'), 'b')
+    assert store.purge_expired() == 0
+    assert [job_id for job_id, _ in store.items()] == ['b']
@@ -0,0 +1,77 @@
+"""ProcessPool.call：只在子进程长时间没有任何消息时判定为卡死，不限制仍有进展的任务的总时长"""
+
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from app.process_pool import ProcessPool
+from app.video_downloader import DownloadFailedError
+
+
+class FakeProcess:
+    def __init__(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+
+class FakeChild:
+    """代替子进程：由测试线程通过管道的另一端发送消息"""
+
+    def __init__(self):
+        self.conn, self.remote = multiprocessing.Pipe()
+        self.cancel_event = threading.Event()
+        self.process = FakeProcess()
+        self.recent_keys = []
+        self.jobs = 0
+        self.rss = 0
+        self.pid = 0
+        self.killed = False
+
+    def kill(self):
+        self.killed = True
+        self.process.alive = False
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = ProcessPool(max_processes=1, idle_timeout=0.6)
+    child = FakeChild()
+    monkeypatch.setattr(pool, '_acquire', lambda affinity, priority: child)
+    monkeypatch.setattr(pool, '_release', lambda child, healthy: None)
+    return pool, child
+
+
+def run_child(child, messages, interval):
+    def main():
+        child.remote.recv()
+        for message in messages:
+            time.sleep(interval)
+            child.remote.send(message)
+
+    threading.Thread(target=main, daemon=True).start()
+
+
+def test_progressing_job_is_not_limited_by_total_time(pool):
+    pool, child = pool
+    # 总时长超过 idle_timeout 的两倍，但每 0.2 秒都有进度或心跳
+    messages = [('progress', {'percent': i}) for i in range(4)] + [('alive',)] * 4 + [('result', 'done', 0)]
+    run_child(child, messages, 0.2)
+    progress = []
+    assert pool.call('download_video', (), progress_callback=progress.append) == 'done'
+    assert [item['percent'] for item in progress] == [0, 1, 2, 3]
+    assert not child.killed
+
+
+def test_silent_child_is_killed(pool):
+    pool, child = pool
+    run_child(child, [('progress', {'percent': 1})], 0.1)
+    started = time.time()
+    with pytest.raises(DownloadFailedError) as error:
+        pool.call('download_video', ())
+    assert error.value.error_type == 'timeout'
+    assert child.killed
+    assert time.time() - started < 3
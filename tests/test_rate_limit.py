@@ -0,0 +1,136 @@
+"""KeyedLimiter：按key限制并发和速率，acquire_many 失败时不残留占用；
+SharedKeyedLimiter：共享同一目录的多个进程合计受限"""
+
+import subprocess
+import sys
+import threading
+
+from app.rate_limit import KeyedLimiter, SharedKeyedLimiter, TokenBucket
+
+
+def test_concurrency_limit_per_key():
+    limiter = KeyedLimiter({'a': {'concurrency': 2}, '*': {}})
+    assert limiter.try_acquire('a') == 0
+    assert limiter.try_acquire('a') == 0
+    assert limiter.try_acquire('a') is None
+    # 未单独配置的key使用 '*'（不限）
+    for _ in range(10):
+        assert limiter.try_acquire('b') == 0
+    limiter.release('a')
+    assert limiter.try_acquire('a') == 0
+    assert limiter.stats()['active'] == {'a': 2, 'b': 10}
+
+
+def test_rate_limit_returns_wait_time():
+    limiter = KeyedLimiter({'*': {'rate': 1.0, 'burst': 2}})
+    assert limiter.try_acquire('a') == 0
+    assert limiter.try_acquire('a') == 0
+    wait = limiter.try_acquire('a')
+    assert 0 < wait <= 1.0
+    # 只占用并发名额的请求不受速率限制
+    assert limiter.try_acquire('a', rate=False) == 0
+    # 各key有独立的令牌桶
+    assert limiter.try_acquire('b') == 0
+
+
+def test_token_bucket_refills():
+    bucket = TokenBucket(rate=10, burst=1)
+    bucket.consume()
+    assert bucket.wait_time() > 0
+    bucket.updated -= 0.2
+    assert bucket.wait_time() == 0
+
+
+def test_acquire_waits_for_release():
+    limiter = KeyedLimiter({'*': {'concurrency': 1}})
+    assert limiter.acquire('a')
+    acquired = threading.Event()
+
+    def worker():
+        limiter.acquire('a')
+        acquired.set()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release('a')
+    assert acquired.wait(2)
+    thread.join(2)
+    assert limiter.throttled == 1
+
+
+def test_acquire_cancelled():
+    limiter = KeyedLimiter({'*': {'concurrency': 1}})
+    limiter.acquire('a')
+    cancel = threading.Event()
+    cancel.set()
+    assert not limiter.acquire('a', cancel)
+
+
+def test_acquire_many_releases_on_failure():
+    limiter = KeyedLimiter({'b': {'concurrency': 1}, '*': {}})
+    limiter.acquire('b')
+    cancel = threading.Event()
+    cancel.set()
+    assert not limiter.acquire_many(['a', 'b'], cancel)
+    assert limiter.stats()['active'] == {'b': 1}
+    limiter.release('b')
+    assert limiter.acquire_many(['b', 'a', 'a'])
+    assert limiter.stats()['active'] == {'a': 1, 'b': 1}
+
+
+def test_shared_limits_apply_across_processes(tmp_path):
+    # 同一目录的两个限流器相当于两个worker进程
+    limits = {'bilibili': {'concurrency': 3}, '*': {}}
+    first = SharedKeyedLimiter(limits, state_dir=str(tmp_path))
+    second = SharedKeyedLimiter(limits, state_dir=str(tmp_path))
+    assert first.try_acquire('bilibili') == 0
+    assert second.try_acquire('bilibili') == 0
+    assert second.try_acquire('bilibili') == 0
+    assert first.try_acquire('bilibili') is None
+    second.release('bilibili')
+    assert first.try_acquire('bilibili') == 0
+    assert first.stats()['active'] == {'bilibili': 2}
+
+
+def test_shared_total_concurrency(tmp_path):
+    first = SharedKeyedLimiter({'*': {}}, state_dir=str(tmp_path), total=2)
+    second = SharedKeyedLimiter({'*': {}}, state_dir=str(tmp_path), total=2)
+    assert first.try_acquire('a') == 0
+    assert second.try_acquire('b') == 0
+    assert second.try_acquire('c') is None
+    first.release('a')
+    assert second.try_acquire('c') == 0
+
+
+def test_shared_token_bucket(tmp_path):
+    limits = {'*': {'concurrency': 5, 'rate': 1.0, 'burst': 2}}
+    first = SharedKeyedLimiter(limits, state_dir=str(tmp_path))
+    second = SharedKeyedLimiter(limits, state_dir=str(tmp_path))
+    assert first.try_acquire('a') == 0
+    assert second.try_acquire('a') == 0
+    wait = first.try_acquire('a')
+    assert 0 < wait <= 1.0
+    # 受速率限制时不占用并发名额
+    assert first.stats()['active'] == {'a': 1}
+    assert second.try_acquire('a', rate=False) == 0
+
+
+def test_shared_slot_released_when_process_dies(tmp_path):
+    limits = {'*': {'concurrency': 1}}
+    holder = subprocess.Popen([sys.executable, '-c', (
+        'import sys, time\n'
+        'from app.rate_limit import SharedKeyedLimiter\n'
+        f'limiter = SharedKeyedLimiter({limits!r}, state_dir={str(tmp_path)!r})\n'
+        'assert limiter.try_acquire("a") == 0\n'
+        'print("held", flush=True)\n'
+        'time.sleep(60)\n'
+    )], stdout=subprocess.PIPE, text=True)
+    try:
+        assert holder.stdout.readline().strip() == 'held'
+        limiter = SharedKeyedLimiter(limits, state_dir=str(tmp_path))
+        assert limiter.try_acquire('a') is None
+    finally:
+        holder.kill()
+        holder.wait()
+    assert limiter.try_acquire('a') == 0
@@ -0,0 +1,165 @@
+"""Reaper.sweep：按任务状态和存活时间回收记录和文件，合并下载的跟随者仍引用的文件保留"""
+
+import os
+import time
+
+import pytest
+
+from app import reaper as reaper_module
+from app.checkpoint import CHECKPOINT_FILENAME
+from app.job_store import MemoryJobStore
+from app.reaper import Reaper
+
+HOUR = 3600
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = MemoryJobStore(ttl=24 * HOUR)
+    monkeypatch.setattr(reaper_module, 'get_job_store', lambda: store)
+    monkeypatch.setattr(reaper_module, 'get_result_cache', lambda: None)
+    return store
+
+
+@pytest.fixture
+def work_root(tmp_path, monkeypatch):
+    root = tmp_path / 'work'
+    root.mkdir()
+    monkeypatch.setattr(reaper_module, 'get_work_root', lambda: str(root))
+    monkeypatch.setattr(reaper_module, 'get_part_root', lambda: None)
+    return root
+
+
+@pytest.fixture
+def reaper():
+    return Reaper(fetched_ttl=300, unfetched_ttl=HOUR, failed_ttl=900, orphan_ttl=HOUR)
+
+
+def job(store, work_root, download_id, age=None, **fields):
+    """创建任务记录和带输出文件的任务目录；age 为任务结束至今的秒数"""
+    job_dir = work_root / download_id
+    job_dir.mkdir()
+    file_path = job_dir / 'video.mp4'
+    file_path.write_bytes(b'0' * 100)
+    record = {'file_path': str(file_path), **fields}
+    if age is not None:
+        record['finished_at'] = time.time() - age
+    store.create(download_id, record)
+    return file_path
+
+
+@pytest.mark.parametrize('fields, age, reaped', [
+    # 已取走：最后一次下载后保留 fetched_ttl
+    ({'status': 'completed', 'fetched_at': time.time() - 200}, HOUR * 2, False),
+    ({'status': 'completed', 'fetched_at': time.time() - 400}, 10, True),
+    # 从未取走：完成后保留 unfetched_ttl
+    ({'status': 'completed'}, HOUR - 60, False),
+    ({'status': 'completed'}, HOUR + 60, True),
+    # 失败/取消：保留 failed_ttl
+    ({'status': 'failed'}, 800, False),
+    ({'status': 'failed'}, 1000, True),
+    ({'status': 'cancelled'}, 1000, True),
+])
+def test_expiry_by_state_and_age(store, work_root, reaper, fields, age, reaped):
+    file_path = job(store, work_root, 'a', age=age, **fields)
+    result = reaper.sweep()
+    assert ('a' not in store) == reaped
+    assert os.path.exists(file_path) != reaped
+    assert result['records'] == int(reaped)
+
+
+def test_unfinished_jobs_are_kept_and_finish_time_recorded(store, work_root, reaper):
+    file_path = job(store, work_root, 'running', status='downloading')
+    job(store, work_root, 'done', status='completed')
+    reaper.sweep()
+    assert 'running' in store and os.path.exists(file_path)
+    assert 'finished_at' not in store.get('running')
+    # 第一次看到任务结束时记下时间，从此开始计算保留时间
+    assert store.get('done')['finished_at'] == pytest.approx(time.time(), abs=5)
+
+
+def test_file_referenced_by_follower_is_kept(store, work_root, reaper):
+    file_path = job(store, work_root, 'leader', age=HOUR * 2, status='completed', fetched_at=time.time() - HOUR)
+    # 合并下载的跟随者还没取走文件
+    store.create('follower', {'status': 'completed', 'file_path': str(file_path), 'finished_at': time.time()})
+    reaper.sweep()
+    assert 'leader' not in store
+    assert os.path.exists(file_path)
+    store.update('follower', {'fetched_at': time.time() - 400})
+    reaper.sweep()
+    assert 'follower' not in store
+    assert not os.path.exists(file_path.parent)
+
+
+def test_batch_record_kept_until_items_reaped(store, work_root, reaper):
+    job(store, work_root, 'item', status='completed')
+    store.create('batch', {'status': 'batch', 'items': [{'download_id': 'item'}]})
+    reaper.sweep()
+    assert 'finished_at' not in store.get('batch')
+    # 所有任务都被回收后按失败任务的保留时间回收
+    store.delete('item')
+    reaper.sweep()
+    assert 'finished_at' in store.get('batch')
+    store.update('batch', {'finished_at': time.time() - 1000})
+    reaper.sweep()
+    assert 'batch' not in store
+
+
+def test_orphan_dirs(store, work_root, reaper):
+    old = time.time() - HOUR * 2
+    orphan = work_root / 'orphan'
+    orphan.mkdir()
+    (orphan / 'video.mp4').write_bytes(b'0' * 100)
+    os.utime(orphan, (old, old))
+    recent = work_root / 'recent'
+    recent.mkdir()
+    # 有检查点的是未完成的任务，交给 resume_orphans 接管而不是删除
+    unfinished = work_root / 'unfinished'
+    unfinished.mkdir()
+    (unfinished / CHECKPOINT_FILENAME).write_text('{}')
+    os.utime(unfinished, (old, old))
+    # 工作目录中的锁文件等不是任务目录
+    lock_file = work_root / '.disk_budget.lock'
+    lock_file.write_text('')
+    os.utime(lock_file, (old, old))
+
+    result = reaper.sweep()
+    assert sorted(os.listdir(work_root)) == ['.disk_budget.lock', 'recent', 'unfinished']
+    assert result == {'records': 0, 'removed': 1, 'bytes': 100}
+    assert reaper.stats()['files_reaped'] == 1
+
+
+def test_failed_job_leftovers_removed_unless_unfinished(store, work_root, reaper):
+    job(store, work_root, 'failed', age=1000, status='failed')
+    (work_root / 'failed' / 'dl').mkdir()
+    (work_root / 'failed' / 'dl' / 'video.mp4.part').write_bytes(b'0' * 100)
+    # 记录已结束但任务已被重新接管（检查点存在）：目录和其中的文件保留
+    file_path = job(store, work_root, 'resuming', age=1000, status='failed')
+    (work_root / 'resuming' / CHECKPOINT_FILENAME).write_text('{}')
+    reaper.sweep()
+    assert not os.path.exists(work_root / 'failed')
+    assert 'resuming' not in store
+    assert os.path.exists(file_path)
+
+
+def test_part_dirs_without_work_dir(store, work_root, reaper, tmp_path, monkeypatch):
+    part_root = tmp_path / 'part'
+    part_root.mkdir()
+    monkeypatch.setattr(reaper_module, 'get_part_root', lambda: str(part_root))
+    job(store, work_root, 'active', status='downloading')
+    (part_root / 'active').mkdir()
+    (part_root / 'gone').mkdir()
+    (part_root / 'gone' / 'video.mp4.part').write_bytes(b'0' * 100)
+    reaper.sweep()
+    assert os.listdir(part_root) == ['active']
+
+
+def test_forget_and_resume_hooks(store, work_root):
+    forgotten = []
+    reaper = Reaper(failed_ttl=900, forget_jobs=lambda surviving: forgotten.append(set(surviving)),
+                    resume_orphans=lambda: 2)
+    job(store, work_root, 'kept', status='downloading')
+    job(store, work_root, 'reaped', age=1000, status='failed')
+    reaper.sweep()
+    assert forgotten == [{'kept'}]
+    assert reaper.stats()['orphans_resumed'] == 2
@@ -0,0 +1,137 @@
+"""ResultCache.store：复制文件期间不持有锁，放不下时文件留在原位置；配额和固定状态在共享目录的进程之间生效"""
+
+import os
+import threading
+
+from app import result_cache as result_cache_module
+from app.result_cache import LEASE_FILENAME, STAGING_PREFIX, ResultCache
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+    return path
+
+
+def test_store_and_lookup(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    src = write_file(tmp_path / 'a.mp4', 100)
+    path = cache.store('a', str(src))
+    assert cache.contains_path(path)
+    assert not os.path.exists(src)
+    assert cache.lookup('a') == path
+    # 重新加载时恢复索引，临时目录不算作条目
+    assert ResultCache(str(tmp_path / 'cache'), max_bytes=1000).lookup('a') == path
+
+
+def test_lookup_not_blocked_while_copying(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    cache.store('old', str(write_file(tmp_path / 'old.mp4', 100)))
+    copying = threading.Event()
+    release = threading.Event()
+    finalize = result_cache_module.finalize_file
+
+    def slow_finalize(src, dest):
+        copying.set()
+        release.wait(5)
+        return finalize(src, dest)
+
+    monkeypatch.setattr(result_cache_module, 'finalize_file', slow_finalize)
+    src = write_file(tmp_path / 'new.mp4', 100)
+    worker = threading.Thread(target=cache.store, args=('new', str(src)))
+    worker.start()
+    try:
+        assert copying.wait(5)
+        assert cache.lookup('old') is not None
+        assert cache.stats()['entries'] == 1
+    finally:
+        release.set()
+        worker.join(5)
+    assert cache.lookup('new') is not None
+
+
+def test_pinned_entries_keep_file_in_place(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=150)
+    pinned = cache.store('pinned', str(write_file(tmp_path / 'pinned.mp4', 100)))
+    cache.acquire(pinned)
+    src = write_file(tmp_path / 'new.mp4', 100)
+    assert cache.store('new', str(src)) == str(src)
+    assert os.path.getsize(src) == 100
+    cache.release(pinned)
+    assert cache.store('new', str(src)) != str(src)
+    assert cache.lookup('pinned') is None
+
+
+def test_room_taken_while_copying_moves_file_back(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=150)
+    finalize = result_cache_module.finalize_file
+    other = write_file(tmp_path / 'other.mp4', 100)
+
+    def finalize_then_pin(src, dest):
+        method = finalize(src, dest)
+        if os.path.exists(other):
+            # 复制期间另一个任务存入并开始传输，淘汰不掉
+            cache.acquire(cache.store('other', str(other)))
+        return method
+
+    monkeypatch.setattr(result_cache_module, 'finalize_file', finalize_then_pin)
+    src = write_file(tmp_path / 'new.mp4', 100)
+    assert cache.store('new', str(src)) == str(src)
+    assert os.path.getsize(src) == 100
+    assert [name for name in os.listdir(cache.root) if name.startswith(STAGING_PREFIX)] == []
+
+
+def test_concurrent_store_of_same_key_reuses_entry(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    first = cache.store('a', str(write_file(tmp_path / 'first.mp4', 100)))
+    cache.acquire(first)
+    second = cache.store('a', str(write_file(tmp_path / 'second.mp4', 100)))
+    assert second == first and os.path.exists(first)
+    assert cache.stats()['total_bytes'] == 100
+
+
+def test_quota_and_pins_shared_between_processes(tmp_path):
+    # 同一目录的两个实例相当于两个worker进程
+    first = ResultCache(str(tmp_path / 'cache'), max_bytes=250)
+    second = ResultCache(str(tmp_path / 'cache'), max_bytes=250)
+    pinned = first.store('pinned', str(write_file(tmp_path / 'pinned.mp4', 100)))
+    assert first.acquire(pinned)
+    old = second.store('old', str(write_file(tmp_path / 'old.mp4', 100)))
+    assert second.lookup('pinned') == pinned
+    # 第三个文件放不下：另一个进程固定的最旧条目保留，淘汰未固定的条目
+    os.utime(pinned, (0, 0))
+    os.utime(old, (1, 1))
+    new = second.store('new', str(write_file(tmp_path / 'new.mp4', 100)))
+    assert second.contains_path(new)
+    assert os.path.exists(pinned) and not os.path.exists(old)
+    assert first.stats()['total_bytes'] == 200
+    # 固定释放后可以被淘汰
+    first.release(pinned)
+    second.store('other', str(write_file(tmp_path / 'other.mp4', 100)))
+    assert first.lookup('pinned') is None
+    assert first.lookup('new') == new
+
+
+def test_store_reuses_entry_written_by_other_process(tmp_path):
+    first = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    second = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    path = first.store('a', str(write_file(tmp_path / 'first.mp4', 100)))
+    assert second.store('a', str(write_file(tmp_path / 'second.mp4', 100))) == path
+    assert second.stats()['entries'] == 1
+
+
+def test_leased_entry_is_not_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=150)
+    leased = cache.store('leased', str(write_file(tmp_path / 'leased.mp4', 100)))
+    # 交给代理发送：固定释放后租约仍然有效
+    cache.acquire(leased)
+    assert cache.lease(leased, 60)
+    cache.release(leased)
+    src = write_file(tmp_path / 'new.mp4', 100)
+    assert cache.store('new', str(src)) == str(src)
+    assert cache.lookup('leased') == leased
+    # 租约到期后可以被淘汰
+    os.utime(os.path.join(os.path.dirname(leased), LEASE_FILENAME), (0, 0))
+    assert cache.store('new', str(src)) != str(src)
+    assert cache.lookup('leased') is None
+    assert not cache.lease(leased, 60)
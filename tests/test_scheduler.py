@@ -0,0 +1,164 @@
+"""JobScheduler：短任务优先排序、队列上限、取消"""
+
+import threading
+import time
+
+import pytest
+
+from app.scheduler import JobScheduler, QueueFullError, estimate_job_cost
+
+UNLIMITED = {'*': {}}
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def blocker():
+    """占住唯一的工作线程，后续提交的任务都留在队列中"""
+    release = threading.Event()
+    yield release
+    release.set()
+
+
+def occupy(scheduler, release, platform='other'):
+    scheduler.submit('blocker', lambda: release.wait(5), platform)
+    assert wait_until(lambda: scheduler.stats()['running'] == 1)
+
+
+def test_shortest_job_first(blocker):
+    scheduler = JobScheduler(max_workers=1, max_queue=10, platform_limits=UNLIMITED, aging_rate=0)
+    occupy(scheduler, blocker)
+    order = []
+    for job_id, cost in (('large', 300), ('small', 100), ('medium', 200)):
+        scheduler.submit(job_id, lambda job_id=job_id: order.append(job_id), cost=cost)
+
+    assert [scheduler.queue_position(job_id) for job_id in ('small', 'medium', 'large')] == [1, 2, 3]
+    blocker.set()
+    assert wait_until(lambda: len(order) == 3)
+    assert order == ['small', 'medium', 'large']
+
+
+def test_aging_moves_old_jobs_forward(blocker):
+    scheduler = JobScheduler(max_workers=1, max_queue=10, platform_limits=UNLIMITED, aging_rate=1000)
+    occupy(scheduler, blocker)
+    scheduler.submit('old', lambda: None, cost=10_000)
+    scheduler._submitted['old'] -= 20  # 已等待20秒：10000 - 20*1000 < 5000
+    scheduler.submit('new', lambda: None, cost=5_000)
+    assert scheduler.queue_position('old') == 1
+
+
+def test_set_cost_reorders(blocker):
+    scheduler = JobScheduler(max_workers=1, max_queue=10, platform_limits=UNLIMITED, aging_rate=0)
+    occupy(scheduler, blocker)
+    scheduler.submit('a', lambda: None, cost=100)
+    scheduler.submit('b', lambda: None)
+    assert scheduler.set_cost('b', 1)
+    assert scheduler.queue_position('b') == 1
+    assert not scheduler.set_cost('missing', 1)
+
+
+def test_queue_bound(blocker):
+    scheduler = JobScheduler(max_workers=1, max_queue=2, platform_limits=UNLIMITED)
+    occupy(scheduler, blocker)
+    scheduler.submit('a', lambda: None)
+    scheduler.submit('b', lambda: None)
+    with pytest.raises(QueueFullError) as excinfo:
+        scheduler.submit('c', lambda: None)
+    assert excinfo.value.retry_after > 0
+
+
+def test_queue_bound_with_platform_cap():
+    """平台并发上限低于工作线程数时，运行中的任务达不到 max_workers，队列仍然有界"""
+    release = threading.Event()
+    limits = {'bilibili': {'concurrency': 3}, '*': {}}
+    scheduler = JobScheduler(max_workers=4, max_queue=5, platform_limits=limits)
+    accepted = 0
+    try:
+        for i in range(200):
+            try:
+                scheduler.submit(f'job{i}', lambda: release.wait(5), 'bilibili')
+                accepted += 1
+            except QueueFullError:
+                pass
+            # 让工作线程先取走能立即执行的任务
+            if i < 3:
+                wait_until(lambda: scheduler.stats()['running'] == i + 1)
+        stats = scheduler.stats()
+        assert stats['running'] == 3
+        assert stats['queued'] == 5
+        assert accepted == 8
+    finally:
+        release.set()
+
+
+def test_cancel_queued_job(blocker):
+    scheduler = JobScheduler(max_workers=1, max_queue=10, platform_limits=UNLIMITED)
+    occupy(scheduler, blocker)
+    ran = []
+    scheduler.submit('a', lambda: ran.append('a'))
+    scheduler.submit('b', lambda: ran.append('b'))
+    assert scheduler.cancel('a')
+    assert not scheduler.cancel('a')
+    assert scheduler.queue_position('a') is None
+    assert not scheduler.cancel('blocker')
+    blocker.set()
+    assert wait_until(lambda: ran == ['b'])
+    assert scheduler.wait_idle(5)
+
+
+def test_requeue_runs_later_without_blocking_worker():
+    scheduler = JobScheduler(max_workers=1, max_queue=10, platform_limits=UNLIMITED)
+    order = []
+
+    def waiting():
+        order.append('waiting')
+        if order.count('waiting') == 1:
+            scheduler.requeue('waiting', waiting, delay=0.2)
+
+    scheduler.submit('waiting', waiting, cost=1)
+    scheduler.submit('other', lambda: order.append('other'), cost=2)
+    assert wait_until(lambda: len(order) == 3)
+    assert order == ['waiting', 'other', 'waiting']
+    assert scheduler.stats()['completed'] == 2
+
+
+def test_requeued_job_does_not_consume_rate_token():
+    # 速率令牌只有一个：第一次执行时已用掉，重试不应再等待令牌
+    scheduler = JobScheduler(max_workers=1, max_queue=10,
+                             platform_limits={'*': {'rate': 0.01, 'burst': 1}})
+    runs = []
+
+    def waiting():
+        runs.append(time.time())
+        if len(runs) == 1:
+            scheduler.requeue('waiting', waiting)
+
+    scheduler.submit('waiting', waiting)
+    assert wait_until(lambda: len(runs) == 2, timeout=2)
+
+
+def test_shared_workers_limit_total_across_schedulers(tmp_path, blocker):
+    # 两个共享目录的调度器相当于两个worker进程，合计只能同时执行 max_workers 个任务
+    first = JobScheduler(max_workers=1, platform_limits=UNLIMITED, shared_dir=str(tmp_path))
+    second = JobScheduler(max_workers=1, platform_limits=UNLIMITED, shared_dir=str(tmp_path))
+    occupy(first, blocker)
+    done = threading.Event()
+    second.submit('other', done.set)
+    assert not done.wait(0.3)
+    # 名额被另一个进程释放时不会通知本进程，靠定期重试开始执行
+    blocker.set()
+    assert done.wait(5)
+
+
+def test_estimate_job_cost():
+    assert estimate_job_cost(None) is None
+    assert estimate_job_cost({'filesize': 1234}) == 1234
+    assert estimate_job_cost({'duration': 10}) == 10 * 375 * 1024
+    assert estimate_job_cost({'title': 'x'}) is None
@@ -0,0 +1,81 @@
+"""ZipStream：预先计算的长度与实际输出一致，输出可被标准库解压"""
+
+import io
+import zipfile
+
+import pytest
+
+from app import zip_stream
+from app.zip_stream import ZipStream
+
+
+@pytest.fixture
+def files(tmp_path):
+    contents = {'a.mp4': b'a' * 1000, '视频.mp4': bytes(range(256)) * 50, 'empty.mp4': b''}
+    paths = []
+    for name, data in contents.items():
+        path = tmp_path / name
+        path.write_bytes(data)
+        paths.append((name, str(path)))
+    return contents, paths
+
+
+def read_all(stream):
+    return b''.join(stream)
+
+
+def test_length_matches_output_and_archive_is_valid(files):
+    contents, paths = files
+    stream = ZipStream(paths, chunk_size=100)
+    data = read_all(stream)
+    assert len(stream) == len(data)
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert {name: archive.read(name) for name in archive.namelist()} == contents
+
+
+def test_duplicate_names_are_numbered(files):
+    contents, paths = files
+    name, path = paths[0]
+    with zipfile.ZipFile(io.BytesIO(read_all(ZipStream([(name, path), (name, path), (name, path)])))) as archive:
+        assert archive.namelist() == ['a.mp4', 'a (2).mp4', 'a (3).mp4']
+
+
+def test_zip64_end_records(files, monkeypatch):
+    # 降低阈值模拟条目数超限，验证 ZIP64 结束记录
+    contents, paths = files
+    monkeypatch.setattr(zip_stream, 'ZIP_MAX_ENTRIES', 2)
+    stream = ZipStream(paths)
+    assert stream.zip64_end
+    data = read_all(stream)
+    assert len(stream) == len(data)
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert len(archive.namelist()) == 3
+
+
+def test_truncated_file_aborts(files):
+    contents, paths = files
+    stream = ZipStream(paths)
+    with open(paths[0][1], 'wb') as f:
+        f.write(b'short')
+    with pytest.raises(IOError):
+        read_all(stream)
+    assert all(entry.file.closed for entry in stream.entries)
+
+
+def test_missing_file_closes_opened_files(files):
+    contents, paths = files
+    opened = []
+    original = zip_stream._Entry
+
+    class TrackingEntry(original):
+        def __init__(self, name, path):
+            super().__init__(name, path)
+            opened.append(self.file)
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(zip_stream, '_Entry', TrackingEntry)
+        with pytest.raises(OSError):
+            ZipStream(paths + [('missing.mp4', paths[0][1] + '.missing')])
+    assert opened and all(file.closed for file in opened)